@@ -0,0 +1,222 @@
+# -*- coding: utf-8 -*-
+"""
+agregacion_piezas.py
+Agregación de piezas para proyectos grandes de Carpinter-IA.
+
+Un despiece (o un lote de imágenes) repite la misma pieza en filas y páginas
+distintas. Agregado fusiona las piezas iguales —mismo largo, ancho, cantos y
+material— sumando la cantidad, con una tolerancia en mm para las lecturas
+OCR casi iguales, y guarda un índice compacto:
+
+- columnas en array (largo, ancho, cantos, material, cantidad, nº de
+  entradas fusionadas) en lugar de un dict por pieza;
+- cuadrícula de celdas de lado tolerancia+1 para encontrar la pieza
+  equivalente sin recorrer la lista;
+- largos ordenados (bisect) para filtrar por rango de medidas;
+- área acumulada por material, actualizada en cada inserción.
+
+Es incremental: agregar() se llama por imagen o página según llegan los
+resultados y fusionar() une agregados parciales, sin reordenar nada. La
+pieza representativa es la primera vista (sus medidas no cambian), así que
+piezas separadas por más de la tolerancia nunca se encadenan. El orden de
+salida es el de primera aparición (arriba -> abajo, página a página).
+
+Variables de entorno:
+- AGREGACION_TOLERANCIA_MM  diferencia máxima de largo/ancho para fusionar
+                            (por defecto 0: solo piezas idénticas)
+"""
+
+import os
+import bisect
+from array import array
+
+AGREGACION_TOLERANCIA_MM = int(os.environ.get("AGREGACION_TOLERANCIA_MM", 0))
+
+_CANTOS = ("L1", "L2", "A1", "A2")
+
+
+def _mascara_cantos(cantos):
+    """{"L1": bool, "L2": ..., "A1": ..., "A2": ...} (o máscara int) -> máscara de 4 bits."""
+    if isinstance(cantos, int):
+        return cantos & 0xF
+    if not isinstance(cantos, dict):
+        return 0
+    return sum(1 << i for i, k in enumerate(_CANTOS) if cantos.get(k))
+
+
+def _cantos_dict(mascara):
+    return {k: bool(mascara >> i & 1) for i, k in enumerate(_CANTOS)}
+
+
+def _orden_pagina(v):
+    """Números primero, en orden numérico; después el resto como texto."""
+    return (0, v, "") if isinstance(v, int) else (1, 0, str(v))
+
+
+def _entero(valor, defecto):
+    try:
+        return int(valor)
+    except (TypeError, ValueError):
+        return defecto
+
+
+class Agregado:
+    def __init__(self, tolerancia=None):
+        self.tolerancia = max(0, int(AGREGACION_TOLERANCIA_MM if tolerancia is None else tolerancia))
+        self._celda = self.tolerancia + 1
+        # columnas: una posición por pieza agregada
+        self.largo = array("l")
+        self.ancho = array("l")
+        self.cantos = array("B")
+        self.material = array("l")
+        self.cantidad = array("q")
+        self.fusionadas = array("l")
+        self.textos = []        # ocr_texto de la pieza representativa
+        self.paginas = []       # páginas de origen (set) o None
+        self._materiales = []   # id -> nombre
+        self._material_id = {}
+        self._celdas = {}       # (material, cantos, largo // celda, ancho // celda) -> [fila, ...]
+        self._largos = array("l")     # largos ordenados...
+        self._por_largo = array("l")  # ...y la fila de cada uno
+        self._area_mm2 = array("d")   # por material
+        self.entradas = 0
+
+    def __len__(self):
+        return len(self.largo)
+
+    # --------------------- inserción ---------------------
+    def _id_material(self, nombre):
+        nombre = nombre or ""
+        mid = self._material_id.get(nombre)
+        if mid is None:
+            mid = self._material_id[nombre] = len(self._materiales)
+            self._materiales.append(nombre)
+            self._area_mm2.append(0.0)
+        return mid
+
+    def _buscar(self, mid, mascara, largo, ancho):
+        """Fila equivalente (la más cercana dentro de la tolerancia) o None."""
+        cl, ca = largo // self._celda, ancho // self._celda
+        vecinas = (0,) if not self.tolerancia else (-1, 0, 1)
+        mejor, mejor_dist = None, None
+        for dl in vecinas:
+            for da in vecinas:
+                for fila in self._celdas.get((mid, mascara, cl + dl, ca + da), ()):
+                    dist = max(abs(self.largo[fila] - largo), abs(self.ancho[fila] - ancho))
+                    if dist <= self.tolerancia and (mejor is None or (dist, fila) < (mejor_dist, mejor)):
+                        mejor, mejor_dist = fila, dist
+        return mejor
+
+    def _anadir(self, cantidad, largo, ancho, mascara, mid, texto, paginas, fusionadas=1):
+        self.entradas += fusionadas
+        fila = self._buscar(mid, mascara, largo, ancho)
+        if fila is not None:
+            # el área cuenta con las medidas de la representativa
+            self._area_mm2[mid] += cantidad * self.largo[fila] * self.ancho[fila]
+            self.cantidad[fila] += cantidad
+            self.fusionadas[fila] += fusionadas
+            if paginas:
+                if self.paginas[fila] is None:
+                    self.paginas[fila] = set()
+                self.paginas[fila].update(paginas)
+            return fila
+        self._area_mm2[mid] += cantidad * largo * ancho
+        fila = len(self.largo)
+        self.largo.append(largo)
+        self.ancho.append(ancho)
+        self.cantos.append(mascara)
+        self.material.append(mid)
+        self.cantidad.append(cantidad)
+        self.fusionadas.append(fusionadas)
+        self.textos.append(texto)
+        self.paginas.append(set(paginas) if paginas else None)
+        clave = (mid, mascara, largo // self._celda, ancho // self._celda)
+        self._celdas.setdefault(clave, []).append(fila)
+        pos = bisect.bisect_right(self._largos, largo)
+        self._largos.insert(pos, largo)
+        self._por_largo.insert(pos, fila)
+        return fila
+
+    def agregar(self, piezas, material=None, pagina=None):
+        """
+        Añade piezas (dicts de OCR o de _normalize_piezas). material/pagina se
+        usan para las piezas que no traen los suyos. Devuelve self.
+        """
+        for p in piezas or []:
+            cant = _entero(p.get("cantidad", p.get("qty", 1)), 1)
+            largo = _entero(p.get("largo", p.get("length", 0)), 0)
+            ancho = _entero(p.get("ancho", p.get("width", 0)), 0)
+            pag = p.get("pagina", pagina)
+            self._anadir(cant, largo, ancho, _mascara_cantos(p.get("cantos")),
+                         self._id_material(p.get("material") or material),
+                         p.get("ocr_texto", f"{cant} {largo}x{ancho}"),
+                         [pag] if pag is not None else None)
+        return self
+
+    def fusionar(self, otro):
+        """Añade las piezas de otro Agregado (p. ej. de otro worker). Devuelve self."""
+        for k in range(len(otro)):
+            self._anadir(otro.cantidad[k], otro.largo[k], otro.ancho[k], otro.cantos[k],
+                         self._id_material(otro._materiales[otro.material[k]]),
+                         otro.textos[k], otro.paginas[k], otro.fusionadas[k])
+        return self
+
+    # --------------------- consultas ---------------------
+    def _pieza(self, fila):
+        cant = self.cantidad[fila]
+        p = {"cantidad": cant, "largo": self.largo[fila], "ancho": self.ancho[fila],
+             "cantos": _cantos_dict(self.cantos[fila]),
+             "ocr_texto": f"{cant} {self.largo[fila]}x{self.ancho[fila]}",
+             "fusionadas": self.fusionadas[fila]}
+        if self.fusionadas[fila] == 1:
+            p["ocr_texto"] = self.textos[fila]
+        material = self._materiales[self.material[fila]]
+        if material:
+            p["material"] = material
+        paginas = sorted(self.paginas[fila] or (), key=_orden_pagina)
+        if paginas:
+            p["pagina"] = paginas[0] if len(paginas) == 1 else ", ".join(str(v) for v in paginas)
+        return p
+
+    def piezas(self):
+        """Piezas agregadas en orden de primera aparición."""
+        return [self._pieza(k) for k in range(len(self))]
+
+    def filtrar(self, largo=None, ancho=None, material=None):
+        """
+        Piezas con largo/ancho dentro de los rangos (min, max) inclusivos (None =
+        sin límite) y, si se indica, de ese material; en orden de primera aparición.
+        """
+        lmin, lmax = largo or (None, None)
+        i = 0 if lmin is None else bisect.bisect_left(self._largos, lmin)
+        j = len(self._largos) if lmax is None else bisect.bisect_right(self._largos, lmax)
+        amin, amax = ancho or (None, None)
+        mid = self._material_id.get(material or "") if material is not None else None
+        if material is not None and mid is None:
+            return []
+        filas = []
+        for fila in self._por_largo[i:j]:
+            a = self.ancho[fila]
+            if (amin is not None and a < amin) or (amax is not None and a > amax):
+                continue
+            if mid is not None and self.material[fila] != mid:
+                continue
+            filas.append(fila)
+        return [self._pieza(k) for k in sorted(filas)]
+
+    def area_m2(self, material=None):
+        """Área total (m²) por material, o la de un material si se indica."""
+        if material is not None:
+            mid = self._material_id.get(material or "")
+            return round(self._area_mm2[mid] / 1e6, 4) if mid is not None else 0.0
+        return {nombre: round(self._area_mm2[mid] / 1e6, 4) for mid, nombre in enumerate(self._materiales)}
+
+    def stats(self):
+        return {"entradas": self.entradas, "piezas": len(self), "unidades": int(sum(self.cantidad)),
+                "fusionadas": self.entradas - len(self), "tolerancia_mm": self.tolerancia,
+                "area_m2": self.area_m2()}
+
+
+def agregar_piezas(piezas, tolerancia=None, material=None):
+    """Atajo: lista de piezas -> lista agregada."""
+    return Agregado(tolerancia).agregar(piezas, material=material).piezas()
@@ -1,27 +1,194 @@
 # -*- coding: utf-8 -*-
+import io
 import os
 import json
-import tempfile
-from flask import Flask, request, jsonify, send_file
+import time
+import logging
+from concurrent.futures import ThreadPoolExecutor
+from flask import Flask, Request, request, jsonify, send_file, url_for, g, Response
 from flask_cors import CORS
 from werkzeug.utils import secure_filename
 
-from ocr_rayas_tesseract import run_ocr_and_get_pieces  # usa tu función OCR
+# ocr_rayas_tesseract (cv2, numpy, pytesseract) y generar_pdf (ReportLab, openpyxl)
+# se importan dentro de las funciones: el proceso arranca y /health responde
+# sin cargarlos. ocr_warmup los carga y ejercita antes de /ready.
+from ocr_cache import cache_key, get_cache
+from ocr_jobs import get_queue, QueueFull, OCR_JOB_BUDGET
+from ocr_admission import get_limiter, Saturated, OCR_ADMISSION_WAIT
+from ocr_results import get_store
+import ocr_metrics
+import ocr_warmup
+
+logger = logging.getLogger("carpinter_ocr")
+
+# Límite de subida: OCR_MAX_UPLOAD_MB por archivo (se comprueba en cada endpoint)
+# y, para la petición entera (Flask responde 413 antes de leer el cuerpo), el de
+# un archivo en todos los endpoints salvo /ocr/batch, que admite un lote completo.
+# 1 MB extra para los campos del formulario.
+OCR_MAX_UPLOAD_MB = float(os.environ.get("OCR_MAX_UPLOAD_MB", 25))
+OCR_MAX_UPLOAD_BYTES = int(OCR_MAX_UPLOAD_MB * 1024 * 1024)
+OCR_BATCH_MAX_FILES = int(os.environ.get("OCR_BATCH_MAX_FILES", 50))
+_MAX_PETICION = OCR_MAX_UPLOAD_BYTES + 1024 * 1024
+_MAX_PETICION_LOTE = OCR_MAX_UPLOAD_BYTES * OCR_BATCH_MAX_FILES + 1024 * 1024
+
+
+class _PeticionOCR(Request):
+    """Límite del cuerpo según el endpoint (el endpoint ya se conoce al leer el formulario)."""
+
+    @property
+    def max_content_length(self):
+        return _MAX_PETICION_LOTE if self.endpoint == "ocr_batch_endpoint" else _MAX_PETICION
+
 
 app = Flask(__name__)
+app.request_class = _PeticionOCR
+app.config["MAX_CONTENT_LENGTH"] = _MAX_PETICION
 CORS(app)
 
+# Los resultados se guardan por id en ocr_results (SQLite compartido por los workers)
+RESULTADO_VACIO = {"piezas": [], "image_width": None, "image_height": None, "meta": {}}
+PDF_BLOB = "despiece.pdf"
+IMAGEN_BLOB = "imagen.jpg"  # imagen analizada (JPEG a MAX_SIDE): el overlay se dibuja sobre ella al pedirlo
+XLSX_MIMETYPE = "application/vnd.openxmlformats-officedocument.spreadsheetml.sheet"
+# Formatos de /results/<id>/despiece, en orden de preferencia si Accept admite cualquiera
+EXPORT_MIMETYPES = {"pdf": "application/pdf", "xlsx": XLSX_MIMETYPE, "json": "application/json"}
+# Formatos que se generan juntos (a la vez) en la primera descarga de un resultado
+EXPORT_PRERENDER = [f for f in os.environ.get("EXPORT_PRERENDER", "pdf,xlsx,json").split(",")
+                    if f in EXPORT_MIMETYPES]
+
+
+def _ocr_con_cache(data, lang="eng+spa", deadline=None, wait=OCR_ADMISSION_WAIT, lote=None, con_imagen=False,
+                   presupuesto=None):
+    """
+    Devuelve (resultado, hit). Si la imagen + parámetros ya se procesaron,
+    se sirve desde la caché; si no, se ejecuta el OCR decodificando en memoria.
+    El OCR ocupa una ranura del limitador global (Saturated si no hay en `wait` s)
+    y respeta el plazo `deadline` (si falta, uno de `presupuesto` s, por defecto
+    OCR_REQUEST_BUDGET, que empieza al obtener la ranura).
+    `lote` es el Deadline de un lote: acota la espera de ranura y el plazo de la
+    página a lo que le queda (BudgetExceeded si ya no queda).
+    con_imagen: en un fallo de caché el resultado trae "imagen" (ndarray analizado).
+    Los resultados parciales no se guardan en caché.
+    """
+    from ocr_rayas_tesseract import (run_ocr_result, pipeline_params, Deadline,  # usa tu función OCR
+                                     BudgetExceeded, OCR_REQUEST_BUDGET)
+    cache = get_cache()
+    key = cache_key(data, **pipeline_params(lang)) if cache else None
+    if cache:
+        hit = cache.get(key)
+        if hit is not None:
+            ocr_metrics.observe_ocr_result(hit, True)
+            return hit, True
+
+    if lote is not None:
+        if lote.expired():
+            raise BudgetExceeded("Plazo del lote agotado")
+        restante = lote.remaining()
+        if restante is not None:
+            wait = restante if wait is None else min(wait, restante)
+    with get_limiter().slot(wait=wait):
+        if deadline is None and lote is not None:
+            if lote.expired():
+                raise BudgetExceeded("Plazo del lote agotado")
+            restante = lote.remaining()
+            if restante is not None and OCR_REQUEST_BUDGET > 0:
+                restante = min(restante, OCR_REQUEST_BUDGET)
+            deadline = Deadline(restante)
+        resultado = run_ocr_result(data, lang=lang, deadline=deadline or Deadline(presupuesto),
+                                   con_imagen=con_imagen)
+    ocr_metrics.observe_ocr_result(resultado, False if cache else None)
+    if cache and resultado.get("image_width") and not resultado.get("parcial"):
+        cache.put(key, {k: resultado[k] for k in ("piezas", "image_width", "image_height", "boxes",
+                                                  "filas", "textos_cajas", "meta")})
+    return resultado, False
+
+
+def _generar_documento(formato, piezas, **meta):
+    """
+    Genera el PDF o XLSX de las piezas. Devuelve (bytes, mimetype, ms) y
+    registra el tiempo en carpinter_pdf_build_seconds.
+    """
+    t0 = time.perf_counter()
+    if formato == "xlsx":
+        from generar_pdf import generar_xlsx_bytes
+        data, mimetype = generar_xlsx_bytes(piezas, **meta), XLSX_MIMETYPE
+    else:
+        from generar_pdf import generar_pdf_bytes
+        data, mimetype = generar_pdf_bytes(piezas, **meta), "application/pdf"
+    dur = time.perf_counter() - t0
+    ocr_metrics.PDF_BUILD_SECONDS.observe(dur, formato=formato)
+    return data, mimetype, dur * 1000.0
+
+
+def _documento_stream(formato, piezas, download_name, **meta):
+    """
+    Respuesta en streaming del PDF/XLSX: el documento se escribe en un fichero
+    temporal (memoria o disco según tamaño) y se envía por trozos, sin
+    mantener los bytes completos en memoria ni copiarlos a un BytesIO.
+    """
+    from generar_pdf import generar_spool, iter_spool
+    t0 = time.perf_counter()
+    spool, size = generar_spool(formato, piezas, **meta)
+    ocr_metrics.PDF_BUILD_SECONDS.observe(time.perf_counter() - t0, formato=formato)
+    mimetype = XLSX_MIMETYPE if formato == "xlsx" else "application/pdf"
+    resp = Response(iter_spool(spool), mimetype=mimetype, direct_passthrough=True)
+    resp.headers["Content-Length"] = str(size)
+    resp.headers["Content-Disposition"] = f"attachment; filename={download_name}"
+    return resp
+
+
+def _guardar_resultado(resultado, blobs):
+    """Guarda el resultado en el almacén; devuelve su id o None si falla (no rompe la petición)."""
+    blobs = {k: v for k, v in blobs.items() if v[0]}
+    try:
+        return get_store().put(resultado, blobs)
+    except Exception as e:
+        logger.warning(f"No se pudo guardar el resultado: {e}")
+        return None
+
+
+def _leer_archivo(f):
+    """Bytes del archivo subido, o None si supera OCR_MAX_UPLOAD_MB."""
+    data = f.stream.read(OCR_MAX_UPLOAD_BYTES + 1)
+    return None if len(data) > OCR_MAX_UPLOAD_BYTES else data
+
+
+def _demasiado_grande(nombre=None):
+    archivo = f"Archivo '{nombre}'" if nombre else "Archivo"
+    return jsonify({"error": f"{archivo} demasiado grande (máx. {OCR_MAX_UPLOAD_MB:g} MB por archivo)"}), 413
+
+
+def _saturado(e):
+    resp = jsonify({"error": "Servidor OCR saturado, reintente más tarde"})
+    resp.headers["Retry-After"] = str(e.retry_after)
+    return resp, 429
+
+
+@app.errorhandler(413)
+def upload_demasiado_grande(e):
+    return jsonify({"error": f"Petición demasiado grande (máx. {OCR_MAX_UPLOAD_MB:g} MB por archivo, "
+                             f"{OCR_BATCH_MAX_FILES} archivos por lote)"}), 413
+
+
+@app.before_request
+def _inicio_peticion():
+    g.t0 = time.perf_counter()
+
+
+@app.after_request
+def _fin_peticion(resp):
+    t0 = getattr(g, "t0", None)
+    if t0 is not None and request.endpoint not in (None, "metrics", "static"):
+        ocr_metrics.REQUEST_SECONDS.observe(time.perf_counter() - t0, endpoint=request.endpoint)
+    return resp
+
+
 # ------------------------------------------
-#   VARIABLE GLOBAL PARA GUARDAR RESULTADOS
+#      ENDPOINT: MÉTRICAS PROMETHEUS
 # ------------------------------------------
-ULTIMO_RESULTADO = {
-    "piezas": [],
-    "image_width": None,
-    "image_height": None,
-    "meta": {}
-}
-
-DEBUG_OVERLAY_PATH = "/tmp/debug_overlay.png"
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return Response(ocr_metrics.render(), mimetype="text/plain; version=0.0.4; charset=utf-8")
 
 
 # ------------------------------------------
@@ -32,6 +199,20 @@ def health_check():
     return jsonify({"status": "ok"}), 200
 
 
+# ------------------------------------------
+#      ENDPOINT READINESS (CALENTAMIENTO TERMINADO)
+# ------------------------------------------
+@app.route("/ready", methods=["GET"])
+def ready_check():
+    ocr_warmup.iniciar()  # sin gunicorn.conf.py (flask run, python app.py) arranca aquí
+    estado = ocr_warmup.estado()
+    if estado["listo"]:
+        return jsonify(dict(estado, status="ready")), 200
+    resp = jsonify(dict(estado, status="error" if estado["estado"] == "error" else "warming"))
+    resp.headers["Retry-After"] = "2"
+    return resp, 503
+
+
 # ------------------------------------------
 #   ENDPOINT PRINCIPAL /OCR
 # ------------------------------------------
@@ -45,37 +226,391 @@ def ocr_endpoint():
     espesor = request.form.get("espesor", "")
     cliente = request.form.get("cliente", "")
 
-    # guardar archivo temporal
-    with tempfile.NamedTemporaryFile(delete=False, suffix=".jpg") as tmp:
-        temp_path = tmp.name
-        file.save(temp_path)
-
-    # ejecutar OCR
+    # ejecutar OCR (o servir desde caché) con plazo único para toda la petición
+    data = _leer_archivo(file)
+    if data is None:
+        return _demasiado_grande(file.filename)
+    from ocr_rayas_tesseract import Deadline
+    deadline = Deadline()
+    t_ocr = time.perf_counter()
     try:
-        piezas, w, h = run_ocr_and_get_pieces(temp_path, debug_overlay=DEBUG_OVERLAY_PATH)
+        resultado, hit = _ocr_con_cache(data, deadline=deadline, con_imagen=True)
+    except Saturated as e:
+        return _saturado(e)
     except Exception as e:
         return jsonify({"error": str(e)}), 500
+    piezas = resultado["piezas"]
+    parcial = bool(resultado.get("parcial"))
+    ocr_ms = (time.perf_counter() - t_ocr) * 1000.0
 
-    # guardar resultado global
-    ULTIMO_RESULTADO["piezas"] = piezas
-    ULTIMO_RESULTADO["image_width"] = w
-    ULTIMO_RESULTADO["image_height"] = h
-    ULTIMO_RESULTADO["meta"] = {
-        "material": material,
-        "espesor": espesor,
-        "cliente": cliente,
-        "image_path": temp_path
-    }
-
-    # generar PDF desde piezas
+    # generar PDF desde piezas (en caché solo se regenera el PDF)
     try:
-        from generar_pdf import crear_pdf_desde_piezas
-        output_pdf = "/tmp/output_from_json.pdf"
-        crear_pdf_desde_piezas(piezas, output_pdf, material=material, espesor=espesor, cliente=cliente)
+        pdf, _, pdf_ms = _generar_documento("pdf", piezas, material=material, espesor=espesor, cliente=cliente)
     except Exception as e:
         return jsonify({"error": f"Error generando PDF: {e}"}), 500
 
-    return send_file(output_pdf, mimetype="application/pdf")
+    # guardar resultado (por id) con su PDF y la imagen analizada (para el overlay bajo demanda);
+    # solo un acierto de caché no la trae y hay que decodificar la subida
+    imagen, base_overlay = resultado.pop("imagen", None), None
+    if resultado.get("boxes"):
+        from ocr_rayas_tesseract import imagen_overlay
+        if imagen is not None:
+            base_overlay = imagen_overlay(imagen)
+        else:
+            base_overlay = imagen_overlay(data, orientacion=(resultado.get("meta") or {}).get("orientacion"))
+    result_id = _guardar_resultado({
+        "piezas": piezas,
+        "image_width": resultado["image_width"],
+        "image_height": resultado["image_height"],
+        "boxes": resultado.get("boxes", []),
+        "filas": resultado.get("filas", []),
+        "textos_cajas": resultado.get("textos_cajas", []),
+        "meta": {
+            "material": material,
+            "espesor": espesor,
+            "cliente": cliente,
+            "image_name": secure_filename(file.filename or ""),
+            "cache": "hit" if hit else "miss",
+            "fallback_global": resultado.get("meta", {}).get("fallback_global"),
+            "orientacion": resultado.get("meta", {}).get("orientacion"),
+            "parcial": parcial
+        }
+    }, {PDF_BLOB: (pdf, "application/pdf"), IMAGEN_BLOB: (base_overlay, "image/jpeg")})
+
+    resp = send_file(io.BytesIO(pdf), mimetype="application/pdf", download_name="despiece.pdf")
+    if result_id:
+        resp.headers["X-Result-Id"] = result_id
+        resp.headers["X-Result-Url"] = url_for("ver_resultado", result_id=result_id)
+        resp.headers["X-Export-Url"] = url_for("exportar_resultado", result_id=result_id)
+    resp.headers["X-OCR-Cache"] = "HIT" if hit else "MISS"
+    resp.headers["X-OCR-Partial"] = "1" if parcial else "0"
+    tiempos = {} if hit else dict((resultado.get("meta") or {}).get("tiempos_ms") or {})
+    tiempos.pop("total", None)
+    tiempos["ocr"] = ocr_ms
+    tiempos["pdf"] = pdf_ms
+    resp.headers["Server-Timing"] = ocr_metrics.server_timing(tiempos)
+    return resp
+
+
+# ------------------------------------------
+#      ENDPOINT: ESTADÍSTICAS DE CACHÉ OCR
+# ------------------------------------------
+@app.route("/cache/stats", methods=["GET"])
+def cache_stats():
+    from ocr_row_cache import get_row_cache
+    cache, row_cache = get_cache(), get_row_cache()
+    out = dict(cache.stats(), enabled=True) if cache is not None else {"enabled": False}
+    out["filas"] = dict(row_cache.stats(), enabled=True) if row_cache is not None else {"enabled": False}
+    return jsonify(out), 200
+
+
+# ------------------------------------------
+#   LOTE: VARIAS IMÁGENES -> UN SOLO DESPIECE
+# ------------------------------------------
+OCR_BATCH_PAGES_PARALLELISM = int(os.environ.get("OCR_BATCH_PAGES_PARALLELISM", 0))  # 0 = OCR_PARALLELISM
+# Plazo de todo el lote (espera de ranura + OCR de cada página); por debajo del timeout de gunicorn
+OCR_BATCH_BUDGET = float(os.environ.get("OCR_BATCH_BUDGET", 100))
+
+
+def _ocr_lote(paginas, lang="eng+spa"):
+    """
+    OCR en paralelo de [(nombre, bytes), ...]. Devuelve (piezas, resumen_paginas)
+    con las piezas en orden de página y cada pieza marcada con "pagina"/"archivo".
+    Todas las páginas comparten el plazo OCR_BATCH_BUDGET: las que no consiguen
+    ranura o no empiezan a tiempo quedan con error en su resumen.
+    """
+    from ocr_rayas_tesseract import Deadline, OCR_PARALLELISM
+    lote = Deadline(OCR_BATCH_BUDGET)
+
+    def una(args):
+        n, (nombre, data) = args
+        try:
+            # las páginas esperan ranura como mucho lo que le queda al lote
+            resultado, hit = _ocr_con_cache(data, lang=lang, wait=None, lote=lote)
+            return n, nombre, resultado, hit, None
+        except Exception as e:
+            return n, nombre, None, False, str(e)
+
+    workers = max(1, min(OCR_BATCH_PAGES_PARALLELISM or OCR_PARALLELISM, len(paginas)))
+    with ThreadPoolExecutor(max_workers=workers, thread_name_prefix="ocr-lote") as ex:
+        salidas = list(ex.map(una, enumerate(paginas, 1)))
+
+    piezas, resumen = [], []
+    for n, nombre, resultado, hit, error in salidas:
+        if error is None and not resultado.get("image_width"):
+            error = "No se pudo leer la imagen"
+        if error is not None:
+            resumen.append({"pagina": n, "archivo": nombre, "error": error, "piezas": 0})
+            continue
+        for p in resultado["piezas"]:
+            piezas.append(dict(p, pagina=n, archivo=nombre))
+        resumen.append({"pagina": n, "archivo": nombre, "piezas": len(resultado["piezas"]),
+                        "image_width": resultado["image_width"],
+                        "image_height": resultado["image_height"],
+                        "parcial": bool(resultado.get("parcial")),
+                        "cache": "hit" if hit else "miss"})
+    return piezas, resumen
+
+
+@app.route("/ocr/batch", methods=["POST"])
+def ocr_batch_endpoint():
+    files = request.files.getlist("files") or request.files.getlist("file")
+    if not files:
+        return jsonify({"error": "Faltan los archivos 'files'"}), 400
+    if len(files) > OCR_BATCH_MAX_FILES:
+        return jsonify({"error": f"Máximo {OCR_BATCH_MAX_FILES} archivos por lote"}), 400
+
+    material = request.form.get("material", "")
+    espesor = request.form.get("espesor", "")
+    cliente = request.form.get("cliente", "")
+    formato = (request.form.get("formato") or request.args.get("formato") or "pdf").lower()
+    # agrupar=1: fusionar piezas iguales de todas las páginas (tolerancia en mm opcional)
+    agrupar = (request.form.get("agrupar") or request.args.get("agrupar") or "0") == "1"
+    try:
+        tolerancia = request.form.get("tolerancia") or request.args.get("tolerancia")
+        tolerancia = int(tolerancia) if tolerancia else None
+    except ValueError:
+        return jsonify({"error": "tolerancia no válida"}), 400
+
+    # admisión: si no hay ranura libre ahora, rechazar el lote entero
+    limiter = get_limiter()
+    try:
+        limiter.release(limiter.acquire())
+    except Saturated as e:
+        return _saturado(e)
+
+    paginas = []
+    for i, f in enumerate(files, 1):
+        data = _leer_archivo(f)
+        if data is None:
+            return _demasiado_grande(f.filename)
+        paginas.append((secure_filename(f.filename or "") or f"pagina_{i}", data))
+    piezas, resumen = _ocr_lote(paginas)
+    agregacion = None
+    if agrupar:
+        from agregacion_piezas import Agregado
+        agregado = Agregado(tolerancia).agregar(piezas, material=material)
+        piezas, agregacion = agregado.piezas(), agregado.stats()
+
+    if formato == "json":
+        out = {"piezas": piezas, "paginas": resumen,
+               "meta": {"material": material, "espesor": espesor, "cliente": cliente}}
+        if agregacion is not None:
+            out["agregacion"] = agregacion
+        return jsonify(out), 200
+    formato = "xlsx" if formato == "xlsx" else "pdf"
+    try:
+        resp = _documento_stream(formato, piezas, f"despiece_lote.{formato}",
+                                 material=material, espesor=espesor, cliente=cliente)
+    except Exception as e:
+        return jsonify({"error": f"Error generando {formato.upper()}: {e}"}), 500
+    # el documento no lleva el resumen: las páginas fallidas o parciales van en cabeceras
+    fallidas = [str(r["pagina"]) for r in resumen if r.get("error")]
+    parciales = [str(r["pagina"]) for r in resumen if r.get("parcial")]
+    resp.headers["X-OCR-Pages"] = str(len(resumen))
+    resp.headers["X-OCR-Failed-Pages"] = ",".join(fallidas)
+    resp.headers["X-OCR-Partial-Pages"] = ",".join(parciales)
+    resp.headers["X-OCR-Partial"] = "1" if fallidas or parciales else "0"
+    return resp
+
+
+# ------------------------------------------
+#   TRABAJOS ASÍNCRONOS: POST /jobs + GET /jobs/<id>
+# ------------------------------------------
+def _job_ocr(data, lang="eng+spa"):
+    """Se ejecuta en un hilo worker de ocr_jobs; devuelve el resultado JSON."""
+    # presupuesto propio (OCR_JOB_BUDGET), no el de una petición HTTP síncrona
+    resultado, hit = _ocr_con_cache(data, lang=lang, wait=None, presupuesto=OCR_JOB_BUDGET)
+    return {
+        "piezas": resultado["piezas"],
+        "image_width": resultado["image_width"],
+        "image_height": resultado["image_height"],
+        "boxes": resultado.get("boxes", []),
+        "ocr_meta": resultado.get("meta", {}),
+        "parcial": bool(resultado.get("parcial")),
+        "cache": "hit" if hit else "miss",
+    }
+
+
+def _job_publico(job):
+    out = {k: job[k] for k in ("id", "status", "created", "started", "finished", "error")}
+    out["meta"] = job.get("meta") or {}
+    if job["status"] == "done":
+        out["result_urls"] = {
+            fmt: url_for("job_result", job_id=job["id"], fmt=fmt) for fmt in ("json", "pdf", "xlsx")
+        }
+    return out
+
+
+@app.route("/jobs", methods=["POST"])
+def crear_job():
+    if "file" not in request.files:
+        return jsonify({"error": "Falta el archivo 'file'"}), 400
+    meta = {k: request.form.get(k, "") for k in ("material", "espesor", "cliente")}
+    data = _leer_archivo(request.files["file"])
+    if data is None:
+        return _demasiado_grande(request.files["file"].filename)
+    try:
+        job = get_queue().submit(_job_ocr, data, meta=meta)
+    except QueueFull:
+        resp = jsonify({"error": "Cola de trabajos llena, reintente más tarde"})
+        resp.headers["Retry-After"] = "5"
+        return resp, 429
+    resp = jsonify({"job_id": job["id"], "status": job["status"],
+                    "status_url": url_for("estado_job", job_id=job["id"])})
+    resp.headers["Location"] = url_for("estado_job", job_id=job["id"])
+    return resp, 202
+
+
+@app.route("/jobs/<job_id>", methods=["GET"])
+def estado_job(job_id):
+    job = get_queue().store.get(job_id)
+    if not job:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    return jsonify(_job_publico(job)), 200
+
+
+@app.route("/jobs/<job_id>/result.<fmt>", methods=["GET"])
+def job_result(job_id, fmt):
+    job = get_queue().store.get(job_id)
+    if not job:
+        return jsonify({"error": "Trabajo no encontrado"}), 404
+    if job["status"] == "error":
+        return jsonify({"error": job["error"], "status": "error"}), 500
+    if job["status"] != "done":
+        resp = jsonify({"status": job["status"]})
+        resp.headers["Retry-After"] = "2"
+        return resp, 409
+
+    result, meta = job["result"], job.get("meta") or {}
+    if fmt == "json":
+        return jsonify(dict(result, meta=meta)), 200
+    if fmt in ("pdf", "xlsx"):
+        return _documento_stream(fmt, result["piezas"], f"despiece_{job_id}.{fmt}", **meta)
+    return jsonify({"error": f"Formato no soportado: {fmt}"}), 400
+
+
+# ------------------------------------------
+#   RESULTADOS POR ID: GET /results/<id>[/<artefacto>]
+# ------------------------------------------
+@app.route("/results/<result_id>", methods=["GET"])
+def ver_resultado(result_id):
+    resultado = get_store().get(result_id)
+    if resultado is None:
+        return jsonify({"error": "Resultado no encontrado o caducado"}), 404
+    return jsonify(dict(resultado, id=result_id)), 200
+
+
+def _overlay_resultado(result_id, fmt="png", scale=1.0):
+    """
+    Overlay de depuración de un resultado, renderizado la primera vez que se
+    pide (formato + escala) y guardado después como blob del resultado.
+    Devuelve (bytes, mimetype) o None.
+    """
+    store = get_store()
+    nombre = f"overlay_{scale:g}.{fmt}"
+    blob = store.get_blob(result_id, nombre)
+    if blob is not None:
+        return blob
+    resultado = store.get(result_id)
+    imagen = store.get_blob(result_id, IMAGEN_BLOB)
+    if resultado is None or imagen is None or not resultado.get("boxes"):
+        return None
+    from ocr_rayas_tesseract import render_overlay
+    # la imagen guardada ya está corregida de orientación
+    data, mimetype = render_overlay(imagen[0], resultado["boxes"], resultado.get("filas"),
+                                    resultado.get("textos_cajas"),
+                                    size=(resultado["image_width"], resultado["image_height"]),
+                                    scale=scale, fmt=fmt)
+    if data is None:
+        return None
+    store.put_blob(result_id, nombre, data, mimetype)
+    return data, mimetype
+
+
+def _formato_pedido():
+    """Formato por ?formato= o por la cabecera Accept; None si no se puede servir ninguno."""
+    fmt = (request.args.get("formato") or "").lower()
+    if fmt:
+        return fmt if fmt in EXPORT_MIMETYPES else None
+    if not request.accept_mimetypes:  # sin Accept: cualquiera vale
+        return next(iter(EXPORT_MIMETYPES))
+    mejor = request.accept_mimetypes.best_match(list(EXPORT_MIMETYPES.values()))
+    return next((f for f, m in EXPORT_MIMETYPES.items() if m == mejor), None)
+
+
+@app.route("/results/<result_id>/despiece", methods=["GET"])
+def exportar_resultado(result_id):
+    """
+    Despiece de un resultado en PDF, XLSX o JSON (negociado con Accept).
+    La primera descarga genera a la vez los formatos de EXPORT_PRERENDER y
+    los guarda como blobs del resultado; las siguientes se sirven de ahí, o
+    con 304 si el ETag (huella del contenido + formato) coincide.
+    """
+    fmt = _formato_pedido()
+    if fmt is None:
+        return jsonify({"error": "Formato no disponible", "formatos": list(EXPORT_MIMETYPES)}), 406
+    store = get_store()
+    resultado = store.get(result_id)
+    if resultado is None:
+        return jsonify({"error": "Resultado no encontrado o caducado"}), 404
+
+    from generar_pdf import exportar, huella_export
+    meta = resultado.get("meta") or {}
+    opciones = {k: meta.get(k, "") for k in ("material", "espesor", "cliente")}
+    etag = f"{huella_export(resultado['piezas'], **opciones)}-{fmt}"
+    nombre = f"despiece.{fmt}"
+    if request.if_none_match.contains(etag):
+        resp, origen = Response(status=304), "not_modified"
+    else:
+        blob, origen = store.get_blob(result_id, nombre), "hit"
+        if blob is None:
+            origen = "miss"
+            hechos = store.blob_names(result_id)
+            formatos = [fmt] + [f for f in EXPORT_PRERENDER if f != fmt and f"despiece.{f}" not in hechos]
+            t0 = time.perf_counter()
+            try:
+                docs = exportar(resultado["piezas"], formatos, **opciones)
+            except Exception as e:
+                return jsonify({"error": f"Error generando {fmt.upper()}: {e}"}), 500
+            ocr_metrics.PDF_BUILD_SECONDS.observe(time.perf_counter() - t0, formato="+".join(formatos))
+            for f, data in docs.items():
+                store.put_blob(result_id, f"despiece.{f}", data, EXPORT_MIMETYPES[f])
+            blob = (docs[fmt], EXPORT_MIMETYPES[fmt])
+        resp = send_file(io.BytesIO(blob[0]), mimetype=blob[1], etag=False, conditional=False,
+                         as_attachment=True, download_name=f"despiece_{result_id[:8]}.{fmt}")
+    resp.set_etag(etag)
+    resp.headers["Vary"] = "Accept"
+    resp.headers["Cache-Control"] = "private, no-cache"
+    ocr_metrics.EXPORT_TOTAL.inc(formato=fmt, resultado=origen)
+    return resp
+
+
+def _overlay_formats():
+    from ocr_rayas_tesseract import OVERLAY_FORMATS
+    return OVERLAY_FORMATS
+
+
+@app.route("/results/<result_id>/<nombre>", methods=["GET"])
+def artefacto_resultado(result_id, nombre):
+    base, _, fmt = nombre.rpartition(".")
+    if base == "overlay" and fmt in _overlay_formats():
+        # /results/<id>/overlay.{png,jpg,webp}?scale=0.5
+        try:
+            scale = min(2.0, max(0.1, float(request.args.get("scale", 1))))
+        except ValueError:
+            return jsonify({"error": "scale no válido"}), 400
+        blob = _overlay_resultado(result_id, fmt, round(scale, 2))
+        if blob is None:
+            return jsonify({"error": "Overlay no disponible para este resultado"}), 404
+        return send_file(io.BytesIO(blob[0]), mimetype=blob[1], download_name=nombre)
+    if nombre == IMAGEN_BLOB:
+        return jsonify({"error": f"{nombre} no disponible para este resultado"}), 404
+    blob = get_store().get_blob(result_id, nombre)
+    if blob is None:
+        return jsonify({"error": f"{nombre} no disponible para este resultado"}), 404
+    data, mimetype = blob
+    return send_file(io.BytesIO(data), mimetype=mimetype, download_name=nombre)
 
 
 # ------------------------------------------
@@ -83,7 +618,11 @@ def ocr_endpoint():
 # ------------------------------------------
 @app.route("/last_result.json", methods=["GET"])
 def last_json():
-    return jsonify(ULTIMO_RESULTADO)
+    # el más reciente de cualquier worker; preferible usar /results/<id>
+    result_id, resultado = get_store().latest()
+    if resultado is None:
+        return jsonify(RESULTADO_VACIO)
+    return jsonify(dict(resultado, id=result_id))
 
 
 # ------------------------------------------
@@ -91,13 +630,16 @@ def last_json():
 # ------------------------------------------
 @app.route("/debug_overlay.png", methods=["GET"])
 def overlay():
-    if not os.path.exists(DEBUG_OVERLAY_PATH):
+    result_id, _ = get_store().latest(con_blob=IMAGEN_BLOB)
+    blob = _overlay_resultado(result_id) if result_id else None
+    if blob is None:
         return jsonify({"error": "Overlay no generado aún"}), 404
-    return send_file(DEBUG_OVERLAY_PATH, mimetype="image/png")
+    return send_file(io.BytesIO(blob[0]), mimetype=blob[1])
 
 
 # ------------------------------------------
 #      EJECUCIÓN LOCAL
 # ------------------------------------------
 if __name__ == "__main__":
+    ocr_warmup.iniciar()
     app.run(host="0.0.0.0", port=5000, debug=True)
@@ -0,0 +1,414 @@
+# -*- coding: utf-8 -*-
+"""
+bench_ocr.py
+Benchmark reproducible del pipeline de Carpinter-IA con hojas de despiece
+sintéticas (generadas offline con cv2.putText, sin ficheros externos).
+
+Cada hoja lleva filas "cantidad largo x ancho" conocidas agrupadas en cajas,
+en varias variantes: limpia, ruido, inclinada, baja_res y alta_res.
+Se ejecuta run_ocr_result (por etapas, vía meta["tiempos_ms"]) y después
+generar_pdf_bytes / generar_xlsx_bytes, y se informa de:
+- latencia p50/p90/p99 (total y por etapa)
+- llamadas a Tesseract por imagen
+- pico de RSS del proceso, del mayor hijo (tesseract o worker del pool,
+  muestreado en /proc) y de todos a la vez
+- precisión / exhaustividad de las ternas reconocidas
+- filas sueltas por el lector rápido de dígitos: leídas, a Tesseract y mal leídas
+
+Uso:
+    python bench_ocr.py                          # informe por pantalla
+    python bench_ocr.py --json bench.json        # guarda el informe
+    python bench_ocr.py --guardar-baseline       # guarda bench_baseline.json
+    python bench_ocr.py --baseline bench_baseline.json --tolerancia 0.15
+        -> sale con código 1 si hay regresión de latencia, llamadas, memoria o
+           precisión, si el lector de dígitos lee mal alguna fila o si el
+           pipeline no es el del baseline
+"""
+
+import os
+import re
+import sys
+import json
+import time
+import random
+import argparse
+import platform
+import threading
+from collections import Counter, defaultdict
+
+import cv2
+import numpy as np
+
+from ocr_rayas_tesseract import run_ocr_result, Deadline, pipeline_params
+from ocr_digitos import leer_fila
+from generar_pdf import generar_pdf_bytes, generar_xlsx_bytes
+
+VARIANTES = ("limpia", "ruido", "inclinada", "baja_res", "alta_res")
+BASELINE_DEFAULT = "bench_baseline.json"
+
+
+# --------------------- Hojas sintéticas ---------------------
+_FUENTES_HOJA = (cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX,
+                 cv2.FONT_HERSHEY_COMPLEX, cv2.FONT_HERSHEY_TRIPLEX)
+
+
+def _filas_aleatorias(rng, n):
+    filas = []
+    for _ in range(n):
+        cant = rng.randint(1, 12)
+        largo = rng.choice(range(100, 2500, 10))
+        ancho = rng.choice(range(60, 900, 10))
+        filas.append((cant, largo, ancho))
+    return filas
+
+
+def generar_hoja(rng, n_filas=12, variante="limpia"):
+    """
+    Devuelve (imagen BGR, [(cant, largo, ancho), ...]) con las filas en cajas
+    de 3-5 líneas sobre fondo blanco. Cada hoja usa una fuente Hershey y las
+    filas mezclan uno o dos espacios y "x" con o sin espacios alrededor.
+    """
+    filas = _filas_aleatorias(rng, n_filas)
+    fuente = rng.choice(_FUENTES_HOJA)
+    escala_txt, grosor, paso = 1.1, 2, 56
+    ancho_img = 900
+    alto_img = 80 + n_filas * paso + (n_filas // 3 + 1) * 40
+    img = np.full((alto_img, ancho_img, 3), 255, dtype=np.uint8)
+
+    y, i = 60, 0
+    while i < len(filas):
+        grupo = filas[i:i + rng.randint(3, 5)]
+        y0 = y - 42
+        for cant, largo, ancho in grupo:
+            sep, por = rng.choice((" ", "  ")), rng.choice(("x", " x "))
+            cv2.putText(img, f"{cant}{sep}{largo}{por}{ancho}", (70, y), fuente, escala_txt, (20, 20, 20),
+                        grosor, cv2.LINE_AA)
+            y += paso
+        cv2.rectangle(img, (40, y0), (560, y - paso + 18), (0, 0, 0), 2)
+        y += 40
+        i += len(grupo)
+
+    if variante == "ruido":
+        ruido = np.random.default_rng(rng.randint(0, 2 ** 31)).normal(0, 22, img.shape)
+        img = np.clip(img.astype(np.float32) + ruido, 0, 255).astype(np.uint8)
+        img = cv2.GaussianBlur(img, (3, 3), 0)
+    elif variante == "inclinada":
+        ang = rng.uniform(-4, 4)
+        m = cv2.getRotationMatrix2D((ancho_img / 2, alto_img / 2), ang, 1.0)
+        img = cv2.warpAffine(img, m, (ancho_img, alto_img), borderValue=(255, 255, 255))
+    elif variante == "baja_res":
+        img = cv2.resize(img, None, fx=0.55, fy=0.55, interpolation=cv2.INTER_AREA)
+    elif variante == "alta_res":
+        img = cv2.resize(img, None, fx=3.5, fy=3.5, interpolation=cv2.INTER_CUBIC)
+    return img, filas
+
+
+def _fila_sintetica(rng):
+    """Una fila suelta (gris) con fuente, escala, grosor y espaciado al azar, y su terna."""
+    cant, largo, ancho = _filas_aleatorias(rng, 1)[0]
+    texto = f"{cant}{rng.choice((' ', '  '))}{largo}{rng.choice(('x', ' x '))}{ancho}"
+    fuente, escala, grosor = rng.choice(_FUENTES_HOJA), rng.choice((0.9, 1.1, 1.4)), rng.choice((1, 2))
+    (tw, th), base = cv2.getTextSize(texto, fuente, escala, grosor)
+    img = np.full((th + base + 20, tw + 30), 255, dtype=np.uint8)
+    cv2.putText(img, texto, (15, th + 10), fuente, escala, 20, grosor, cv2.LINE_AA)
+    return img, (cant, largo, ancho)
+
+
+def _jpeg(img, calidad=90):
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+    if not ok:
+        raise RuntimeError("No se pudo codificar la imagen sintética")
+    return buf.tobytes()
+
+
+# --------------------- Medidas ---------------------
+def _percentiles(valores, ps=(50, 90, 99)):
+    if not valores:
+        return {f"p{p}": None for p in ps}
+    arr = np.asarray(valores, dtype=np.float64)
+    return {f"p{p}": round(float(np.percentile(arr, p)), 2) for p in ps}
+
+
+def _vm_kb(pid, campo):
+    """Campo (VmHWM, VmRSS...) de /proc/<pid>/status en KB, o None."""
+    try:
+        with open(f"/proc/{pid}/status", "r") as f:
+            for linea in f:
+                if linea.startswith(campo + ":"):
+                    return int(linea.split()[1])
+    except (OSError, ValueError, IndexError):
+        pass
+    return None
+
+
+def _descendientes(raiz):
+    """PIDs de todos los descendientes de raiz (recorriendo /proc/<pid>/stat)."""
+    hijos = defaultdict(list)
+    for nombre in os.listdir("/proc"):
+        if not nombre.isdigit():
+            continue
+        try:
+            with open(f"/proc/{nombre}/stat", "r") as f:
+                stat = f.read()
+            ppid = int(stat[stat.rindex(")") + 2:].split()[1])
+        except (OSError, ValueError, IndexError):
+            continue
+        hijos[ppid].append(int(nombre))
+    out, pendientes = [], [raiz]
+    while pendientes:
+        for pid in hijos.get(pendientes.pop(), ()):
+            out.append(pid)
+            pendientes.append(pid)
+    return out
+
+
+class _MuestreoRss:
+    """
+    Muestrea en un hilo el pico de memoria (VmHWM) de los procesos hijos
+    —tesseract de pytesseract y los workers del pool— leyendo /proc. Los
+    tesseract duran poco, así que se muestrea cada `intervalo` s; RUSAGE_CHILDREN
+    no sirve (solo cuenta hijos ya recogidos y nunca los workers vivos).
+    También guarda el pico de RSS sumado (proceso + hijos a la vez).
+    """
+
+    def __init__(self, intervalo=0.01):
+        self.intervalo = intervalo
+        self.hijos_kb = {}
+        self.total_kb = 0
+        self._fin = None
+        self._hilo = None
+
+    def _muestra(self):
+        total = _vm_kb(os.getpid(), "VmRSS") or 0
+        for pid in _descendientes(os.getpid()):
+            hwm = _vm_kb(pid, "VmHWM")
+            if hwm is None:
+                continue
+            self.hijos_kb[pid] = max(hwm, self.hijos_kb.get(pid, 0))
+            total += _vm_kb(pid, "VmRSS") or 0
+        self.total_kb = max(self.total_kb, total)
+
+    def _bucle(self):
+        while not self._fin.wait(self.intervalo):
+            self._muestra()
+
+    def __enter__(self):
+        if os.path.isdir("/proc"):
+            self._fin = threading.Event()
+            self._hilo = threading.Thread(target=self._bucle, name="bench-rss", daemon=True)
+            self._hilo.start()
+        return self
+
+    def __exit__(self, *exc):
+        if self._hilo is not None:
+            self._fin.set()
+            self._hilo.join()
+            self._muestra()
+
+    def informe(self):
+        try:
+            import resource
+        except ImportError:  # Windows
+            return None
+        div = 1024 * 1024 if sys.platform == "darwin" else 1024  # ru_maxrss en bytes (mac) o KB (linux)
+        propio = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / div
+        if self._hilo is None:  # sin /proc (mac): no hay medida de los hijos
+            return {"proceso_mb": round(propio, 1), "hijos_mb": None, "total_mb": None}
+        return {"proceso_mb": round(propio, 1),
+                "hijos_mb": round(max(self.hijos_kb.values(), default=0) / 1024, 1),
+                "total_mb": round(self.total_kb / 1024, 1)}
+
+
+_TERNA = re.compile(r"^(\d+) (\d+) ?x ?(\d+)$")
+
+
+def _lector_digitos(rng, n_filas):
+    """
+    Filas sueltas por el lector rápido (sin Tesseract): cuántas lee, cuántas
+    deja a Tesseract y cuántas lee MAL sin avisar (deben ser 0).
+    """
+    leidas = a_tesseract = erroneas = 0
+    for _ in range(n_filas):
+        img, terna = _fila_sintetica(rng)
+        texto, _ = leer_fila(img)
+        m = _TERNA.match(texto) if texto else None
+        if texto is None:
+            a_tesseract += 1
+        elif m and tuple(int(g) for g in m.groups()) == terna:
+            leidas += 1
+        else:
+            erroneas += 1
+    return {"filas": n_filas, "leidas": leidas, "a_tesseract": a_tesseract, "erroneas": erroneas}
+
+
+def _precision(esperadas, obtenidas):
+    esp = Counter(esperadas)
+    obt = Counter(obtenidas)
+    aciertos = sum((esp & obt).values())
+    return aciertos, sum(esp.values()), sum(obt.values())
+
+
+def ejecutar(n_imagenes=10, n_filas=12, semilla=1234, variantes=VARIANTES, repeticiones=1):
+    rng = random.Random(semilla)
+    casos = []
+    for v in variantes:
+        for _ in range(n_imagenes):
+            img, filas = generar_hoja(rng, n_filas=n_filas, variante=v)
+            casos.append((v, _jpeg(img), filas))
+
+    lat = defaultdict(list)
+    etapas = defaultdict(list)
+    llamadas = defaultdict(list)
+    exactitud = defaultdict(lambda: [0, 0, 0])
+    pdf_ms, xlsx_ms = [], []
+
+    with _MuestreoRss() as rss:
+        for _ in range(repeticiones):
+            for v, data, filas in casos:
+                deadline = Deadline(0)  # sin presupuesto: medimos el pipeline completo
+                t0 = time.perf_counter()
+                res = run_ocr_result(data, deadline=deadline)
+                total = (time.perf_counter() - t0) * 1000.0
+                lat[v].append(total)
+                lat["todas"].append(total)
+                meta = res.get("meta") or {}
+                for k, ms in (meta.get("tiempos_ms") or {}).items():
+                    etapas[k].append(ms)
+                llamadas[v].append(meta.get("tesseract_llamadas", 0))
+                llamadas["todas"].append(meta.get("tesseract_llamadas", 0))
+
+                obtenidas = [(p["cantidad"], p["largo"], p["ancho"]) for p in res["piezas"]]
+                a, e, o = _precision(filas, obtenidas)
+                for clave in (v, "todas"):
+                    exactitud[clave][0] += a
+                    exactitud[clave][1] += e
+                    exactitud[clave][2] += o
+
+                t1 = time.perf_counter()
+                generar_pdf_bytes(res["piezas"], material="bench", espesor="19", cliente="bench")
+                pdf_ms.append((time.perf_counter() - t1) * 1000.0)
+                t2 = time.perf_counter()
+                generar_xlsx_bytes(res["piezas"])
+                xlsx_ms.append((time.perf_counter() - t2) * 1000.0)
+
+    def _acc(clave):
+        a, e, o = exactitud[clave]
+        return {"recall": round(a / e, 4) if e else None, "precision": round(a / o, 4) if o else None}
+
+    informe = {
+        "entorno": {"python": platform.python_version(), "opencv": cv2.__version__,
+                    "cpus": os.cpu_count(), "pipeline": pipeline_params()},
+        "parametros": {"imagenes_por_variante": n_imagenes, "filas": n_filas, "semilla": semilla,
+                       "repeticiones": repeticiones},
+        "latencia_ms": {k: _percentiles(v) for k, v in lat.items()},
+        "etapas_ms": {k: _percentiles(v, (50, 95)) for k, v in sorted(etapas.items())},
+        "tesseract_llamadas": {k: round(float(np.mean(v)), 2) for k, v in llamadas.items()},
+        "exactitud": {k: _acc(k) for k in exactitud},
+        "pdf_ms": _percentiles(pdf_ms),
+        "xlsx_ms": _percentiles(xlsx_ms),
+        "pico_rss": rss.informe(),
+        "lector_digitos": _lector_digitos(random.Random(semilla), 50 * n_filas),
+    }
+    return informe
+
+
+# --------------------- Puerta de regresión ---------------------
+def comparar(informe, baseline, tolerancia=0.15):
+    """
+    Devuelve la lista de regresiones respecto a baseline (vacía = OK). Si el
+    pipeline (pipeline_params) no es el del baseline no se compara: la
+    comparación no tendría sentido y se devuelve ese único fallo.
+    """
+    pipeline = (informe.get("entorno") or {}).get("pipeline")
+    pipeline_base = (baseline.get("entorno") or {}).get("pipeline")
+    if pipeline != pipeline_base:
+        distintos = sorted(k for k in set(pipeline or {}) | set(pipeline_base or {})
+                           if (pipeline or {}).get(k) != (pipeline_base or {}).get(k))
+        return [f"pipeline distinto del baseline ({', '.join(distintos) or 'sin datos'}): "
+                f"regenerar el baseline con --guardar-baseline"]
+    fallos = []
+
+    def peor_si_mayor(nombre, actual, base, tol=tolerancia):
+        if actual is None or base in (None, 0):
+            return
+        if actual > base * (1 + tol):
+            fallos.append(f"{nombre}: {actual} > {base} (+{tol:.0%})")
+
+    for p in ("p50", "p90"):
+        peor_si_mayor(f"latencia todas {p}", informe["latencia_ms"]["todas"][p],
+                      baseline["latencia_ms"]["todas"][p])
+    peor_si_mayor("pdf p50", informe["pdf_ms"]["p50"], baseline["pdf_ms"]["p50"])
+    peor_si_mayor("tesseract llamadas", informe["tesseract_llamadas"]["todas"],
+                  baseline["tesseract_llamadas"]["todas"], tol=0.0)
+    rss, rss_base = informe.get("pico_rss") or {}, baseline.get("pico_rss") or {}
+    for k in ("proceso_mb", "hijos_mb", "total_mb"):
+        peor_si_mayor(f"pico rss {k}", rss.get(k), rss_base.get(k))
+    for k in ("recall", "precision"):
+        actual = informe["exactitud"]["todas"][k]
+        base = baseline["exactitud"]["todas"][k]
+        if actual is not None and base is not None and actual < base - 0.02:
+            fallos.append(f"exactitud {k}: {actual} < {base} (-0.02)")
+    erroneas = (informe.get("lector_digitos") or {}).get("erroneas")
+    if erroneas:
+        fallos.append(f"lector de dígitos: {erroneas} filas leídas mal sin pasar a Tesseract")
+    return fallos
+
+
+def _imprimir(informe):
+    print("== Latencia total (ms) ==")
+    for k, v in informe["latencia_ms"].items():
+        print(f"  {k:10s} p50={v['p50']}  p90={v['p90']}  p99={v['p99']}")
+    print("== Etapas (ms) ==")
+    for k, v in informe["etapas_ms"].items():
+        print(f"  {k:16s} p50={v['p50']}  p95={v['p95']}")
+    print("== Llamadas a Tesseract por imagen ==")
+    for k, v in informe["tesseract_llamadas"].items():
+        print(f"  {k:10s} {v}")
+    print("== Exactitud ==")
+    for k, v in informe["exactitud"].items():
+        print(f"  {k:10s} recall={v['recall']}  precision={v['precision']}")
+    print(f"== PDF (ms) {informe['pdf_ms']}  XLSX (ms) {informe['xlsx_ms']}")
+    print(f"== Pico RSS {informe['pico_rss']}")
+    print(f"== Lector de dígitos {informe['lector_digitos']}")
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="Benchmark OCR Carpinter-IA con hojas sintéticas")
+    ap.add_argument("--imagenes", type=int, default=10, help="imágenes por variante")
+    ap.add_argument("--filas", type=int, default=12, help="filas por imagen")
+    ap.add_argument("--semilla", type=int, default=1234)
+    ap.add_argument("--repeticiones", type=int, default=1)
+    ap.add_argument("--variantes", default=",".join(VARIANTES))
+    ap.add_argument("--json", help="guardar el informe en este fichero")
+    ap.add_argument("--baseline", help="comparar con este baseline y fallar si hay regresión")
+    ap.add_argument("--tolerancia", type=float, default=0.15)
+    ap.add_argument("--guardar-baseline", nargs="?", const=BASELINE_DEFAULT,
+                    help=f"guardar el informe como baseline (por defecto {BASELINE_DEFAULT})")
+    args = ap.parse_args(argv)
+
+    variantes = tuple(v for v in args.variantes.split(",") if v)
+    informe = ejecutar(args.imagenes, args.filas, args.semilla, variantes, args.repeticiones)
+    _imprimir(informe)
+
+    if args.json:
+        with open(args.json, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+    if args.guardar_baseline:
+        with open(args.guardar_baseline, "w", encoding="utf-8") as f:
+            json.dump(informe, f, ensure_ascii=False, indent=2)
+        print(f"Baseline guardado en {args.guardar_baseline}")
+    if args.baseline:
+        with open(args.baseline, "r", encoding="utf-8") as f:
+            baseline = json.load(f)
+        fallos = comparar(informe, baseline, args.tolerancia)
+        if fallos:
+            print("REGRESIÓN:")
+            for f_ in fallos:
+                print(f"  - {f_}")
+            return 1
+        print("Sin regresiones respecto al baseline.")
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
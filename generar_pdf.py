@@ -6,26 +6,70 @@ de la lista de piezas + metadatos.
 
 Incluye múltiples nombres compatibles para que app.py o cualquier otro fichero
 pueda importar la función que espere (crear_pdf_desde_piezas, generar_pdf_bytes, etc).
+
+Listas grandes (más de EXPORT_CHUNK_THRESHOLD piezas): la tabla se parte en
+trozos de una página con altura de fila fija, de modo que ReportLab la
+maqueta página a página sin medir ni partir una tabla gigante. El XLSX se
+escribe siempre con openpyxl en modo write_only. generar_stream escribe el
+documento en un SpooledTemporaryFile y lo devuelve en trozos para enviarlo
+al cliente sin otra copia en memoria.
+
+Exportación multi-formato (exportar): las piezas se normalizan una sola vez
+y los formatos pedidos (pdf, xlsx, json) se generan a la vez en hilos.
+huella_export da un ETag estable del contenido (piezas + metadatos, sin la
+fecha del PDF) para servir descargas repetidas con 304 / desde caché.
 """
 
 from reportlab.lib.pagesizes import A4, landscape
 from reportlab.lib import colors
 from reportlab.lib.units import mm
-from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer
+from reportlab.platypus import SimpleDocTemplate, Table, TableStyle, Paragraph, Spacer, PageBreak
 from reportlab.lib.styles import getSampleStyleSheet
 import io
+import os
+import json
+import hashlib
 import datetime
 import base64
+import tempfile
+from concurrent.futures import ThreadPoolExecutor
 
 # XLSX
 from openpyxl import Workbook
 from openpyxl.utils import get_column_letter
 
+# Estilos compartidos (se construyen una vez por proceso)
+STYLES = getSampleStyleSheet()
+TABLE_STYLE = TableStyle([
+    ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#e8e8e8")),
+    ('GRID', (0,0), (-1,-1), 0.5, colors.black),
+    ('ALIGN', (0,0), (-1,-1), 'CENTER'),
+    ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
+    ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
+    ('LEFTPADDING', (0,0), (-1,-1), 4),
+    ('RIGHTPADDING', (0,0), (-1,-1), 4),
+])
+
+# Modo gran volumen
+EXPORT_CHUNK_THRESHOLD = int(os.environ.get("EXPORT_CHUNK_THRESHOLD", 300))
+EXPORT_SPOOL_MB = float(os.environ.get("EXPORT_SPOOL_MB", 8))  # más grande -> a disco
+EXPORT_STREAM_CHUNK = 64 * 1024
+ROW_HEIGHT = 6*mm
+ROWS_FIRST_PAGE = 20   # debajo de título y metadatos
+ROWS_PER_PAGE = 28     # A4 apaisado con márgenes de 12 mm: 29 filas de 6 mm caben en 186 mm
+
+class _Normalizadas(list):
+    """Lista ya pasada por _normalize_piezas (no se vuelve a normalizar)."""
+
+
 def _normalize_piezas(piezas):
     """
     Asegura que piezas es lista de dicts con keys (cantidad,largo,ancho,ocr_texto)
+    (+ "pagina" si la pieza viene de un lote de varias imágenes)
     """
-    out = []
+    if isinstance(piezas, _Normalizadas):
+        return piezas
+    out = _Normalizadas()
     if not piezas:
         return out
     for p in piezas:
@@ -42,20 +86,40 @@ def _normalize_piezas(piezas):
         except Exception:
             ancho = 0
         ocr_texto = p.get("ocr_texto", f"{cant} {largo}x{ancho}")
-        out.append({"cantidad": cant, "largo": largo, "ancho": ancho, "ocr_texto": ocr_texto})
+        pieza = {"cantidad": cant, "largo": largo, "ancho": ancho, "ocr_texto": ocr_texto}
+        if p.get("pagina") is not None:
+            pieza["pagina"] = p.get("pagina")
+        out.append(pieza)
     return out
 
-def generar_pdf_bytes(piezas, meta=None, material=None, espesor=None, cliente=None):
+def _con_pagina(piezas):
+    return any("pagina" in p for p in piezas)
+
+def _tablas_por_pagina(data, col_widths):
+    """Una tabla (con cabecera) por página y altura de fila fija: maquetación incremental."""
+    cabecera, filas = data[0], data[1:]
+    elems, ini, n = [], 0, ROWS_FIRST_PAGE
+    while ini < len(filas):
+        trozo = [cabecera] + filas[ini:ini + n]
+        table = Table(trozo, colWidths=col_widths, rowHeights=[ROW_HEIGHT] * len(trozo))
+        table.setStyle(TABLE_STYLE)
+        if elems:
+            elems.append(PageBreak())
+        elems.append(table)
+        ini += n
+        n = ROWS_PER_PAGE
+    return elems
+
+def escribir_pdf(fileobj, piezas, meta=None, material=None, espesor=None, cliente=None):
     """
-    Devuelve bytes con el PDF creado.
+    Escribe el PDF en fileobj (BytesIO, fichero, SpooledTemporaryFile...).
     Simple: cabecera con metadatos + tabla con piezas.
     """
     piezas = _normalize_piezas(piezas or [])
-    buf = io.BytesIO()
     # documento apaisado (mejor para tablas largas)
-    doc = SimpleDocTemplate(buf, pagesize=landscape(A4), leftMargin=12*mm, rightMargin=12*mm, topMargin=12*mm, bottomMargin=12*mm)
+    doc = SimpleDocTemplate(fileobj, pagesize=landscape(A4), leftMargin=12*mm, rightMargin=12*mm, topMargin=12*mm, bottomMargin=12*mm)
 
-    styles = getSampleStyleSheet()
+    styles = STYLES
     elems = []
 
     # Cabecera
@@ -79,32 +143,41 @@ def generar_pdf_bytes(piezas, meta=None, material=None, espesor=None, cliente=No
         elems.append(Paragraph(ln, styles["Normal"]))
     elems.append(Spacer(1, 6*mm))
 
-    # Tabla de piezas
+    # Tabla de piezas (con columna de página si vienen de un lote)
+    paginas = _con_pagina(piezas)
     data = [["#", "Cantidad", "Largo (mm)", "Ancho (mm)", "OCR texto"]]
+    if paginas:
+        data[0].insert(1, "Pág.")
     for i, p in enumerate(piezas, 1):
-        data.append([str(i), str(p["cantidad"]), str(p["largo"]), str(p["ancho"]), p.get("ocr_texto", "")])
+        fila = [str(i), str(p["cantidad"]), str(p["largo"]), str(p["ancho"]), p.get("ocr_texto", "")]
+        if paginas:
+            fila.insert(1, str(p.get("pagina", "")))
+        data.append(fila)
 
     if len(data) == 1:
         elems.append(Paragraph("No se detectaron piezas.", styles["Normal"]))
     else:
         col_widths = [20*mm, 30*mm, 35*mm, 35*mm, 130*mm]
-        table = Table(data, colWidths=col_widths, repeatRows=1)
-        tblstyle = TableStyle([
-            ('BACKGROUND', (0,0), (-1,0), colors.HexColor("#e8e8e8")),
-            ('GRID', (0,0), (-1,-1), 0.5, colors.black),
-            ('ALIGN', (0,0), (-1,-1), 'CENTER'),
-            ('VALIGN', (0,0), (-1,-1), 'MIDDLE'),
-            ('FONTNAME', (0,0), (-1,0), 'Helvetica-Bold'),
-            ('LEFTPADDING', (0,0), (-1,-1), 4),
-            ('RIGHTPADDING', (0,0), (-1,-1), 4),
-        ])
-        table.setStyle(tblstyle)
-        elems.append(table)
+        if paginas:
+            col_widths = [20*mm, 18*mm, 30*mm, 35*mm, 35*mm, 112*mm]
+        if len(piezas) > EXPORT_CHUNK_THRESHOLD:
+            elems.extend(_tablas_por_pagina(data, col_widths))
+        else:
+            table = Table(data, colWidths=col_widths, repeatRows=1)
+            table.setStyle(TABLE_STYLE)
+            elems.append(table)
 
     elems.append(Spacer(1,6*mm))
     elems.append(Paragraph("Generado por Carpinter-IA", styles["Italic"]))
 
     doc.build(elems)
+
+def generar_pdf_bytes(piezas, meta=None, material=None, espesor=None, cliente=None):
+    """
+    Devuelve bytes con el PDF creado.
+    """
+    buf = io.BytesIO()
+    escribir_pdf(buf, piezas, meta=meta, material=material, espesor=espesor, cliente=cliente)
     pdf = buf.getvalue()
     buf.close()
     return pdf
@@ -130,24 +203,112 @@ def exportar_pdf_maestro_bytes(*args, **kwargs):
     return generar_pdf_bytes(*args, **kwargs)
 
 # --- XLSX generator (opcional) ---
-def generar_xlsx_bytes(piezas, meta=None, material=None, espesor=None, cliente=None):
+def escribir_xlsx(fileobj, piezas, meta=None, material=None, espesor=None, cliente=None):
+    """
+    Escribe el XLSX en fileobj. Modo write_only: las filas se vuelcan al
+    fichero según se añaden, sin guardar un objeto por celda.
+    """
     piezas = _normalize_piezas(piezas or [])
-    wb = Workbook()
-    ws = wb.active
-    ws.title = "Despiece"
+    wb = Workbook(write_only=True)
+    ws = wb.create_sheet("Despiece")
+    paginas = _con_pagina(piezas)
     headers = ["#", "Cantidad", "Largo (mm)", "Ancho (mm)", "OCR texto"]
+    if paginas:
+        headers.insert(1, "Página")
+    # ajustar anchos basicos (en write_only, antes de escribir filas)
+    for i, h in enumerate(headers, 1):
+        ws.column_dimensions[get_column_letter(i)].width = 18 if i < len(headers) else 40
     ws.append(headers)
     for i, p in enumerate(piezas, 1):
-        ws.append([i, p["cantidad"], p["largo"], p["ancho"], p.get("ocr_texto","")])
-    # ajustar anchos basicos
-    for i, h in enumerate(headers, 1):
-        ws.column_dimensions[get_column_letter(i)].width = 18 if i < 5 else 40
+        fila = [i, p["cantidad"], p["largo"], p["ancho"], p.get("ocr_texto","")]
+        if paginas:
+            fila.insert(1, p.get("pagina"))
+        ws.append(fila)
+    wb.save(fileobj)
+
+def generar_xlsx_bytes(piezas, meta=None, material=None, espesor=None, cliente=None):
     bio = io.BytesIO()
-    wb.save(bio)
+    escribir_xlsx(bio, piezas, meta=meta, material=material, espesor=espesor, cliente=cliente)
     data = bio.getvalue()
     bio.close()
     return data
 
+# --- Streaming (respuestas HTTP por trozos) ---
+def generar_spool(formato, piezas, **meta):
+    """
+    Escribe el PDF/XLSX en un SpooledTemporaryFile (memoria hasta EXPORT_SPOOL_MB,
+    luego disco) y lo deja al principio. Devuelve (fichero, tamaño en bytes).
+    """
+    spool = tempfile.SpooledTemporaryFile(max_size=int(EXPORT_SPOOL_MB * 1024 * 1024))
+    try:
+        (escribir_xlsx if formato == "xlsx" else escribir_pdf)(spool, piezas, **meta)
+        size = spool.tell()
+        spool.seek(0)
+    except Exception:
+        spool.close()
+        raise
+    return spool, size
+
+def iter_spool(spool, chunk_size=EXPORT_STREAM_CHUNK):
+    """Lee el fichero en trozos y lo cierra al terminar (o si el cliente corta)."""
+    try:
+        while True:
+            trozo = spool.read(chunk_size)
+            if not trozo:
+                break
+            yield trozo
+    finally:
+        spool.close()
+
+def generar_stream(formato, piezas, chunk_size=EXPORT_STREAM_CHUNK, **meta):
+    """Iterador de bytes del PDF/XLSX (formato "pdf" o "xlsx")."""
+    spool, _ = generar_spool(formato, piezas, **meta)
+    return iter_spool(spool, chunk_size)
+
+# --- Exportación multi-formato (normalizar una vez, generar en paralelo) ---
+EXPORT_VERSION = "1"  # subir si cambia el contenido de los documentos (invalida los ETag)
+# Hilos de exportar(); ReportLab/openpyxl son Python puro (GIL): solo compensa con varios núcleos
+EXPORT_PARALLELISM = max(1, int(os.environ.get("EXPORT_PARALLELISM", min(3, os.cpu_count() or 1))))
+
+def escribir_json(fileobj, piezas, meta=None, material=None, espesor=None, cliente=None):
+    """Despiece en JSON (piezas normalizadas + material/espesor/cliente) en UTF-8."""
+    piezas = _normalize_piezas(piezas or [])
+    doc = {"piezas": piezas, "meta": {"material": material, "espesor": espesor, "cliente": cliente}}
+    fileobj.write(json.dumps(doc, ensure_ascii=False).encode("utf-8"))
+
+_ESCRITORES = {"pdf": escribir_pdf, "xlsx": escribir_xlsx, "json": escribir_json}
+
+def huella_export(piezas, meta=None, material=None, espesor=None, cliente=None):
+    """
+    Huella del contenido exportado (hex): misma huella -> mismos documentos.
+    No depende de la fecha de generación ni del formato.
+    """
+    piezas = _normalize_piezas(piezas or [])
+    imagen = meta.get("image_path") if isinstance(meta, dict) else None
+    clave = json.dumps([EXPORT_VERSION, piezas, material, espesor, cliente, imagen],
+                       ensure_ascii=False, sort_keys=True, separators=(",", ":"))
+    return hashlib.sha256(clave.encode("utf-8")).hexdigest()[:32]
+
+def _exportar_uno(formato, piezas, meta):
+    buf = io.BytesIO()
+    _ESCRITORES[formato](buf, piezas, **meta)
+    return buf.getvalue()
+
+def exportar(piezas, formatos=("pdf", "xlsx", "json"), **meta):
+    """
+    Genera varios formatos del mismo despiece: normaliza las piezas una vez y
+    construye los documentos a la vez (hasta EXPORT_PARALLELISM hilos).
+    Devuelve {formato: bytes}.
+    """
+    formatos = [f for f in dict.fromkeys(formatos) if f in _ESCRITORES]
+    piezas = _normalize_piezas(piezas or [])
+    hilos = min(EXPORT_PARALLELISM, len(formatos))
+    if hilos <= 1:
+        return {f: _exportar_uno(f, piezas, meta) for f in formatos}
+    with ThreadPoolExecutor(max_workers=hilos, thread_name_prefix="export") as ex:
+        futuros = {f: ex.submit(_exportar_uno, f, piezas, meta) for f in formatos}
+        return {f: fut.result() for f, fut in futuros.items()}
+
 def generate_xlsx_bytes(*a, **k):
     return generar_xlsx_bytes(*a, **k)
 
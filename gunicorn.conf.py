@@ -0,0 +1,36 @@
+# -*- coding: utf-8 -*-
+"""
+gunicorn.conf.py
+Configuración de gunicorn para Carpinter-IA (Render / Docker).
+
+- preload_app: el master importa app.py y los módulos pesados (cv2, numpy,
+  pytesseract, ReportLab) una vez; los workers los heredan tras fork.
+- En el master solo se importan módulos: nada de hilos, pools de Tesseract
+  ni conexiones SQLite (se crean de forma perezosa en cada worker).
+- post_fork: cada worker lanza su calentamiento (OCR y PDF diminutos);
+  GET /ready responde 200 cuando termina.
+
+Variables de entorno:
+- PORT              puerto (por defecto 5000)
+- WEB_CONCURRENCY   nº de workers (lo lee gunicorn; por defecto 1)
+- GUNICORN_PRELOAD  "1" (por defecto) o "0"
+- GUNICORN_TIMEOUT  timeout del worker en s (por defecto 120)
+- OCR_WARMUP        ver ocr_warmup.py
+"""
+
+import os
+
+bind = f"0.0.0.0:{os.environ.get('PORT', 5000)}"
+preload_app = os.environ.get("GUNICORN_PRELOAD", "1") == "1"
+timeout = int(os.environ.get("GUNICORN_TIMEOUT", 120))
+
+
+def on_starting(server):
+    if preload_app:
+        import ocr_warmup
+        server.log.info(f"Módulos OCR/PDF precargados en {ocr_warmup.precargar_modulos()} ms")
+
+
+def post_fork(server, worker):
+    import ocr_warmup
+    ocr_warmup.iniciar()
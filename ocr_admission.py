@@ -0,0 +1,128 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_admission.py
+Control de admisión de trabajo OCR para Carpinter-IA.
+
+Limita cuántos OCR se ejecutan a la vez en TODO el contenedor (todos los
+workers/hilos de gunicorn), usando N ficheros-ranura con flock en un directorio
+compartido. Cuando no hay ranura libre tras una espera corta, la petición se
+rechaza (app.py responde 429 + Retry-After) en lugar de dejar crecer la cola.
+Sin fcntl (Windows local) se usa un semáforo por proceso.
+
+Variables de entorno:
+- OCR_MAX_CONCURRENT          ranuras OCR simultáneas (por defecto 4)
+- OCR_ADMISSION_WAIT          segundos que una petición espera ranura (por defecto 2)
+- OCR_ADMISSION_RETRY_AFTER   valor de Retry-After al rechazar (por defecto 5)
+- OCR_ADMISSION_DIR           directorio de las ranuras
+"""
+
+import os
+import time
+import logging
+import tempfile
+import threading
+from contextlib import contextmanager
+
+try:
+    import fcntl
+except ImportError:  # Windows
+    fcntl = None
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_MAX_CONCURRENT = int(os.environ.get("OCR_MAX_CONCURRENT", 4))
+OCR_ADMISSION_WAIT = float(os.environ.get("OCR_ADMISSION_WAIT", 2))
+OCR_ADMISSION_RETRY_AFTER = int(os.environ.get("OCR_ADMISSION_RETRY_AFTER", 5))
+OCR_ADMISSION_DIR = os.environ.get("OCR_ADMISSION_DIR", os.path.join(tempfile.gettempdir(), "carpinter_ocr_slots"))
+
+_POLL = 0.05
+
+
+class Saturated(Exception):
+    """No hay ranura OCR libre; reintentar tras retry_after segundos."""
+
+    def __init__(self, retry_after=OCR_ADMISSION_RETRY_AFTER):
+        super().__init__("Servidor OCR saturado")
+        self.retry_after = retry_after
+
+
+class AdmissionLimiter:
+    def __init__(self, slots=OCR_MAX_CONCURRENT, slot_dir=OCR_ADMISSION_DIR):
+        self.slots = max(1, int(slots))
+        self.slot_dir = slot_dir
+        self._sem = None
+        self.rechazadas = 0
+        self.admitidas = 0
+        if fcntl is not None:
+            try:
+                os.makedirs(self.slot_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Admisión OCR sin ranuras compartidas ({e}); límite por proceso")
+                self.slot_dir = None
+        if fcntl is None or self.slot_dir is None:
+            self._sem = threading.BoundedSemaphore(self.slots)
+
+    def _try_slot(self):
+        for i in range(self.slots):
+            fd = os.open(os.path.join(self.slot_dir, f"slot_{i}.lock"), os.O_RDWR | os.O_CREAT, 0o666)
+            try:
+                fcntl.flock(fd, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                return fd
+            except OSError:
+                os.close(fd)
+        return None
+
+    def acquire(self, wait=OCR_ADMISSION_WAIT):
+        """
+        Ocupa una ranura esperando como mucho `wait` s (None = sin límite).
+        Devuelve un token para release() o lanza Saturated.
+        """
+        limite = None if wait is None else time.monotonic() + wait
+        while True:
+            if self._sem is not None:
+                if self._sem.acquire(timeout=_POLL):
+                    self.admitidas += 1
+                    return "sem"
+            else:
+                fd = self._try_slot()
+                if fd is not None:
+                    self.admitidas += 1
+                    return fd
+                time.sleep(_POLL)
+            if limite is not None and time.monotonic() >= limite:
+                self.rechazadas += 1
+                raise Saturated()
+
+    def release(self, token):
+        if token == "sem":
+            self._sem.release()
+            return
+        try:
+            fcntl.flock(token, fcntl.LOCK_UN)
+        finally:
+            os.close(token)
+
+    @contextmanager
+    def slot(self, wait=OCR_ADMISSION_WAIT):
+        token = self.acquire(wait=wait)
+        try:
+            yield
+        finally:
+            self.release(token)
+
+    def stats(self):
+        return {"slots": self.slots, "admitidas": self.admitidas, "rechazadas": self.rechazadas,
+                "compartido": self._sem is None}
+
+
+_LIMITER = None
+_LIMITER_LOCK = threading.Lock()
+
+
+def get_limiter():
+    global _LIMITER
+    if _LIMITER is None:
+        with _LIMITER_LOCK:
+            if _LIMITER is None:
+                _LIMITER = AdmissionLimiter()
+    return _LIMITER
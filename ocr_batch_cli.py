@@ -0,0 +1,336 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_batch_cli.py
+OCR por lotes, offline y reanudable, de directorios de despieces escaneados.
+
+Recorre directorios (recursivo), globs o ficheros sueltos y reparte las
+imágenes entre procesos (ProcessPoolExecutor). Cada resultado se añade como
+una línea JSON al fichero de salida (JSONL) en cuanto termina.
+
+Reanudación: la salida es también el punto de control. Cada línea lleva la
+clave de contenido (sha256 de los bytes + pipeline_params, la misma de
+ocr_cache), así que al relanzar se saltan las imágenes ya procesadas con los
+mismos parámetros, aunque se hayan movido o renombrado, y se reprocesan si
+cambia el pipeline. Las líneas con error o parciales (presupuesto agotado)
+no cuentan como hechas: se reintentan. Un fichero duplicado dentro del lote
+se procesa una vez.
+
+Uso:
+    python ocr_batch_cli.py escaneos/ -o despieces.jsonl
+    python ocr_batch_cli.py "archivo/2024/**/*.jpg" -o 2024.jsonl --procesos 4
+    python ocr_batch_cli.py escaneos/ -o out.jsonl --pdf --xlsx --docs-dir docs/
+    python ocr_batch_cli.py escaneos/ -o out.jsonl --reprocesar   # ignora el punto de control
+    python ocr_batch_cli.py escaneos/ -o out.jsonl --agregado proyecto.json --tolerancia 2
+
+--agregado fusiona las piezas iguales de todas las imágenes de la salida
+(también las de ejecuciones anteriores) con agregacion_piezas, leyendo el
+JSONL línea a línea.
+
+Cada proceso usa OCR_PARALLELISM=1 y OCR_POOL_SIZE=1 salvo que se indique otra
+cosa en el entorno: el paralelismo lo da el número de procesos.
+"""
+
+import os
+import sys
+import json
+import glob
+import time
+import hashlib
+import logging
+import argparse
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+
+EXTENSIONES = (".jpg", ".jpeg", ".png", ".tif", ".tiff", ".bmp", ".webp")
+SALIDA_DEFAULT = "ocr_batch.jsonl"
+
+
+# --------------------- Entradas ---------------------
+def listar_imagenes(entradas, extensiones=EXTENSIONES):
+    """Directorios (recursivo), globs o ficheros -> rutas ordenadas y sin repetir."""
+    rutas, vistas = [], set()
+
+    def _add(ruta):
+        real = os.path.realpath(ruta)
+        if real not in vistas and os.path.isfile(ruta) and ruta.lower().endswith(extensiones):
+            vistas.add(real)
+            rutas.append(ruta)
+
+    for entrada in entradas:
+        if os.path.isdir(entrada):
+            for raiz, dirs, ficheros in os.walk(entrada):
+                dirs.sort()
+                for f in sorted(ficheros):
+                    _add(os.path.join(raiz, f))
+        elif os.path.isfile(entrada):
+            _add(entrada)
+        else:
+            for ruta in sorted(glob.glob(entrada, recursive=True)):
+                _add(ruta)
+    return rutas
+
+
+def _hash_fichero(ruta, params_json):
+    """Igual que ocr_cache.cache_key(data, **params) sin cargar el fichero entero."""
+    h = hashlib.sha256()
+    with open(ruta, "rb") as f:
+        for trozo in iter(lambda: f.read(1 << 20), b""):
+            h.update(trozo)
+    h.update(params_json)
+    return h.hexdigest()
+
+
+# --------------------- Punto de control ---------------------
+def leer_checkpoint(salida):
+    """Claves ya procesadas en el JSONL (se ignoran líneas cortadas, con error o parciales)."""
+    hechas = set()
+    if not os.path.exists(salida):
+        return hechas
+    with open(salida, "r", encoding="utf-8") as f:
+        for linea in f:
+            try:
+                reg = json.loads(linea)
+            except ValueError:
+                continue
+            if reg.get("clave") and not reg.get("error") and not reg.get("parcial"):
+                hechas.add(reg["clave"])
+    return hechas
+
+
+def _abrir_salida(salida):
+    """Abre en modo append; si la última línea quedó cortada (corte a mitad), la cierra."""
+    if os.path.dirname(salida):
+        os.makedirs(os.path.dirname(salida), exist_ok=True)
+    f = open(salida, "a+b")
+    if f.tell() > 0:
+        f.seek(-1, os.SEEK_END)
+        if f.read(1) != b"\n":
+            f.write(b"\n")
+    return f
+
+
+# --------------------- Worker ---------------------
+def _init_worker(nivel_log):
+    import cv2
+    cv2.setNumThreads(1)
+    logging.getLogger("carpinter_ocr").setLevel(nivel_log)
+
+
+def _nombre_doc(ruta, clave, ext):
+    base = os.path.splitext(os.path.basename(ruta))[0]
+    return f"{base}_{clave[:8]}.{ext}"
+
+
+def procesar(ruta, clave, lang="eng+spa", presupuesto=0, docs_dir=None, formatos=()):
+    """OCR de una imagen (en el proceso worker). Devuelve el registro JSONL."""
+    from ocr_rayas_tesseract import run_ocr_result, Deadline
+    reg = {"archivo": ruta, "clave": clave}
+    t0 = time.perf_counter()
+    try:
+        with open(ruta, "rb") as f:
+            data = f.read()
+        res = run_ocr_result(data, lang=lang, deadline=Deadline(presupuesto))
+        if not res.get("image_width"):
+            raise ValueError("imagen ilegible")
+        reg.update(res)
+        reg["meta"] = dict(res.get("meta") or {}, image_path=ruta)
+        if formatos:
+            from generar_pdf import generar_pdf_bytes, generar_xlsx_bytes
+            reg["documentos"] = []
+            for ext in formatos:
+                destino = os.path.join(docs_dir, _nombre_doc(ruta, clave, ext))
+                contenido = (generar_xlsx_bytes if ext == "xlsx" else generar_pdf_bytes)(res["piezas"])
+                with open(destino, "wb") as f:
+                    f.write(contenido)
+                reg["documentos"].append(destino)
+        reg["error"] = None
+    except Exception as e:
+        reg["error"] = f"{type(e).__name__}: {e}"
+    reg["ms"] = round((time.perf_counter() - t0) * 1000.0, 1)
+    return reg
+
+
+# --------------------- Resumen ---------------------
+def _percentil(valores, p):
+    if not valores:
+        return None
+    v = sorted(valores)
+    return round(v[min(len(v) - 1, int(round(p / 100.0 * (len(v) - 1))))], 1)
+
+
+def resumen(c, lat_ms, duracion):
+    procesadas = c["ok"] + c["errores"]
+    return {
+        "encontradas": c["encontradas"], "procesadas": procesadas, "errores": c["errores"],
+        "saltadas_checkpoint": c["saltadas"], "duplicadas": c["duplicadas"],
+        "piezas": c["piezas"], "parciales": c["parciales"],
+        "segundos": round(duracion, 2),
+        "imagenes_por_s": round(procesadas / duracion, 2) if duracion > 0 else None,
+        "latencia_ms": {"p50": _percentil(lat_ms, 50), "p90": _percentil(lat_ms, 90),
+                        "p99": _percentil(lat_ms, 99)},
+        "tesseract_llamadas_media": round(c["llamadas"] / c["ok"], 2) if c["ok"] else None,
+    }
+
+
+# --------------------- Agregado del proyecto ---------------------
+def agregar_salida(salida, tolerancia=None, material=None):
+    """
+    Agregado de las piezas de todas las imágenes correctas del JSONL (una vez
+    por clave; la página de cada pieza es su archivo), leído en streaming.
+    De una imagen parcial cuenta su reintento completo si lo hay; si no, la
+    última lectura parcial (se añade al final).
+    """
+    from agregacion_piezas import Agregado
+    agregado, vistas, parciales = Agregado(tolerancia), set(), {}
+    with open(salida, "r", encoding="utf-8") as f:
+        for linea in f:
+            try:
+                reg = json.loads(linea)
+            except ValueError:
+                continue
+            if reg.get("error") or not reg.get("clave") or reg["clave"] in vistas:
+                continue
+            if reg.get("parcial"):
+                parciales[reg["clave"]] = reg
+                continue
+            vistas.add(reg["clave"])
+            parciales.pop(reg["clave"], None)
+            agregado.agregar(reg.get("piezas"), material=material, pagina=reg.get("archivo"))
+    for reg in parciales.values():
+        agregado.agregar(reg.get("piezas"), material=material, pagina=reg.get("archivo"))
+    return agregado
+
+
+# --------------------- Ejecución ---------------------
+def ejecutar(rutas, salida, procesos, lang="eng+spa", presupuesto=0, formatos=(), docs_dir=None,
+             reprocesar=False, nivel_log=logging.WARNING, progreso=True):
+    from ocr_rayas_tesseract import pipeline_params
+    params_json = json.dumps(pipeline_params(lang), sort_keys=True, default=str).encode("utf-8")
+    hechas = set() if reprocesar else leer_checkpoint(salida)
+    if formatos:
+        docs_dir = docs_dir or os.path.dirname(os.path.abspath(salida))
+        os.makedirs(docs_dir, exist_ok=True)
+
+    c = dict.fromkeys(("encontradas", "ok", "errores", "saltadas", "duplicadas",
+                       "piezas", "parciales", "llamadas"), 0)
+    c["encontradas"] = len(rutas)
+    lat_ms, en_curso, enviadas = [], {}, set()
+    t0 = time.perf_counter()
+    out = _abrir_salida(salida)
+
+    def _recoger(terminadas):
+        for fut in terminadas:
+            ruta, clave = en_curso.pop(fut)
+            try:
+                reg = fut.result()
+            except Exception as e:  # worker caído (BrokenProcessPool...): se reintenta al reanudar
+                reg = {"archivo": ruta, "clave": clave, "error": f"{type(e).__name__}: {e}"}
+            out.write((json.dumps(reg, ensure_ascii=False) + "\n").encode("utf-8"))
+            out.flush()
+            if reg["error"]:
+                c["errores"] += 1
+                print(f"[error] {ruta}: {reg['error']}", file=sys.stderr)
+                continue
+            c["ok"] += 1
+            c["piezas"] += len(reg["piezas"])
+            c["parciales"] += bool(reg.get("parcial"))
+            c["llamadas"] += int(reg["meta"].get("tesseract_llamadas") or 0)
+            lat_ms.append(reg["ms"])
+            if progreso:
+                hechas_ahora = c["ok"] + c["errores"]
+                print(f"[{hechas_ahora}] {ruta}: {len(reg['piezas'])} piezas, {reg['ms']:.0f} ms",
+                      file=sys.stderr)
+
+    ex = ProcessPoolExecutor(max_workers=procesos, initializer=_init_worker, initargs=(nivel_log,))
+    try:
+        for ruta in rutas:
+            try:
+                clave = _hash_fichero(ruta, params_json)
+            except OSError as e:
+                c["errores"] += 1
+                print(f"[error] {ruta}: {e}", file=sys.stderr)
+                continue
+            if clave in hechas:
+                c["saltadas"] += 1
+                continue
+            if clave in enviadas:
+                c["duplicadas"] += 1
+                continue
+            enviadas.add(clave)
+            # como mucho 2 tareas por proceso en vuelo: el hash va por delante sin acumular
+            while len(en_curso) >= 2 * procesos:
+                terminadas, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+                _recoger(terminadas)
+            fut = ex.submit(procesar, ruta, clave, lang, presupuesto, docs_dir, tuple(formatos))
+            en_curso[fut] = (ruta, clave)
+        while en_curso:
+            terminadas, _ = wait(en_curso, return_when=FIRST_COMPLETED)
+            _recoger(terminadas)
+    except KeyboardInterrupt:
+        print("Interrumpido: se puede reanudar con la misma orden.", file=sys.stderr)
+        ex.shutdown(wait=False, cancel_futures=True)
+        raise
+    finally:
+        out.close()
+        ex.shutdown(wait=True)
+    return resumen(c, lat_ms, time.perf_counter() - t0)
+
+
+def main(argv=None):
+    ap = argparse.ArgumentParser(description="OCR por lotes (reanudable) de despieces Carpinter-IA")
+    ap.add_argument("entradas", nargs="+", help="directorios, globs o ficheros de imagen")
+    ap.add_argument("-o", "--salida", default=SALIDA_DEFAULT, help=f"JSONL de resultados (por defecto {SALIDA_DEFAULT})")
+    ap.add_argument("--procesos", type=int, default=os.cpu_count() or 1)
+    ap.add_argument("--lang", default="eng+spa")
+    ap.add_argument("--presupuesto", type=float, default=0, help="segundos por imagen (0 = sin límite)")
+    ap.add_argument("--pdf", action="store_true", help="escribir un PDF por imagen")
+    ap.add_argument("--xlsx", action="store_true", help="escribir un XLSX por imagen")
+    ap.add_argument("--docs-dir", help="directorio de PDF/XLSX (por defecto junto a la salida)")
+    ap.add_argument("--extensiones", default=",".join(EXTENSIONES))
+    ap.add_argument("--reprocesar", action="store_true", help="ignorar el punto de control")
+    ap.add_argument("--resumen-json", help="guardar el resumen en este fichero")
+    ap.add_argument("--agregado", help="guardar aquí (JSON) las piezas fusionadas de todas las imágenes")
+    ap.add_argument("--tolerancia", type=int, help="mm de tolerancia al fusionar (por defecto AGREGACION_TOLERANCIA_MM)")
+    ap.add_argument("--material", help="material de las piezas agregadas")
+    ap.add_argument("-q", "--silencioso", action="store_true", help="sin progreso por imagen")
+    ap.add_argument("-v", "--verbose", action="store_true", help="log del pipeline OCR")
+    args = ap.parse_args(argv)
+
+    # antes de importar ocr_rayas_tesseract (aquí y en los workers)
+    os.environ.setdefault("OCR_PARALLELISM", "1")
+    os.environ.setdefault("OCR_POOL_SIZE", "1")
+    nivel_log = logging.INFO if args.verbose else logging.WARNING
+    logging.getLogger("carpinter_ocr").setLevel(nivel_log)
+
+    extensiones = tuple(e if e.startswith(".") else f".{e}" for e in args.extensiones.lower().split(",") if e)
+    rutas = listar_imagenes(args.entradas, extensiones)
+    if not rutas:
+        print("No se encontraron imágenes.", file=sys.stderr)
+        return 1
+    formatos = [f for f, activo in (("pdf", args.pdf), ("xlsx", args.xlsx)) if activo]
+    try:
+        res = ejecutar(rutas, args.salida, max(1, args.procesos), lang=args.lang,
+                       presupuesto=args.presupuesto, formatos=formatos, docs_dir=args.docs_dir,
+                       reprocesar=args.reprocesar, nivel_log=nivel_log, progreso=not args.silencioso)
+    except KeyboardInterrupt:
+        return 130
+
+    print(f"== {res['procesadas']} procesadas ({res['errores']} con error), "
+          f"{res['saltadas_checkpoint']} ya hechas, {res['duplicadas']} duplicadas, "
+          f"de {res['encontradas']} encontradas")
+    print(f"== {res['segundos']} s, {res['imagenes_por_s']} img/s, latencia {res['latencia_ms']}, "
+          f"{res['piezas']} piezas, {res['tesseract_llamadas_media']} llamadas Tesseract/img")
+    if args.agregado:
+        agregado = agregar_salida(args.salida, tolerancia=args.tolerancia, material=args.material)
+        stats = agregado.stats()
+        with open(args.agregado, "w", encoding="utf-8") as f:
+            json.dump({"piezas": agregado.piezas(), "agregacion": stats}, f, ensure_ascii=False, indent=2)
+        print(f"== agregado: {stats['entradas']} entradas -> {stats['piezas']} piezas "
+              f"({stats['unidades']} unidades), área {stats['area_m2']} m²")
+    if args.resumen_json:
+        with open(args.resumen_json, "w", encoding="utf-8") as f:
+            json.dump(res, f, ensure_ascii=False, indent=2)
+    return 1 if res["errores"] else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
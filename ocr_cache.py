@@ -0,0 +1,187 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_cache.py
+Caché de resultados OCR direccionada por contenido para Carpinter-IA.
+
+Clave = sha256(bytes de la imagen + parámetros del pipeline: lang, OCR_MAX_SIDE,
+versión...). Valor = dict JSON con piezas, dimensiones y cajas detectadas.
+
+Dos niveles:
+- memoria: LRU acotado (OCR_CACHE_MEM_ITEMS)
+- disco:   un .json por clave en OCR_CACHE_DIR, con tope de tamaño
+           (OCR_CACHE_DISK_MB); al superarlo se borran los menos usados (mtime).
+
+El nivel de disco se comparte entre workers de gunicorn del mismo contenedor.
+OCR_CACHE=0 desactiva la caché.
+"""
+
+import os
+import json
+import hashlib
+import logging
+import tempfile
+import threading
+from collections import OrderedDict
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_CACHE = os.environ.get("OCR_CACHE", "1") == "1"
+OCR_CACHE_MEM_ITEMS = int(os.environ.get("OCR_CACHE_MEM_ITEMS", 256))
+OCR_CACHE_DIR = os.environ.get("OCR_CACHE_DIR", os.path.join(tempfile.gettempdir(), "carpinter_ocr_cache"))
+OCR_CACHE_DISK_MB = float(os.environ.get("OCR_CACHE_DISK_MB", 200))
+
+
+def cache_key(data, **params):
+    """sha256 de los bytes de la imagen + parámetros (ordenados) del pipeline."""
+    h = hashlib.sha256()
+    h.update(data)
+    h.update(json.dumps(params, sort_keys=True, default=str).encode("utf-8"))
+    return h.hexdigest()
+
+
+class OcrCache:
+    def __init__(self, mem_items=OCR_CACHE_MEM_ITEMS, disk_dir=OCR_CACHE_DIR, disk_max_mb=OCR_CACHE_DISK_MB):
+        self.mem_items = max(0, int(mem_items))
+        self.disk_dir = disk_dir
+        self.disk_max_bytes = int(disk_max_mb * 1024 * 1024) if disk_dir else 0
+        self._mem = OrderedDict()
+        self._lock = threading.Lock()
+        self._disk_bytes = None
+        self.stats_counts = {"hits_mem": 0, "hits_disk": 0, "misses": 0, "puts": 0,
+                             "evictions_mem": 0, "evictions_disk": 0}
+        if self.disk_dir:
+            try:
+                os.makedirs(self.disk_dir, exist_ok=True)
+            except OSError as e:
+                logger.warning(f"Caché OCR sin disco ({e})")
+                self.disk_dir = None
+
+    # --------------------- memoria ---------------------
+    def _mem_get(self, key):
+        with self._lock:
+            if key in self._mem:
+                self._mem.move_to_end(key)
+                return self._mem[key]
+        return None
+
+    def _mem_put(self, key, value):
+        if not self.mem_items:
+            return
+        with self._lock:
+            self._mem[key] = value
+            self._mem.move_to_end(key)
+            while len(self._mem) > self.mem_items:
+                self._mem.popitem(last=False)
+                self.stats_counts["evictions_mem"] += 1
+
+    # --------------------- disco ---------------------
+    def _path(self, key):
+        return os.path.join(self.disk_dir, f"{key}.json")
+
+    def _disk_get(self, key):
+        if not self.disk_dir:
+            return None
+        path = self._path(key)
+        try:
+            with open(path, "r", encoding="utf-8") as f:
+                value = json.load(f)
+            os.utime(path, None)  # marca como usado recientemente
+            return value
+        except (OSError, ValueError):
+            return None
+
+    def _disk_put(self, key, value):
+        if not self.disk_dir:
+            return
+        try:
+            fd, tmp = tempfile.mkstemp(suffix=".tmp", dir=self.disk_dir)
+            with os.fdopen(fd, "w", encoding="utf-8") as f:
+                json.dump(value, f, ensure_ascii=False)
+            size = os.path.getsize(tmp)
+            os.replace(tmp, self._path(key))
+        except (OSError, TypeError, ValueError) as e:
+            logger.debug(f"No se pudo escribir caché OCR: {e}")
+            return
+        with self._lock:
+            if self._disk_bytes is not None:
+                self._disk_bytes += size
+        if self._disk_bytes is None or self._disk_bytes > self.disk_max_bytes:
+            self._evict_disk()
+
+    def _evict_disk(self):
+        """Recalcula el tamaño real y borra los .json más antiguos hasta caber."""
+        entradas = []
+        total = 0
+        try:
+            with os.scandir(self.disk_dir) as it:
+                for e in it:
+                    if not e.name.endswith(".json"):
+                        continue
+                    try:
+                        st = e.stat()
+                    except OSError:
+                        continue
+                    entradas.append((st.st_mtime, st.st_size, e.path))
+                    total += st.st_size
+        except OSError:
+            return
+        if total > self.disk_max_bytes:
+            entradas.sort()
+            objetivo = int(self.disk_max_bytes * 0.9)
+            for _, size, path in entradas:
+                if total <= objetivo:
+                    break
+                try:
+                    os.unlink(path)
+                    total -= size
+                    self.stats_counts["evictions_disk"] += 1
+                except OSError:
+                    pass
+        with self._lock:
+            self._disk_bytes = total
+
+    # --------------------- API ---------------------
+    def get(self, key):
+        value = self._mem_get(key)
+        if value is not None:
+            self.stats_counts["hits_mem"] += 1
+            return value
+        value = self._disk_get(key)
+        if value is not None:
+            self.stats_counts["hits_disk"] += 1
+            self._mem_put(key, value)
+            return value
+        self.stats_counts["misses"] += 1
+        return None
+
+    def put(self, key, value):
+        self.stats_counts["puts"] += 1
+        self._mem_put(key, value)
+        self._disk_put(key, value)
+
+    def stats(self):
+        out = dict(self.stats_counts)
+        hits = out["hits_mem"] + out["hits_disk"]
+        total = hits + out["misses"]
+        out["hit_rate"] = round(hits / total, 4) if total else 0.0
+        with self._lock:
+            out["items_mem"] = len(self._mem)
+        out["disk_bytes"] = self._disk_bytes
+        out["disk_max_bytes"] = self.disk_max_bytes
+        return out
+
+
+_CACHE = None
+_CACHE_LOCK = threading.Lock()
+
+
+def get_cache():
+    """Caché del proceso, o None si OCR_CACHE=0."""
+    global _CACHE
+    if not OCR_CACHE:
+        return None
+    if _CACHE is None:
+        with _CACHE_LOCK:
+            if _CACHE is None:
+                _CACHE = OcrCache()
+    return _CACHE
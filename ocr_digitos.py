@@ -0,0 +1,220 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_digitos.py
+Reconocedor rápido de filas de despiece ("3 600x400") en NumPy, sin Tesseract.
+
+El juego de caracteres de las filas es mínimo (0-9 y x), así que una fila
+limpia se puede leer en proceso:
+1. Segmentación por componentes conexas (cv2.connectedComponentsWithStats)
+   sobre la fila binarizada (Otsu).
+2. Cada glifo se normaliza a 16x16 (conservando la proporción) y se compara
+   por similitud coseno con plantillas renderizadas con las fuentes Hershey
+   de OpenCV (varios grosores y escalas), generadas una vez por proceso.
+3. Confianza por glifo = similitud con la mejor plantilla y margen frente a
+   la mejor de otra clase; la geometría (altura relativa, proporción)
+   penaliza, lo que separa la 'x' (altura de minúscula) de los dígitos.
+
+4. Los espacios se deciden por el exceso de cada hueco sobre el hueco típico
+   entre glifos de la propia fila (no por un umbral fijo: el espaciado
+   cambia con la fuente y el grosor). Un hueco dudoso entre números manda
+   la fila a Tesseract.
+
+leer_fila devuelve (texto, confianzas) si TODOS los glifos superan los
+umbrales y el texto da al menos una terna; si no, (None, confianzas) y la
+fila pasa a Tesseract.
+
+Variables de entorno:
+- OCR_DIGITS_MIN_SIM     similitud mínima por glifo (por defecto 0.80)
+- OCR_DIGITS_MIN_MARGIN  margen mínimo frente a otra clase (por defecto 0.05)
+"""
+
+import os
+import re
+import threading
+
+import cv2
+import numpy as np
+
+OCR_DIGITS_MIN_SIM = float(os.environ.get("OCR_DIGITS_MIN_SIM", 0.80))
+OCR_DIGITS_MIN_MARGIN = float(os.environ.get("OCR_DIGITS_MIN_MARGIN", 0.05))
+
+CLASES = "0123456789x"
+_TAM = 16
+_FUENTES = (cv2.FONT_HERSHEY_SIMPLEX, cv2.FONT_HERSHEY_DUPLEX, cv2.FONT_HERSHEY_COMPLEX,
+            cv2.FONT_HERSHEY_TRIPLEX, cv2.FONT_HERSHEY_PLAIN)
+_GROSORES = (1, 2, 3)
+_ESCALAS = (1.5, 2.5)
+# Penalización de geometría en la puntuación
+_PESO_ALTURA = 0.6
+_PESO_PROPORCION = 0.15
+# Segmentación
+# Exceso de un hueco sobre el hueco típico de la fila, relativo a la altura de dígito:
+# >= _ESPACIO_SI es espacio, <= _ESPACIO_NO no lo es; entre ambos, dudoso
+_ESPACIO_SI = 0.28
+_ESPACIO_NO = 0.15
+_MIN_ALTURA = 10        # filas con dígitos más bajos van a Tesseract
+
+_FILA_OK = re.compile(r"^(?:\d{1,2} )?\d{2,4} ?x ?\d{2,4}$")
+
+
+def _cuadro(glifo, out=None):
+    """Glifo binario (texto = 255, recortado) -> 16x16 centrado conservando la proporción."""
+    h, w = glifo.shape
+    esc = _TAM / max(h, w)
+    nw, nh = max(1, min(_TAM, round(w * esc))), max(1, min(_TAM, round(h * esc)))
+    out = np.zeros((_TAM, _TAM), np.uint8) if out is None else out
+    y0, x0 = (_TAM - nh) // 2, (_TAM - nw) // 2
+    out[y0:y0 + nh, x0:x0 + nw] = cv2.resize(glifo, (nw, nh), interpolation=cv2.INTER_AREA)
+    return out
+
+
+def _normalizar(cuadros):
+    """[n, 16, 16] uint8 -> [n, 256] float32 con media 0 y norma 1 por fila."""
+    v = cuadros.reshape(len(cuadros), -1).astype(np.float32)
+    v -= v.mean(axis=1, keepdims=True)
+    n = np.linalg.norm(v, axis=1, keepdims=True)
+    return v / np.where(n > 0, n, 1)
+
+
+# --------------------- Plantillas (sintéticas, una vez por proceso) ---------------------
+_PLANTILLAS = None
+_PLANTILLAS_LOCK = threading.Lock()
+
+
+def _recorte(bw):
+    ys, xs = np.nonzero(bw)
+    if not len(ys):
+        return None
+    return bw[ys.min():ys.max() + 1, xs.min():xs.max() + 1]
+
+
+def _render(ch, fuente, escala, grosor):
+    (tw, th), base = cv2.getTextSize(ch, fuente, escala, grosor)
+    lienzo = np.zeros((th + base + 2 * grosor + 4, tw + 2 * grosor + 4), np.uint8)
+    cv2.putText(lienzo, ch, (grosor + 2, th + grosor + 2), fuente, escala, 255, grosor, cv2.LINE_AA)
+    _, bw = cv2.threshold(lienzo, 127, 255, cv2.THRESH_BINARY)
+    return _recorte(bw)
+
+
+def _construir_plantillas():
+    """Mismo nº de plantillas por clase, ordenadas por clase (se agrupan con reshape)."""
+    combos = [(f, e, g) for f in _FUENTES for e in _ESCALAS for g in _GROSORES]
+    cuadros, clases, alturas, proporciones = [], [], [], []
+    for k, ch in enumerate(CLASES):
+        for fuente, escala, grosor in combos:
+            g = _render(ch, fuente, escala, grosor)
+            alto_digito = _render("0", fuente, escala, grosor).shape[0]
+            cuadros.append(_cuadro(g))
+            clases.append(k)
+            alturas.append(g.shape[0] / alto_digito)
+            proporciones.append(np.log(g.shape[1] / g.shape[0]))
+    return (np.ascontiguousarray(_normalizar(np.stack(cuadros)).T), np.asarray(clases),
+            np.asarray(alturas, np.float32), np.asarray(proporciones, np.float32))
+
+
+def plantillas():
+    """(vectores traspuestos [256, n], clase [n], altura relativa [n], log proporción [n])."""
+    global _PLANTILLAS
+    if _PLANTILLAS is None:
+        with _PLANTILLAS_LOCK:
+            if _PLANTILLAS is None:
+                _PLANTILLAS = _construir_plantillas()
+    return _PLANTILLAS
+
+
+# --------------------- Segmentación + clasificación ---------------------
+def _segmentar(fila):
+    """
+    Componentes de la fila (gris, texto oscuro) de izquierda a derecha:
+    [(x, y, w, h), ...] y la imagen binaria, o (None, None) si la fila
+    tiene algo que no parecen glifos sueltos (líneas, manchas, glifos unidos).
+    """
+    _, bw = cv2.threshold(fila, 0, 255, cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+    n, _, stats, _ = cv2.connectedComponentsWithStats(bw, connectivity=8)
+    if n <= 1:
+        return None, None
+    x, y, w, h, area = stats[1:].T
+    alto_max = int(h.max())
+    if alto_max < _MIN_ALTURA:
+        return None, None
+    ancho_fila, alto_fila = fila.shape[1], fila.shape[0]
+    motas = (h < 0.3 * alto_max) & (area < 0.05 * alto_max * alto_max)
+    bordes = (((x + w) <= 0.06 * ancho_fila) | (x >= 0.94 * ancho_fila)) \
+        & (w < 0.3 * alto_max) & (h >= 0.8 * alto_fila)  # borde vertical de la caja
+    quedan = ~(motas | bordes)
+    if (w[quedan] > 1.5 * alto_max).any():
+        return None, None  # línea horizontal o glifos pegados
+    orden = np.argsort(x[quedan], kind="stable")
+    glifos = np.stack([x, y, w, h], axis=1)[quedan][orden]
+    return glifos.tolist(), bw
+
+
+def _clasificar(vectores, alturas, proporciones):
+    """Para cada glifo: (clase, similitud, margen frente a la mejor de otra clase)."""
+    t_vec, _, t_alt, t_prop = plantillas()
+    puntos = vectores @ t_vec
+    puntos -= _PESO_ALTURA * np.abs(alturas[:, None] - t_alt[None, :])
+    puntos -= _PESO_PROPORCION * np.abs(proporciones[:, None] - t_prop[None, :])
+    # mejor puntuación por clase (las plantillas vienen agrupadas por clase)
+    por_clase = puntos.reshape(len(vectores), len(CLASES), -1).max(axis=2)
+    filas = np.arange(len(vectores))
+    mejor = por_clase.argmax(axis=1)
+    sims = por_clase[filas, mejor]
+    por_clase[filas, mejor] = -np.inf
+    return mejor, sims, sims - por_clase.max(axis=1)
+
+
+def _espacios(glifos, alto_digito):
+    """
+    Para cada hueco entre glifos consecutivos: True (espacio), False o None
+    (dudoso). La referencia es la mediana de la mitad menor de los huecos:
+    los números tienen al menos dos dígitos, así que esa mitad son huecos
+    dentro de palabra aunque la fila lleve varios espacios ("1 10 x 10").
+    """
+    geo = np.asarray(glifos, np.float32)
+    huecos = geo[1:, 0] - (geo[:-1, 0] + geo[:-1, 2])
+    if not len(huecos):
+        return []
+    menores = np.sort(huecos)[:(len(huecos) + 1) // 2]
+    exceso = (huecos - np.median(menores)) / alto_digito
+    return [True if e >= _ESPACIO_SI else False if e <= _ESPACIO_NO else None for e in exceso]
+
+
+def leer_fila(fila, min_sim=None, min_margin=None):
+    """
+    fila: imagen gris (2D, uint8, texto oscuro sobre claro) de una fila.
+    Devuelve (texto, [confianza por glifo]); texto es None si la fila no es
+    fiable y debe leerla Tesseract.
+    """
+    min_sim = OCR_DIGITS_MIN_SIM if min_sim is None else min_sim
+    min_margin = OCR_DIGITS_MIN_MARGIN if min_margin is None else min_margin
+    if fila is None or fila.ndim != 2 or fila.size == 0:
+        return None, []
+    glifos, bw = _segmentar(fila)
+    if not glifos or len(glifos) > 16:
+        return None, []
+    geo = np.asarray(glifos, np.float32)
+    alto_digito = geo[:, 3].max()
+    cuadros = np.zeros((len(glifos), _TAM, _TAM), np.uint8)
+    for k, (x, y, w, h) in enumerate(glifos):
+        _cuadro(bw[y:y + h, x:x + w], cuadros[k])
+    clases, sims, margenes = _clasificar(_normalizar(cuadros), geo[:, 3] / alto_digito,
+                                         np.log(geo[:, 2] / geo[:, 3]))
+    confianzas = [round(float(s), 3) for s in sims]
+    if (sims < min_sim).any() or (margenes < min_margin).any():
+        return None, confianzas
+
+    partes = [CLASES[clases[0]]]
+    for k, espacio in zip(clases[1:], _espacios(glifos, alto_digito)):
+        ch = CLASES[k]
+        if espacio is None:
+            # junto a la 'x' el espacio no cambia la terna; entre números sí
+            if ch != "x" and partes[-1] != "x":
+                return None, confianzas
+        elif espacio:
+            partes.append(" ")
+        partes.append(ch)
+    texto = "".join(partes)
+    if not _FILA_OK.match(texto):
+        return None, confianzas
+    return texto, confianzas
@@ -0,0 +1,218 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_jobs.py
+Trabajos OCR asíncronos para Carpinter-IA.
+
+- JobStore: dónde se guarda el estado de cada trabajo.
+    * SQLiteJobStore  (fichero local; visible desde todos los workers de gunicorn, por defecto)
+    * MemoryJobStore  (en proceso; solo con un worker: GET /jobs/<id> puede
+      caer en otro worker que no conoce el trabajo)
+- JobQueue: cola acotada + hilos worker locales que ejecutan los trabajos, de
+  modo que los hilos de petición nunca hacen OCR en línea.
+
+Estados: queued -> running -> done | error
+
+Variables de entorno:
+- OCR_JOBS_STORE    "sqlite" (por defecto) o "memory" (ignorado si WEB_CONCURRENCY > 1)
+- OCR_JOBS_DB       ruta SQLite (por defecto /tmp/carpinter_jobs.sqlite3)
+- OCR_JOBS_WORKERS  hilos worker por proceso (por defecto 2)
+- OCR_JOBS_QUEUE    tamaño máximo de la cola (por defecto 32)
+- OCR_JOBS_TTL      segundos que se conservan los trabajos terminados (por defecto 3600)
+- OCR_JOB_BUDGET    presupuesto OCR de cada trabajo en s (por defecto 600, 0 = sin límite);
+                    mucho mayor que OCR_REQUEST_BUDGET: no hay timeout HTTP que respetar
+"""
+
+import os
+import json
+import time
+import uuid
+import queue
+import sqlite3
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_JOBS_STORE = os.environ.get("OCR_JOBS_STORE", "sqlite").lower()
+OCR_JOBS_DB = os.environ.get("OCR_JOBS_DB", os.path.join(tempfile.gettempdir(), "carpinter_jobs.sqlite3"))
+OCR_JOBS_WORKERS = int(os.environ.get("OCR_JOBS_WORKERS", 2))
+OCR_JOBS_QUEUE = int(os.environ.get("OCR_JOBS_QUEUE", 32))
+OCR_JOBS_TTL = float(os.environ.get("OCR_JOBS_TTL", 3600))
+OCR_JOB_BUDGET = float(os.environ.get("OCR_JOB_BUDGET", 600))
+
+
+class QueueFull(Exception):
+    """La cola de trabajos está llena; el cliente debe reintentar más tarde."""
+
+
+def _new_job(meta=None):
+    return {"id": uuid.uuid4().hex, "status": "queued", "created": time.time(),
+            "started": None, "finished": None, "error": None, "meta": meta or {}, "result": None}
+
+
+# --------------------- Stores ---------------------
+class MemoryJobStore:
+    def __init__(self):
+        self._jobs = {}
+        self._lock = threading.Lock()
+
+    def create(self, meta=None):
+        job = _new_job(meta)
+        with self._lock:
+            self._jobs[job["id"]] = job
+        return dict(job)
+
+    def update(self, job_id, **fields):
+        with self._lock:
+            if job_id in self._jobs:
+                self._jobs[job_id].update(fields)
+
+    def get(self, job_id):
+        with self._lock:
+            job = self._jobs.get(job_id)
+            return dict(job) if job else None
+
+    def delete(self, job_id):
+        with self._lock:
+            self._jobs.pop(job_id, None)
+
+    def purge(self, ttl=OCR_JOBS_TTL):
+        limite = time.time() - ttl
+        with self._lock:
+            viejos = [k for k, j in self._jobs.items() if j["finished"] and j["finished"] < limite]
+            for k in viejos:
+                del self._jobs[k]
+        return len(viejos)
+
+
+class SQLiteJobStore:
+    _COLS = ("id", "status", "created", "started", "finished", "error", "meta", "result")
+
+    def __init__(self, path=OCR_JOBS_DB):
+        self.path = path
+        self._local = threading.local()
+        with self._conn() as c:
+            c.execute("""CREATE TABLE IF NOT EXISTS jobs (
+                id TEXT PRIMARY KEY, status TEXT, created REAL, started REAL,
+                finished REAL, error TEXT, meta TEXT, result TEXT)""")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def create(self, meta=None):
+        job = _new_job(meta)
+        self._conn().execute(
+            "INSERT INTO jobs (id, status, created, meta) VALUES (?, ?, ?, ?)",
+            (job["id"], job["status"], job["created"], json.dumps(job["meta"], ensure_ascii=False)))
+        return job
+
+    def update(self, job_id, **fields):
+        if not fields:
+            return
+        cols, vals = [], []
+        for k, v in fields.items():
+            if k not in self._COLS or k == "id":
+                continue
+            if k in ("meta", "result"):
+                v = json.dumps(v, ensure_ascii=False) if v is not None else None
+            cols.append(f"{k} = ?")
+            vals.append(v)
+        if not cols:
+            return
+        vals.append(job_id)
+        self._conn().execute(f"UPDATE jobs SET {', '.join(cols)} WHERE id = ?", vals)
+
+    def get(self, job_id):
+        row = self._conn().execute(
+            f"SELECT {', '.join(self._COLS)} FROM jobs WHERE id = ?", (job_id,)).fetchone()
+        if not row:
+            return None
+        job = dict(zip(self._COLS, row))
+        for k in ("meta", "result"):
+            job[k] = json.loads(job[k]) if job[k] else ({} if k == "meta" else None)
+        return job
+
+    def delete(self, job_id):
+        self._conn().execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+
+    def purge(self, ttl=OCR_JOBS_TTL):
+        cur = self._conn().execute("DELETE FROM jobs WHERE finished IS NOT NULL AND finished < ?",
+                                   (time.time() - ttl,))
+        return cur.rowcount
+
+
+def make_store(kind=OCR_JOBS_STORE):
+    if kind == "memory":
+        workers = int(os.environ.get("WEB_CONCURRENCY", 1) or 1)
+        if workers <= 1:
+            return MemoryJobStore()
+        logger.warning(f"OCR_JOBS_STORE=memory con {workers} workers: se usa sqlite "
+                       f"(cada worker solo vería sus trabajos)")
+    return SQLiteJobStore()
+
+
+# --------------------- Cola + workers ---------------------
+class JobQueue:
+    def __init__(self, store, workers=OCR_JOBS_WORKERS, maxsize=OCR_JOBS_QUEUE):
+        self.store = store
+        self._q = queue.Queue(maxsize=max(1, maxsize))
+        self._threads = []
+        for i in range(max(1, workers)):
+            t = threading.Thread(target=self._loop, daemon=True, name=f"ocr-job-{i}")
+            t.start()
+            self._threads.append(t)
+        self.pid = os.getpid()
+
+    def submit(self, fn, *args, meta=None, **kwargs):
+        """
+        Encola fn(*args, **kwargs); su valor de retorno (JSON) será el resultado.
+        Lanza QueueFull si la cola está llena.
+        """
+        try:
+            self.store.purge()
+        except Exception as e:
+            logger.debug(f"No se pudo purgar trabajos: {e}")
+        job = self.store.create(meta)
+        try:
+            self._q.put_nowait((job["id"], fn, args, kwargs))
+        except queue.Full:
+            self.store.delete(job["id"])
+            raise QueueFull()
+        return job
+
+    def pending(self):
+        return self._q.qsize()
+
+    def _loop(self):
+        while True:
+            job_id, fn, args, kwargs = self._q.get()
+            self.store.update(job_id, status="running", started=time.time())
+            try:
+                result = fn(*args, **kwargs)
+                self.store.update(job_id, status="done", finished=time.time(), result=result)
+            except Exception as e:
+                logger.exception(f"Trabajo {job_id} falló: {e}")
+                self.store.update(job_id, status="error", finished=time.time(), error=str(e))
+            finally:
+                self._q.task_done()
+
+
+_QUEUE = None
+_QUEUE_LOCK = threading.Lock()
+
+
+def get_queue():
+    """Cola de trabajos del proceso (se crea perezosamente; una nueva tras fork)."""
+    global _QUEUE
+    if _QUEUE is not None and _QUEUE.pid == os.getpid():
+        return _QUEUE
+    with _QUEUE_LOCK:
+        if _QUEUE is None or _QUEUE.pid != os.getpid():
+            _QUEUE = JobQueue(make_store())
+        return _QUEUE
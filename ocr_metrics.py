@@ -0,0 +1,203 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_metrics.py
+Métricas de rendimiento de Carpinter-IA en formato de texto Prometheus
+(sin dependencias externas).
+
+- Histogramas por etapa del pipeline (decode, resize, detect_boxes, find_rows,
+  tesseract, ocr_boxes, fallback_global, overlay, write_json, pdf...)
+- Llamadas a Tesseract por petición
+- Tasa de fallback a _ocr_full_image (analisis vs. fallbacks)
+- Pre-etapa de orientación (OCR_DESKEW=1): tasa de fallback con y sin
+  corrección y segundos de fallback ahorrados (estimados)
+- Tiempo de construcción del PDF
+
+Las métricas son por proceso: con varios workers de gunicorn, cada scrape de
+/metrics ve el worker que responde (la etiqueta pid permite distinguirlos).
+"""
+
+import os
+import threading
+
+# Buckets en segundos (de 1 ms a 60 s)
+BUCKETS_S = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 30, 60)
+BUCKETS_CALLS = (0, 1, 2, 5, 10, 20, 50, 100, 200)
+
+
+def _labels_str(labels):
+    if not labels:
+        return ""
+    partes = []
+    for k, v in labels:
+        v = str(v).replace("\\", "\\\\").replace('"', '\\"').replace("\n", "\\n")
+        partes.append(f'{k}="{v}"')
+    return "{" + ",".join(partes) + "}"
+
+
+def _fmt(v):
+    if v == float("inf"):
+        return "+Inf"
+    return repr(float(v)) if isinstance(v, float) else str(v)
+
+
+class Counter:
+    def __init__(self, name, help_text, label_names=()):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def inc(self, amount=1, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+    def value(self, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        return self._values.get(key, 0)
+
+    def render(self, const_labels=()):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} counter"]
+        with self._lock:
+            items = sorted(self._values.items())
+        for key, v in items:
+            labels = tuple(const_labels) + tuple(zip(self.label_names, key))
+            out.append(f"{self.name}{_labels_str(labels)} {_fmt(v)}")
+        return out
+
+
+class Histogram:
+    def __init__(self, name, help_text, label_names=(), buckets=BUCKETS_S):
+        self.name, self.help, self.label_names = name, help_text, tuple(label_names)
+        self.buckets = tuple(sorted(buckets)) + (float("inf"),)
+        self._series = {}  # key -> [counts por bucket, suma, n]
+        self._lock = threading.Lock()
+
+    def observe(self, value, **labels):
+        key = tuple(labels.get(n, "") for n in self.label_names)
+        with self._lock:
+            serie = self._series.get(key)
+            if serie is None:
+                serie = self._series[key] = [[0] * len(self.buckets), 0.0, 0]
+            for i, b in enumerate(self.buckets):
+                if value <= b:
+                    serie[0][i] += 1
+                    break
+            serie[1] += value
+            serie[2] += 1
+
+    def render(self, const_labels=()):
+        out = [f"# HELP {self.name} {self.help}", f"# TYPE {self.name} histogram"]
+        with self._lock:
+            items = sorted((k, ([*v[0]], v[1], v[2])) for k, v in self._series.items())
+        for key, (counts, suma, n) in items:
+            base = tuple(const_labels) + tuple(zip(self.label_names, key))
+            acumulado = 0
+            for b, c in zip(self.buckets, counts):
+                acumulado += c
+                out.append(f"{self.name}_bucket{_labels_str(base + (('le', _fmt(b)),))} {acumulado}")
+            out.append(f"{self.name}_sum{_labels_str(base)} {_fmt(float(suma))}")
+            out.append(f"{self.name}_count{_labels_str(base)} {n}")
+        return out
+
+
+class Registry:
+    def __init__(self):
+        self._metrics = []
+
+    def register(self, metric):
+        self._metrics.append(metric)
+        return metric
+
+    def render(self):
+        const = (("pid", os.getpid()),)
+        lines = []
+        for m in self._metrics:
+            lines.extend(m.render(const))
+        return "\n".join(lines) + "\n"
+
+
+REGISTRY = Registry()
+
+STAGE_SECONDS = REGISTRY.register(Histogram(
+    "carpinter_ocr_stage_seconds", "Duración de cada etapa del pipeline OCR/PDF", ("stage",)))
+REQUEST_SECONDS = REGISTRY.register(Histogram(
+    "carpinter_request_seconds", "Duración total de la petición", ("endpoint",)))
+TESSERACT_CALLS = REGISTRY.register(Histogram(
+    "carpinter_ocr_tesseract_calls", "Llamadas a Tesseract por análisis de imagen", (), BUCKETS_CALLS))
+TESSERACT_CALLS_TOTAL = REGISTRY.register(Counter(
+    "carpinter_ocr_tesseract_calls_total", "Llamadas a Tesseract acumuladas"))
+ANALYSES_TOTAL = REGISTRY.register(Counter(
+    "carpinter_ocr_analyses_total", "Imágenes analizadas (sin contar aciertos de caché)", ("parcial",)))
+FALLBACK_TOTAL = REGISTRY.register(Counter(
+    "carpinter_ocr_fallback_total", "Análisis que recurrieron a _ocr_full_image"))
+CACHE_TOTAL = REGISTRY.register(Counter(
+    "carpinter_ocr_cache_total", "Consultas a la caché de resultados OCR", ("resultado",)))
+ORIENTATION_TOTAL = REGISTRY.register(Counter(
+    "carpinter_ocr_orientation_total", "Análisis con la pre-etapa de orientación activa",
+    ("corregida", "fallback")))
+ORIENTATION_SAVED_SECONDS = REGISTRY.register(Counter(
+    "carpinter_ocr_orientation_saved_seconds_total",
+    "Segundos de fallback global evitados (estimados) por las correcciones de orientación"))
+EXPORT_TOTAL = REGISTRY.register(Counter(
+    "carpinter_export_total", "Descargas del despiece por formato (not_modified, hit o miss)",
+    ("formato", "resultado")))
+PDF_BUILD_SECONDS = REGISTRY.register(Histogram(
+    "carpinter_pdf_build_seconds", "Tiempo de generación del PDF/XLSX", ("formato",)))
+
+
+# Coste medio del fallback global en este proceso [n, segundos], para estimar el ahorro
+_FALLBACK_MEDIO = [0, 0.0]
+_FALLBACK_LOCK = threading.Lock()
+
+
+def _observe_orientation(meta, fallback):
+    """
+    Una imagen corregida que no cae en el fallback se acredita con el coste
+    medio del fallback observado (cota superior: quizá no habría caído) menos
+    lo que costó la etapa. El coste de la etapa en todas las imágenes está en
+    carpinter_ocr_stage_seconds{stage="orientacion"}.
+    """
+    tiempos = meta.get("tiempos_ms") or {}
+    corregida = meta.get("orientacion") is not None
+    ORIENTATION_TOTAL.inc(corregida="1" if corregida else "0", fallback="1" if fallback else "0")
+    with _FALLBACK_LOCK:
+        if fallback and "fallback_global" in tiempos:
+            _FALLBACK_MEDIO[0] += 1
+            _FALLBACK_MEDIO[1] += tiempos["fallback_global"] / 1000.0
+        medio = _FALLBACK_MEDIO[1] / _FALLBACK_MEDIO[0] if _FALLBACK_MEDIO[0] else 0.0
+    if corregida and not fallback and medio:
+        ahorro = medio - tiempos.get("orientacion", 0.0) / 1000.0
+        if ahorro > 0:
+            ORIENTATION_SAVED_SECONDS.inc(ahorro)
+
+
+def observe_ocr_result(resultado, hit):
+    """
+    Registra las métricas de un resultado de run_ocr_result.
+    hit: True/False si se consultó la caché, None si está desactivada.
+    Tasa de fallback = carpinter_ocr_fallback_total / carpinter_ocr_analyses_total.
+    """
+    if hit is not None:
+        CACHE_TOTAL.inc(resultado="hit" if hit else "miss")
+    if hit:
+        return
+    meta = resultado.get("meta") or {}
+    for etapa, ms in (meta.get("tiempos_ms") or {}).items():
+        STAGE_SECONDS.observe(ms / 1000.0, stage=etapa)
+    llamadas = int(meta.get("tesseract_llamadas") or 0)
+    TESSERACT_CALLS.observe(llamadas)
+    TESSERACT_CALLS_TOTAL.inc(llamadas)
+    ANALYSES_TOTAL.inc(parcial="1" if resultado.get("parcial") else "0")
+    if meta.get("fallback_global_usado"):
+        FALLBACK_TOTAL.inc()
+    if "orientacion" in meta:
+        _observe_orientation(meta, bool(meta.get("fallback_global_usado")))
+
+
+def server_timing(tiempos_ms):
+    """Cabecera Server-Timing a partir de {etapa: ms}."""
+    return ", ".join(f"{k};dur={v:.1f}" for k, v in tiempos_ms.items())
+
+
+def render():
+    return REGISTRY.render()
@@ -0,0 +1,241 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_orientacion.py
+Pre-etapa de orientación y enderezado para Carpinter-IA.
+
+Las fotos giradas 90° o tomadas torcidas rompen la morfología horizontal de
+_detect_text_boxes (núcleo 15x3) y la proyección horizontal de las filas, y
+acaban en el fallback global de seis pasadas (el camino más lento). Esta
+etapa trabaja sobre la imagen ya reducida y el Otsu invertido que el análisis
+calcula de todas formas:
+
+1. Perspectiva (opcional, OCR_DESKEW_PERSPECTIVE=1): si la hoja es un
+   cuadrilátero claro que ocupa buena parte de la foto, se endereza con
+   warpPerspective.
+2. Giro de 90°: los dígitos son más altos que anchos; si la mediana de
+   log(alto/ancho) de los glifos (componentes conexas de tamaño de carácter
+   completo) es negativa, el texto está en vertical. El sentido (90 o 270)
+   lo decide el clasificador de dígitos de ocr_digitos: se leen unas líneas
+   en ambos sentidos (y sin girar) y gana la similitud media más alta.
+3. Inclinación: las líneas de texto (glifos unidos con un cierre horizontal)
+   se miden con minAreaRect; se toma la mediana ponderada por longitud y se
+   rota si supera OCR_DESKEW_MIN_ANGLE.
+
+estimar() devuelve la corrección como dict JSON ({"perspectiva", "rot90",
+"angulo"}), que se guarda en meta["orientacion"]; corregir() la aplica a
+cualquier imagen de la misma página (reducida, pirámide u overlay).
+
+Variables de entorno:
+- OCR_DESKEW_PERSPECTIVE  "1" intenta además la corrección de perspectiva (por defecto "0")
+- OCR_DESKEW_MIN_ANGLE  inclinación mínima que se corrige (grados, por defecto 0.5)
+- OCR_DESKEW_MAX_ANGLE  inclinación máxima creíble (grados, por defecto 20)
+"""
+
+import os
+
+import cv2
+import numpy as np
+
+from ocr_digitos import leer_fila
+
+OCR_DESKEW_PERSPECTIVE = os.environ.get("OCR_DESKEW_PERSPECTIVE", "0") == "1"
+OCR_DESKEW_MIN_ANGLE = float(os.environ.get("OCR_DESKEW_MIN_ANGLE", 0.5))
+OCR_DESKEW_MAX_ANGLE = float(os.environ.get("OCR_DESKEW_MAX_ANGLE", 20))
+
+_MIN_GLIFOS = 12
+_UMBRAL_VERTICAL = 0.0     # mediana de log(alto/ancho) por debajo de la cual el texto está girado
+_LINEAS_SENTIDO = 4        # líneas que se leen para decidir 90 o 270
+_MIN_AREA_HOJA = 0.35      # fracción de la imagen que debe ocupar la hoja (perspectiva)
+_BLANCO = 255
+
+
+# --------------------- Transformaciones ---------------------
+def _rotar(img, angulo):
+    """Rota angulo grados (antihorario) ampliando el lienzo para no recortar esquinas."""
+    h, w = img.shape[:2]
+    m = cv2.getRotationMatrix2D((w / 2.0, h / 2.0), angulo, 1.0)
+    cos, sin = abs(m[0, 0]), abs(m[0, 1])
+    nw, nh = int(round(h * sin + w * cos)), int(round(h * cos + w * sin))
+    m[0, 2] += nw / 2.0 - w / 2.0
+    m[1, 2] += nh / 2.0 - h / 2.0
+    borde = _BLANCO if img.ndim == 2 else (_BLANCO,) * img.shape[2]
+    return cv2.warpAffine(img, m, (nw, nh), flags=cv2.INTER_LINEAR, borderValue=borde)
+
+
+_ROT90 = {90: cv2.ROTATE_90_COUNTERCLOCKWISE, 180: cv2.ROTATE_180, 270: cv2.ROTATE_90_CLOCKWISE}
+
+
+def _enderezar_perspectiva(img, cuad):
+    """cuad: 4 esquinas (fracciones de ancho/alto) en orden sup-izq, sup-der, inf-der, inf-izq."""
+    h, w = img.shape[:2]
+    src = np.asarray(cuad, np.float32) * np.float32([w, h])
+    ancho = int(max(np.linalg.norm(src[1] - src[0]), np.linalg.norm(src[2] - src[3])))
+    alto = int(max(np.linalg.norm(src[3] - src[0]), np.linalg.norm(src[2] - src[1])))
+    dst = np.float32([[0, 0], [ancho - 1, 0], [ancho - 1, alto - 1], [0, alto - 1]])
+    borde = _BLANCO if img.ndim == 2 else (_BLANCO,) * img.shape[2]
+    return cv2.warpPerspective(img, cv2.getPerspectiveTransform(src, dst), (ancho, alto),
+                               flags=cv2.INTER_LINEAR, borderValue=borde)
+
+
+def corregir(img, correccion):
+    """Aplica la corrección de estimar() (perspectiva -> 90° -> inclinación) a img."""
+    if not correccion or img is None:
+        return img
+    if correccion.get("perspectiva"):
+        img = _enderezar_perspectiva(img, correccion["perspectiva"])
+    if correccion.get("rot90"):
+        img = cv2.rotate(img, _ROT90[correccion["rot90"]])
+    if correccion.get("angulo"):
+        img = _rotar(img, correccion["angulo"])
+    return img
+
+
+# --------------------- Estimación ---------------------
+def _glifos(inv):
+    """Componentes de tamaño de carácter: (stats [n, 5], etiquetas, ids válidos)."""
+    n, etiquetas, stats, _ = cv2.connectedComponentsWithStats(inv, connectivity=8)
+    x, y, w, h, area = stats[1:].T
+    lado = np.maximum(w, h)
+    tope = 0.08 * max(inv.shape)
+    ok = (lado >= 6) & (lado <= tope) & (area >= 12) & (area >= 0.15 * w * h)
+    return stats[1:][ok], etiquetas, np.flatnonzero(ok) + 1
+
+
+def _aspecto(stats):
+    """
+    Mediana de log(alto/ancho) de los glifos de tamaño completo (las "x", los
+    puntos y el ruido, casi cuadrados, la arrastrarían a 0).
+    """
+    lado = np.maximum(stats[:, 2], stats[:, 3])
+    grandes = stats[lado >= 0.8 * np.median(lado)]
+    return float(np.median(np.log(grandes[:, 3] / grandes[:, 2])))
+
+
+def _cuadrilatero_hoja(gray):
+    """Esquinas (fracciones) de la hoja si es un cuadrilátero claro y no es ya toda la imagen."""
+    h, w = gray.shape
+    _, bw = cv2.threshold(cv2.GaussianBlur(gray, (5, 5), 0), 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+    contornos, _ = cv2.findContours(bw, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    if not contornos:
+        return None
+    c = max(contornos, key=cv2.contourArea)
+    if cv2.contourArea(c) < _MIN_AREA_HOJA * w * h:
+        return None
+    aprox = cv2.approxPolyDP(c, 0.02 * cv2.arcLength(c, True), True)
+    if len(aprox) != 4 or not cv2.isContourConvex(aprox):
+        return None
+    p = aprox.reshape(4, 2).astype(np.float32)
+    s, d = p.sum(axis=1), np.diff(p, axis=1).ravel()
+    orden = np.stack([p[s.argmin()], p[d.argmin()], p[s.argmax()], p[d.argmax()]])
+    esquinas = np.float32([[0, 0], [w - 1, 0], [w - 1, h - 1], [0, h - 1]])
+    if np.abs(orden - esquinas).max() < 0.03 * max(w, h):
+        return None  # la hoja ya llena la foto
+    return (orden / np.float32([w, h])).round(4).tolist()
+
+
+def _lineas(inv, stats, etiquetas, ids):
+    """Líneas de texto: glifos unidos con un cierre horizontal -> [(rect minAreaRect, longitud)]."""
+    paso = int(np.median(np.maximum(stats[:, 2], stats[:, 3])))
+    lut = np.zeros(etiquetas.max() + 1, np.uint8)
+    lut[ids] = 255
+    mascara = lut[etiquetas]
+    nucleo = cv2.getStructuringElement(cv2.MORPH_RECT, (max(3, int(1.5 * paso)), 1))
+    unidas = cv2.morphologyEx(mascara, cv2.MORPH_CLOSE, nucleo)
+    contornos, _ = cv2.findContours(unidas, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
+    lineas = []
+    for c in contornos:
+        rect = cv2.minAreaRect(c)
+        largo, corto = max(rect[1]), min(rect[1])
+        if largo >= 3 * paso and largo >= 3 * corto:
+            lineas.append((rect, largo))
+    return lineas
+
+
+def _angulo(rect):
+    """Inclinación (grados, antihorario) del lado largo de un minAreaRect, en [-45, 45)."""
+    (_, _), (rw, rh), ang = rect
+    if rw < rh:
+        ang -= 90
+    while ang > 45:
+        ang -= 90
+    while ang <= -45:
+        ang += 90
+    return -ang  # minAreaRect mide en sentido horario (eje y hacia abajo)
+
+
+def _inclinacion(lineas):
+    """Mediana ponderada por longitud de la inclinación de las líneas (antihorario), o 0."""
+    if len(lineas) < 2:
+        return 0.0
+    angs = np.array([_angulo(r) for r, _ in lineas])
+    pesos = np.array([l for _, l in lineas])
+    orden = np.argsort(angs)
+    acum = np.cumsum(pesos[orden])
+    return float(angs[orden][np.searchsorted(acum, acum[-1] / 2.0)])
+
+
+def _recortar_linea(gray, rect):
+    """Recorte horizontal (enderezado con su propio minAreaRect) de una línea, con margen."""
+    (cx, cy), _, _ = rect
+    largo, corto = max(rect[1]), min(rect[1])
+    pad = max(2, int(corto) // 4)
+    ancho, alto = int(largo) + 2 * pad, int(corto) + 2 * pad
+    m = cv2.getRotationMatrix2D((cx, cy), -_angulo(rect), 1.0)
+    m[0, 2] += ancho / 2.0 - cx
+    m[1, 2] += alto / 2.0 - cy
+    return cv2.warpAffine(gray, m, (ancho, alto), flags=cv2.INTER_LINEAR, borderValue=_BLANCO)
+
+
+def _puntuar_lineas(gray, lineas):
+    """Similitud media del clasificador de dígitos en las _LINEAS_SENTIDO líneas más largas que lee."""
+    sims, leidas = [], 0
+    for rect, _ in sorted(lineas, key=lambda t: -t[1]):
+        fila = _recortar_linea(gray, rect)
+        _, conf = leer_fila(fila, min_sim=1.1)  # solo interesan las confianzas
+        if conf:  # sin confianzas: la fila no es de dígitos (demasiados glifos)
+            sims.extend(conf)
+            leidas += 1
+            if leidas == _LINEAS_SENTIDO:
+                break
+    return float(np.mean(sims)) if sims else 0.0
+
+
+def estimar(gray, inv):
+    """
+    gray: imagen gris reducida; inv: su Otsu invertido (texto = 255).
+    Devuelve la corrección {"perspectiva": cuad | None, "rot90": 0/90/270,
+    "angulo": grados} o None si la página ya está derecha.
+    """
+    correccion = {"perspectiva": None, "rot90": 0, "angulo": 0.0}
+    if OCR_DESKEW_PERSPECTIVE:
+        cuad = _cuadrilatero_hoja(gray)
+        if cuad is not None:
+            correccion["perspectiva"] = cuad
+            gray = _enderezar_perspectiva(gray, cuad)
+            _, inv = cv2.threshold(cv2.GaussianBlur(gray, (3, 3), 0), 0, 255,
+                                   cv2.THRESH_BINARY_INV + cv2.THRESH_OTSU)
+
+    stats, etiquetas, ids = _glifos(inv)
+    if len(ids) < _MIN_GLIFOS:
+        return correccion if correccion["perspectiva"] else None
+    if _aspecto(stats) < _UMBRAL_VERTICAL:
+        # texto vertical: gana el sentido en que los dígitos se leen mejor; la
+        # página tal cual también compite (una inclinación fuerte engaña al aspecto)
+        lineas = _lineas(inv, stats, etiquetas, ids)
+        candidatos = [(_puntuar_lineas(gray, lineas), 0, gray, inv, lineas)]
+        for rot in (270, 90):
+            g = cv2.rotate(gray, _ROT90[rot])
+            i = cv2.rotate(inv, _ROT90[rot])
+            st, et, ii = _glifos(i)
+            lin = _lineas(i, st, et, ii) if len(ii) else []
+            candidatos.append((_puntuar_lineas(g, lin), rot, g, i, lin))
+        _, correccion["rot90"], gray, inv, lineas = max(candidatos, key=lambda c: c[0])
+    else:
+        lineas = _lineas(inv, stats, etiquetas, ids)
+
+    ang = _inclinacion(lineas)
+    if OCR_DESKEW_MIN_ANGLE <= abs(ang) <= OCR_DESKEW_MAX_ANGLE:
+        correccion["angulo"] = round(-ang, 2)  # girar en sentido contrario a la inclinación
+    if not (correccion["perspectiva"] or correccion["rot90"] or correccion["angulo"]):
+        return None
+    return correccion
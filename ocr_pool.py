@@ -0,0 +1,422 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_pool.py
+Pool de procesos OCR "calientes" para Carpinter-IA.
+
+Cada worker es un proceso de larga vida que carga libtesseract (vía tesserocr)
+y los datos de idioma UNA vez, y después atiende peticiones por un Pipe.
+Así se evita el fork de /usr/bin/tesseract + carga de modelos en cada línea.
+
+Uso (ocr_rayas_tesseract lo hace de forma transparente):
+    pool = get_pool()
+    if pool:
+        txt = pool.image_to_string(img, lang="eng+spa", config="--psm 7", timeout=12)
+
+Variables de entorno:
+- OCR_POOL               "auto" (por defecto: activo si tesserocr está instalado), "1" o "0"
+- OCR_POOL_SIZE          nº de workers (por defecto 2)
+- OCR_POOL_TIMEOUT       timeout por llamada si el llamante no indica uno (s)
+- OCR_POOL_MAX_TASKS     reciclar el worker tras N llamadas (0 = nunca)
+- OCR_POOL_HEALTH_EVERY  segundos entre health checks de workers ociosos (0 = off)
+
+Los errores se reportan como RuntimeError, igual que pytesseract en timeout,
+para que el código existente (que ya captura RuntimeError) no cambie.
+"""
+
+import os
+import re
+import time
+import queue
+import logging
+import threading
+import importlib.util
+import multiprocessing as mp
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_POOL = os.environ.get("OCR_POOL", "auto").lower()
+OCR_POOL_SIZE = int(os.environ.get("OCR_POOL_SIZE", 2))
+OCR_POOL_TIMEOUT = float(os.environ.get("OCR_POOL_TIMEOUT", 30))
+OCR_POOL_MAX_TASKS = int(os.environ.get("OCR_POOL_MAX_TASKS", 0))
+OCR_POOL_HEALTH_EVERY = float(os.environ.get("OCR_POOL_HEALTH_EVERY", 30))
+OCR_POOL_START_TIMEOUT = float(os.environ.get("OCR_POOL_START_TIMEOUT", 60))
+
+
+# --------------------- Configuración estilo CLI -> API ---------------------
+def parse_config(config):
+    """
+    Traduce la cadena de config de pytesseract ("--oem 3 --psm 7 -c k=v ...")
+    a (oem, psm, {variable: valor}).
+    """
+    oem, psm, variables = 3, 3, {}
+    toks = (config or "").split()
+    i = 0
+    while i < len(toks):
+        tok = toks[i]
+        if tok in ("--oem", "--psm") and i + 1 < len(toks):
+            if tok == "--oem":
+                oem = int(toks[i + 1])
+            else:
+                psm = int(toks[i + 1])
+            i += 2
+            continue
+        if tok == "-c" and i + 1 < len(toks) and "=" in toks[i + 1]:
+            k, v = toks[i + 1].split("=", 1)
+            variables[k] = v
+            i += 2
+            continue
+        m = re.match(r"^-c(\w+)=(.*)$", tok)
+        if m:
+            variables[m.group(1)] = m.group(2)
+        i += 1
+    return oem, psm, variables
+
+
+# --------------------- Proceso worker ---------------------
+def _to_pil(img):
+    from PIL import Image
+    import numpy as np
+
+    arr = np.ascontiguousarray(img)
+    if arr.ndim == 3 and arr.shape[2] == 3:
+        arr = arr[:, :, ::-1].copy()  # BGR (OpenCV) -> RGB
+    return Image.fromarray(arr)
+
+
+def _words_data(api, tesserocr):
+    """Equivalente a pytesseract.image_to_data(..., output_type=Output.DICT) a nivel palabra."""
+    keys = ("level", "page_num", "block_num", "par_num", "line_num", "word_num",
+            "left", "top", "width", "height", "conf", "text")
+    data = {k: [] for k in keys}
+    api.Recognize()
+    it = api.GetIterator()
+    if it is None:
+        return data
+    RIL = tesserocr.RIL
+    block = par = line = word = 0
+    while True:
+        if it.IsAtBeginningOf(RIL.BLOCK):
+            block, par, line, word = block + 1, 0, 0, 0
+        if it.IsAtBeginningOf(RIL.PARA):
+            par, line, word = par + 1, 0, 0
+        if it.IsAtBeginningOf(RIL.TEXTLINE):
+            line, word = line + 1, 0
+        word += 1
+        bbox = it.BoundingBox(RIL.WORD)
+        if bbox:
+            x1, y1, x2, y2 = bbox
+            data["level"].append(5)
+            data["page_num"].append(1)
+            data["block_num"].append(block)
+            data["par_num"].append(par)
+            data["line_num"].append(line)
+            data["word_num"].append(word)
+            data["left"].append(x1)
+            data["top"].append(y1)
+            data["width"].append(x2 - x1)
+            data["height"].append(y2 - y1)
+            data["conf"].append(float(it.Confidence(RIL.WORD)))
+            data["text"].append(it.GetUTF8Text(RIL.WORD) or "")
+        if not it.Next(RIL.WORD):
+            break
+    return data
+
+
+def _worker_main(conn, tessdata):
+    """Bucle del proceso: mantiene una API de Tesseract por (lang, oem)."""
+    try:
+        import tesserocr
+    except Exception as e:  # pragma: no cover - depende del entorno
+        conn.send(("error", f"tesserocr no disponible: {e}"))
+        return
+
+    apis = {}
+    defaults = {}
+
+    def get_api(lang, oem):
+        key = (lang, oem)
+        if key not in apis:
+            # tesserocr.OEM/PSM son clases con constantes int, no enums invocables
+            apis[key] = tesserocr.PyTessBaseAPI(path=tessdata, lang=lang, oem=oem)
+            defaults[key] = {}
+        return apis[key], defaults[key]
+
+    conn.send(("ready", os.getpid()))
+    while True:
+        try:
+            msg = conn.recv()
+        except (EOFError, OSError):
+            break
+        op = msg[0]
+        if op == "stop":
+            break
+        if op == "ping":
+            conn.send(("ok", "pong"))
+            continue
+        try:
+            _, img, lang, config = msg
+            oem, psm, variables = parse_config(config)
+            api, dflt = get_api(lang, oem)
+            # restaurar variables que pusieron llamadas anteriores y esta no pide
+            for k, v in list(dflt.items()):
+                if k not in variables:
+                    api.SetVariable(k, v)
+            for k, v in variables.items():
+                if k not in dflt:
+                    dflt[k] = api.GetVariableAsString(k) or ""
+                api.SetVariable(k, v)
+            api.SetPageSegMode(psm)
+            api.SetImage(_to_pil(img))
+            if op == "string":
+                out = api.GetUTF8Text()
+            else:
+                out = _words_data(api, tesserocr)
+            api.Clear()
+            conn.send(("ok", out))
+        except Exception as e:
+            conn.send(("error", str(e)))
+
+    for api in apis.values():
+        try:
+            api.End()
+        except Exception:
+            pass
+
+
+class _Worker:
+    def __init__(self, ctx, tessdata):
+        self._ctx = ctx
+        self._tessdata = tessdata
+        self.proc = None
+        self.conn = None
+        self.tareas = 0
+        self.start()
+
+    def start(self):
+        parent, child = self._ctx.Pipe()
+        self.proc = self._ctx.Process(target=_worker_main, args=(child, self._tessdata), daemon=True)
+        self.proc.start()
+        child.close()
+        self.conn = parent
+        self.tareas = 0
+        if not parent.poll(OCR_POOL_START_TIMEOUT):
+            self.kill()
+            raise RuntimeError("OCR worker no arrancó a tiempo")
+        estado, info = parent.recv()
+        if estado != "ready":
+            self.kill()
+            raise RuntimeError(f"OCR worker falló al arrancar: {info}")
+
+    def kill(self):
+        try:
+            if self.conn:
+                self.conn.close()
+        except Exception:
+            pass
+        if self.proc is not None and self.proc.is_alive():
+            self.proc.kill()
+            self.proc.join(timeout=2)
+
+    def restart(self):
+        self.kill()
+        self.start()
+
+    def alive(self):
+        return self.proc is not None and self.proc.is_alive()
+
+    def call(self, msg, timeout):
+        """
+        Envía msg y espera respuesta. En timeout/caída mata el worker y lanza
+        RuntimeError sin reiniciarlo: el arranque (hasta OCR_POOL_START_TIMEOUT)
+        no debe cargarse al plazo del llamante; lo repone el pool.
+        """
+        try:
+            self.conn.send(msg)
+            if not self.conn.poll(timeout):
+                raise TimeoutError
+            estado, out = self.conn.recv()
+        except TimeoutError:
+            logger.warning(f"OCR worker {self.proc.pid} timeout ({timeout}s); se repone en segundo plano")
+            self.kill()
+            raise RuntimeError("Tesseract process timeout")
+        except (EOFError, OSError, BrokenPipeError) as e:
+            logger.warning(f"OCR worker caído ({e}); se repone en segundo plano")
+            self.kill()
+            raise RuntimeError(f"OCR worker caído: {e}")
+        self.tareas += 1
+        if estado != "ok":
+            raise RuntimeError(out)
+        return out
+
+
+class OcrPool:
+    """Pool de workers Tesseract de larga vida con health checks y reinicio."""
+
+    def __init__(self, size=None, tessdata=None):
+        self.size = max(1, int(size or OCR_POOL_SIZE))
+        self.tessdata = tessdata or os.environ.get("TESSDATA_PREFIX", "/usr/share/tessdata")
+        self._ctx = mp.get_context("spawn")  # seguro aunque el padre tenga hilos
+        self._idle = queue.Queue()
+        self._workers = []
+        self._lock = threading.Lock()
+        self._closed = False
+        self._health_thread = None
+        self.pid = os.getpid()
+
+    def start(self):
+        with self._lock:
+            if self._workers:
+                return self
+            for _ in range(self.size):
+                w = _Worker(self._ctx, self.tessdata)
+                self._workers.append(w)
+                self._idle.put(w)
+            if OCR_POOL_HEALTH_EVERY > 0:
+                self._health_thread = threading.Thread(target=self._health_loop, daemon=True,
+                                                       name="ocr-pool-health")
+                self._health_thread.start()
+            logger.info(f"OCR pool iniciado con {self.size} workers")
+        return self
+
+    def _run(self, msg, timeout, deadline=None):
+        """
+        timeout cubre la espera de worker Y la llamada: la llamada recibe solo lo
+        que queda. Con deadline (Deadline de ocr_rayas_tesseract) la espera se
+        anota como etapa "pool_espera" y, si tras ella no queda presupuesto,
+        deadline.timeout() lanza BudgetExceeded sin llegar a llamar.
+        """
+        timeout = timeout or OCR_POOL_TIMEOUT
+        fin = time.monotonic() + timeout
+        t0 = time.perf_counter()
+        try:
+            w = self._idle.get(timeout=timeout)
+        except queue.Empty:
+            raise RuntimeError("OCR pool saturado")
+        finally:
+            if deadline is not None:
+                deadline.add_time("pool_espera", (time.perf_counter() - t0) * 1000.0)
+        reponer = False
+        try:
+            if not w.alive():  # no se pudo reponer en segundo plano: último intento aquí
+                w.restart()
+            restante = fin - time.monotonic()
+            if deadline is not None:
+                restante = deadline.timeout(restante)
+            if restante <= 0:
+                raise RuntimeError("Tesseract process timeout")
+            out = w.call(msg, restante)
+            reponer = bool(OCR_POOL_MAX_TASKS and w.tareas >= OCR_POOL_MAX_TASKS)
+            return out
+        except RuntimeError:
+            reponer = not w.alive()
+            raise
+        finally:
+            if reponer:
+                self._reponer(w)
+            else:
+                self._idle.put(w)
+
+    def _reponer(self, w):
+        """Reinicia el worker en un hilo y lo devuelve a la cola al terminar."""
+        def reiniciar():
+            try:
+                if not self._closed:
+                    w.restart()
+            except Exception as e:
+                logger.warning(f"No se pudo reponer OCR worker: {e}")
+            finally:
+                self._idle.put(w)
+        threading.Thread(target=reiniciar, daemon=True, name="ocr-pool-restart").start()
+
+    def image_to_string(self, img, lang="eng", config="", timeout=None, deadline=None):
+        return self._run(("string", img, lang, config), timeout, deadline)
+
+    def image_to_data(self, img, lang="eng", config="", timeout=None, deadline=None):
+        return self._run(("data", img, lang, config), timeout, deadline)
+
+    def health(self):
+        """Hace ping a los workers ociosos y reinicia los que no responden."""
+        estado = {"size": self.size, "ok": 0, "reiniciados": 0}
+        for _ in range(self.size):
+            try:
+                w = self._idle.get_nowait()
+            except queue.Empty:
+                break
+            try:
+                if not w.alive():
+                    raise RuntimeError("muerto")
+                w.call(("ping",), 5)
+                estado["ok"] += 1
+            except Exception:
+                try:
+                    w.restart()
+                    estado["reiniciados"] += 1
+                except Exception as e:
+                    logger.warning(f"No se pudo reiniciar OCR worker: {e}")
+            finally:
+                self._idle.put(w)
+        return estado
+
+    def _health_loop(self):
+        while not self._closed:
+            time.sleep(OCR_POOL_HEALTH_EVERY)
+            if self._closed:
+                break
+            try:
+                self.health()
+            except Exception as e:
+                logger.debug(f"Health check OCR pool: {e}")
+
+    def close(self):
+        self._closed = True
+        for w in self._workers:
+            try:
+                w.conn.send(("stop",))
+            except Exception:
+                pass
+            w.kill()
+        self._workers = []
+
+
+# --------------------- Pool por proceso ---------------------
+_POOL = None
+_POOL_LOCK = threading.Lock()
+_POOL_FAILED = False
+
+
+def pool_enabled():
+    if OCR_POOL in ("0", "false", "no", "off"):
+        return False
+    if OCR_POOL == "auto":
+        return importlib.util.find_spec("tesserocr") is not None
+    return True
+
+
+def get_pool():
+    """
+    Devuelve el pool de este proceso (creándolo perezosamente) o None si está
+    desactivado/no disponible. Tras un fork (gunicorn) se crea uno nuevo en el hijo.
+    """
+    global _POOL, _POOL_FAILED
+    if _POOL_FAILED or not pool_enabled():
+        return None
+    pool = _POOL
+    if pool is not None and pool.pid == os.getpid():
+        return pool
+    with _POOL_LOCK:
+        if _POOL is None or _POOL.pid != os.getpid():
+            try:
+                _POOL = OcrPool().start()
+            except Exception as e:
+                logger.warning(f"OCR pool no disponible, se usa pytesseract: {e}")
+                _POOL_FAILED = True
+                _POOL = None
+        return _POOL
+
+
+def shutdown_pool():
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is not None and _POOL.pid == os.getpid():
+            _POOL.close()
+        _POOL = None
@@ -5,13 +5,45 @@ Archivo único: ocr_rayas_tesseract.py
 
 Funciones públicas:
 - run_ocr_and_get_pieces(image_path, debug_overlay=None, lang="eng+spa")
+    -> image_path: ruta, bytes del fichero o ndarray BGR (se decodifica en memoria)
     -> devuelve (piezas, width, height)
-    -> guarda debug_overlay.png en /tmp si detecta cajas (solo si ruta destino != input)
-    -> registra /tmp/last_result.json (no necesario, app.py puede usarlo)
+    -> si se pasa debug_overlay (ruta), guarda ahí el overlay de cajas (si las hay)
+    -> con OCR_DEBUG_FILES=1 escribe además /tmp/debug_overlay.png y /tmp/last_result.json
+       (desactivado por defecto: con varios workers esos ficheros fijos se pisan)
+
+Modo lote (OCR_BATCH=1; desactivado por defecto hasta medir su paridad con
+el camino por fila): todas las filas/cajas de una imagen se apilan en un
+lienzo y se leen con una sola llamada a Tesseract (image_to_data); las
+palabras se devuelven a su fila/caja por coordenadas.
+
+Pool caliente (ocr_pool.py): si tesserocr está instalado, las llamadas van a
+workers de larga vida que cargan los modelos una vez (OCR_POOL, OCR_POOL_SIZE).
+
+Modo pirámide (OCR_PYRAMID=1): la detección de cajas y filas se hace sobre la
+imagen reducida a OCR_MAX_SIDE y solo los recortes se leen de la imagen a
+resolución completa (hasta OCR_PYRAMID_SIDE), de modo que se puede bajar
+OCR_MAX_SIDE sin perder dígitos pequeños.
+
+Lector de dígitos (OCR_DIGITS=1): cada fila se intenta antes con el
+clasificador NumPy de ocr_digitos.py; solo las filas de baja confianza van a
+Tesseract.
+
+Caché de filas (OCR_ROW_CACHE=1, ocr_row_cache.py): las filas binarizadas
+cuya huella perceptual coincide con una fila ya leída reutilizan su texto
+sin pasar por Tesseract.
+
+Orientación (OCR_DESKEW=1, ocr_orientacion.py): antes de detectar cajas se
+estima sobre la imagen reducida si la foto está girada 90°, inclinada o (con
+OCR_DESKEW_PERSPECTIVE=1) en perspectiva, y se endereza; así no acaba en el
+fallback global. La corrección queda en meta["orientacion"].
+
+Paralelismo (OCR_PARALLELISM): filas, cajas y lienzos se leen en un pool de
+hilos acotado; el orden de piezas se mantiene (arriba -> abajo).
 
 Hecho robusto para servidores tipo Render (Linux) y Windows local.
 """
 
+import io
 import os
 import re
 import json
@@ -20,11 +52,19 @@ import tempfile
 import platform
 import shutil
 import logging
+import threading
+from contextlib import contextmanager
+from concurrent.futures import ThreadPoolExecutor
 
 import cv2
 import numpy as np
 import pytesseract
 
+from ocr_pool import get_pool
+from ocr_digitos import leer_fila, OCR_DIGITS_MIN_SIM, OCR_DIGITS_MIN_MARGIN
+from ocr_row_cache import get_row_cache, OCR_ROW_CACHE, OCR_ROW_CACHE_MAX_DIST, OCR_ROW_CACHE_AUDIT
+import ocr_orientacion
+
 # --------------------- Config/entorno Tesseract portable ---------------------
 TESSERACT_CMD_ENV = os.environ.get("TESSERACT_CMD")
 TESSDATA_PREFIX_ENV = os.environ.get("TESSDATA_PREFIX")
@@ -56,8 +96,185 @@ logger = logging.getLogger("carpinter_ocr")
 
 # --------------------- Ajustes OCR/transformaciones ---------------------
 MAX_SIDE = int(os.environ.get("OCR_MAX_SIDE", 1400))
+# Decodificar JPEG grandes ya reducidos (IMREAD_REDUCED_*) cuando MAX_SIDE lo permite
+OCR_REDUCED_DECODE = os.environ.get("OCR_REDUCED_DECODE", "1") == "1"
 OCR_TIMEOUT_LINE = int(os.environ.get("OCR_TIMEOUT_LINE", 12))
 OCR_TIMEOUT_GLOBAL = int(os.environ.get("OCR_TIMEOUT_GLOBAL", 30))
+# Presupuesto total por imagen (s), compartido por todas las llamadas a Tesseract (0 = sin límite)
+OCR_REQUEST_BUDGET = float(os.environ.get("OCR_REQUEST_BUDGET", 25))
+OCR_MIN_CALL_TIMEOUT = 0.5  # por debajo no merece la pena lanzar Tesseract
+
+# Modo lote: todas las filas/cajas de una imagen en un único Tesseract
+# (desactivado por defecto hasta medir su paridad con el camino por fila en el bench)
+OCR_BATCH = os.environ.get("OCR_BATCH", "0") == "1"
+OCR_BATCH_MAX_HEIGHT = int(os.environ.get("OCR_BATCH_MAX_HEIGHT", 8000))  # Tesseract admite < 32767 px
+BATCH_MIN_GAP = 20
+
+# Modo pirámide: detectar cajas/filas en la imagen a MAX_SIDE y leer los recortes
+# de una decodificación a mayor resolución (lado máximo OCR_PYRAMID_SIDE, 0 = original)
+OCR_PYRAMID = os.environ.get("OCR_PYRAMID", "0") == "1"
+OCR_PYRAMID_SIDE = int(os.environ.get("OCR_PYRAMID_SIDE", 4000))
+
+# Lector rápido de dígitos (ocr_digitos.py): las filas que lee con confianza no pasan por Tesseract
+OCR_DIGITS = os.environ.get("OCR_DIGITS", "0") == "1"
+
+# Pre-etapa de orientación/enderezado (ocr_orientacion.py) antes de detectar cajas
+OCR_DESKEW = os.environ.get("OCR_DESKEW", "0") == "1"
+
+# Ficheros de depuración fijos en /tmp (overlay + last_result.json); solo para uso local
+OCR_DEBUG_FILES = os.environ.get("OCR_DEBUG_FILES", "0") == "1"
+
+# Fallback global adaptativo: parar en la primera pasada fiable
+OCR_FALLBACK_ADAPTIVE = os.environ.get("OCR_FALLBACK_ADAPTIVE", "1") == "1"
+OCR_FALLBACK_MIN_CONF = float(os.environ.get("OCR_FALLBACK_MIN_CONF", 60))
+
+# Paralelismo: nº de filas/cajas/lienzos OCR a la vez en este proceso
+def _default_parallelism():
+    try:
+        n = len(os.sched_getaffinity(0))
+    except (AttributeError, OSError):
+        n = os.cpu_count() or 1
+    return min(4, n)
+
+
+OCR_PARALLELISM = max(1, int(os.environ.get("OCR_PARALLELISM", _default_parallelism())))
+# Tope de procesos tesseract (pytesseract) simultáneos por proceso Python
+OCR_MAX_TESS_PROCS = max(1, int(os.environ.get("OCR_MAX_TESS_PROCS", OCR_PARALLELISM)))
+
+# --------------------- Presupuesto de tiempo por petición ---------------------
+class BudgetExceeded(RuntimeError):
+    """Se agotó el presupuesto de la petición (RuntimeError, como un timeout de pytesseract)."""
+
+
+class Deadline:
+    """
+    Plazo único de una petición OCR. Cada llamada a Tesseract usa como timeout
+    el mínimo entre su límite propio y lo que queda; al agotarse, las llamadas
+    restantes fallan al instante y el resultado se marca como parcial.
+    También acumula los tiempos por etapa y las llamadas a Tesseract de la
+    petición (se pasa a todas las etapas, incluidos los hilos del ejecutor).
+    """
+
+    def __init__(self, seconds=None):
+        self.seconds = seconds if seconds is not None else OCR_REQUEST_BUDGET
+        self.fin = time.monotonic() + self.seconds if self.seconds and self.seconds > 0 else None
+        self.agotado = False
+        self.tiempos_ms = {}
+        self.tesseract_llamadas = 0
+        self._lock = threading.Lock()
+
+    def add_time(self, etapa, ms):
+        with self._lock:
+            self.tiempos_ms[etapa] = self.tiempos_ms.get(etapa, 0.0) + ms
+
+    def add_tesseract_call(self, ms):
+        with self._lock:
+            self.tesseract_llamadas += 1
+            self.tiempos_ms["tesseract"] = self.tiempos_ms.get("tesseract", 0.0) + ms
+
+    @contextmanager
+    def etapa(self, nombre):
+        t0 = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add_time(nombre, (time.perf_counter() - t0) * 1000.0)
+
+    def remaining(self):
+        if self.fin is None:
+            return None
+        return self.fin - time.monotonic()
+
+    def expired(self):
+        restante = self.remaining()
+        if restante is not None and restante < OCR_MIN_CALL_TIMEOUT:
+            self.agotado = True
+        return self.agotado
+
+    def timeout(self, per_call):
+        """Timeout para la siguiente llamada, o BudgetExceeded si ya no queda tiempo."""
+        if self.expired():
+            raise BudgetExceeded("Presupuesto OCR agotado")
+        restante = self.remaining()
+        return per_call if restante is None else min(per_call, restante)
+
+
+def _call_timeout(per_call, deadline):
+    return deadline.timeout(per_call) if deadline is not None else per_call
+
+
+# --------------------- Backend Tesseract (pool caliente o pytesseract) ---------------------
+_TESS_SLOTS = threading.BoundedSemaphore(OCR_MAX_TESS_PROCS)
+
+
+def _tess_call(op, img, lang, config, timeout, deadline=None):
+    """
+    Una llamada a Tesseract (pool o pytesseract). timeout acota también la
+    espera de worker/ranura: la llamada recibe solo lo que queda tras ella.
+    """
+    timeout = _call_timeout(timeout, deadline)
+    t0 = time.perf_counter()
+    try:
+        pool = get_pool()
+        if pool is not None:
+            fn = pool.image_to_string if op == "string" else pool.image_to_data
+            return fn(img, lang=lang, config=config, timeout=timeout, deadline=deadline)
+        if not _TESS_SLOTS.acquire(timeout=timeout):
+            raise RuntimeError("Tesseract process timeout")
+        try:
+            espera = time.perf_counter() - t0
+            if deadline is not None:
+                deadline.add_time("tess_espera", espera * 1000.0)
+            timeout = _call_timeout(timeout - espera, deadline)
+            if timeout <= 0:
+                raise RuntimeError("Tesseract process timeout")
+            if op == "string":
+                return pytesseract.image_to_string(img, lang=lang, config=config, timeout=timeout)
+            return pytesseract.image_to_data(img, lang=lang, config=config, timeout=timeout,
+                                             output_type=pytesseract.Output.DICT)
+        finally:
+            _TESS_SLOTS.release()
+    finally:
+        if deadline is not None:
+            deadline.add_tesseract_call((time.perf_counter() - t0) * 1000.0)
+
+
+def _tess_string(img, lang, config, timeout, deadline=None):
+    return _tess_call("string", img, lang, config, timeout, deadline)
+
+
+def _tess_data(img, lang, config, timeout, deadline=None):
+    return _tess_call("data", img, lang, config, timeout, deadline)
+
+
+# --------------------- Ejecutor de OCR concurrente ---------------------
+_EXECUTOR = None
+_EXECUTOR_PID = None
+_EXECUTOR_LOCK = threading.Lock()
+
+
+def _get_executor():
+    """ThreadPoolExecutor del proceso (se recrea tras un fork de gunicorn)."""
+    global _EXECUTOR, _EXECUTOR_PID
+    if _EXECUTOR is not None and _EXECUTOR_PID == os.getpid():
+        return _EXECUTOR
+    with _EXECUTOR_LOCK:
+        if _EXECUTOR is None or _EXECUTOR_PID != os.getpid():
+            _EXECUTOR = ThreadPoolExecutor(max_workers=OCR_PARALLELISM, thread_name_prefix="ocr")
+            _EXECUTOR_PID = os.getpid()
+        return _EXECUTOR
+
+
+def _map_ordenado(fn, items):
+    """map() concurrente si OCR_PARALLELISM > 1; el resultado conserva el orden de items."""
+    items = list(items)
+    if OCR_PARALLELISM <= 1 or len(items) <= 1:
+        return [fn(it) for it in items]
+    return list(_get_executor().map(fn, items))
+
+
+# Subir al cambiar el pipeline de forma que cambien los resultados (invalida cachés)
+PIPELINE_VERSION = "3"
 
 # --------------------- Paths por defecto ---------------------
 DEBUG_OVERLAY_DEFAULT = "/tmp/debug_overlay.png"
@@ -78,93 +295,462 @@ def _extract_pairs_from_text(texto):
     return out
 
 
-def _find_text_rows(img):
-    try:
-        g = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    except Exception:
+# --------------------- Planos de preprocesado (una vez por imagen) ---------------------
+# Fracción de la página cubierta por cajas a partir de la cual el umbral
+# adaptativo se calcula una vez para toda la página
+ADAPTIVE_PAGE_RATIO = 0.8
+
+
+def _gray(img):
+    """Gris de una imagen BGR; si ya es 2D se devuelve tal cual (sin copia)."""
+    return img if img.ndim == 2 else cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
+
+
+def _adaptive_inv(gray):
+    """Umbral adaptativo invertido (texto = 255) usado para las bandas de fila."""
+    return cv2.adaptiveThreshold(gray, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C, cv2.THRESH_BINARY_INV, 31, 7)
+
+
+class _Planos:
+    """
+    Planos de una imagen (gris, Otsu, adaptativo) calculados una sola vez, al
+    primer uso, y repartidos como vistas (sin copias) a las etapas de cajas,
+    filas, líneas y OCR global.
+    """
+
+    def __init__(self, img):
+        self.img = img
+        self._gray = self._otsu = self._otsu_inv = self._adaptativo = None
+
+    @property
+    def gray(self):
+        if self._gray is None:
+            self._gray = _gray(self.img)
+        return self._gray
+
+    @property
+    def otsu(self):
+        if self._otsu is None:
+            blur = cv2.GaussianBlur(self.gray, (3, 3), 0)
+            _, self._otsu = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
+        return self._otsu
+
+    @property
+    def otsu_inv(self):
+        if self._otsu_inv is None:
+            self._otsu_inv = cv2.bitwise_not(self.otsu)
+        return self._otsu_inv
+
+    @property
+    def adaptativo_inv(self):
+        if self._adaptativo is None:
+            self._adaptativo = _adaptive_inv(self.gray)
+        return self._adaptativo
+
+    def adaptativo_compartido(self, rects):
+        """
+        El umbral adaptativo es local (ventana 31): calcularlo en toda la página
+        solo compensa si las cajas (con su margen, que se solapa) cubren casi
+        toda la página; si no, es más barato hacerlo caja a caja.
+        """
+        area = sum((x1 - x0) * (y1 - y0) for x0, y0, x1, y1 in rects)
+        return area >= ADAPTIVE_PAGE_RATIO * self.gray.shape[0] * self.gray.shape[1]
+
+
+def _find_row_bands(img, inv=None):
+    """
+    Bandas horizontales de texto de una caja: [(y0, y1), ...] de arriba a abajo.
+    img: caja en BGR o, mejor, la vista gris de _Planos (sin conversión).
+    inv: vista del umbral adaptativo de la página, si ya está calculado.
+    """
+    if inv is None:
+        try:
+            inv = _adaptive_inv(_gray(img))
+        except Exception:
+            return []
+    if inv.size == 0:
         return []
-    thr = cv2.adaptiveThreshold(g, 255, cv2.ADAPTIVE_THRESH_GAUSSIAN_C,
-                                cv2.THRESH_BINARY, 31, 7)
-    inv = cv2.bitwise_not(thr)
-    hproj = np.sum(inv // 255, axis=1)
-    h = inv.shape[0]
     umbral = max(8, int(inv.shape[1] * 0.02))
-    filas, en_banda, y0 = [], False, 0
-    for y in range(h):
-        if hproj[y] > umbral and not en_banda:
-            en_banda, y0 = True, y
-        elif hproj[y] <= umbral and en_banda:
-            en_banda = False
-            y1 = y
-            if y1 - y0 >= 12:
-                filas.append(img[y0:y1, :])
-    if en_banda and h - y0 >= 12:
-        filas.append(img[y0:h, :])
-    return filas
-
-
-def _ocr_text_line(roi, lang="eng+spa"):
-    g = cv2.cvtColor(roi, cv2.COLOR_BGR2GRAY)
+    activo = np.count_nonzero(inv, axis=1) > umbral
+    # flancos de subida (+1) y bajada (-1) del perfil umbralizado
+    flancos = np.diff(activo.astype(np.int8), prepend=0, append=0)
+    inicios = np.flatnonzero(flancos == 1)
+    finales = np.flatnonzero(flancos == -1)
+    validas = (finales - inicios) >= 12
+    return [(int(a), int(b)) for a, b in zip(inicios[validas], finales[validas])]
+
+
+def _find_text_rows(img):
+    return [img[y0:y1, :] for y0, y1 in _find_row_bands(img)]
+
+
+_LINE_CFG = (
+    "--oem 3 --psm 7 "
+    "-c tessedit_char_whitelist=0123456789xX "
+    "-c classify_bln_numeric_mode=1 "
+    "-c user_defined_dpi=180"
+)
+
+# En modo lote todas las filas van en un único lienzo: psm 6 (bloque uniforme)
+_BATCH_CFG = (
+    "--oem 3 --psm 6 "
+    "-c tessedit_char_whitelist=0123456789xX "
+    "-c classify_bln_numeric_mode=1 "
+    "-c user_defined_dpi=180"
+)
+
+
+def _pieza(cant, largo, ancho):
+    return {"cantidad": cant, "largo": largo, "ancho": ancho,
+            "cantos": {"L1": False, "L2": False, "A1": False, "A2": False},
+            "ocr_texto": f"{cant} {largo}x{ancho}"}
+
+
+def _clean_line_text(txt):
+    txt = re.sub(r"[^\dxX ]", " ", txt)
+    return re.sub(r"\s+", " ", txt).strip()
+
+
+def _prep_text_line(roi):
+    g = _gray(roi)
     if g.shape[0] < 60:
         g = cv2.resize(g, None, fx=2.0, fy=2.0, interpolation=cv2.INTER_CUBIC)
     g = cv2.medianBlur(g, 3)
     _, bw = cv2.threshold(g, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    cfg = (
-        "--oem 3 --psm 7 "
-        "-c tessedit_char_whitelist=0123456789xX "
-        "-c classify_bln_numeric_mode=1 "
-        "-c user_defined_dpi=180"
-    )
+    return bw
+
+
+def _ocr_text_line(roi, lang="eng+spa", deadline=None, bw=None):
+    bw = _prep_text_line(roi) if bw is None else bw
     try:
-        txt = pytesseract.image_to_string(bw, lang=lang, config=cfg, timeout=OCR_TIMEOUT_LINE)
+        txt = _tess_string(bw, lang, _LINE_CFG, OCR_TIMEOUT_LINE, deadline)
     except RuntimeError:
         return ""
-    txt = re.sub(r"[^\dxX ]", " ", txt)
-    return re.sub(r"\s+", " ", txt).strip()
+    return _clean_line_text(txt)
 
 
-def _ocr_full_image(img, lang="eng+spa"):
-    piezas = []
-    g = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    g = cv2.GaussianBlur(g, (3, 3), 0)
+def _ocr_box_fallback(roi, lang="eng+spa", deadline=None):
+    """Caja sin filas detectadas: psm 7 y, si no sale nada, psm 6."""
+    for psm in (7, 6):
+        cfg = f"--oem 3 --psm {psm} -c tessedit_char_whitelist=0123456789xX -c classify_bln_numeric_mode=1"
+        try:
+            t = _tess_string(roi, lang, cfg, OCR_TIMEOUT_LINE, deadline)
+        except RuntimeError:
+            t = ""
+        t = _clean_line_text(t)
+        if t:
+            return t
+    return ""
 
-    variantes = []
-    _, otsu = cv2.threshold(g, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    variantes.append(otsu)
-    variantes.append(cv2.bitwise_not(otsu))
 
-    base_cfg = (
-        "--oem 3 -c tessedit_char_whitelist=0123456789xX=:-/ "
-        "-c classify_bln_numeric_mode=1 "
-        "-c user_defined_dpi=180"
-    )
+def _ocr_tarea(tarea, lang="eng+spa", deadline=None, bw=None):
+    _, _, tipo, roi = tarea
+    if tipo == "fila":
+        return _ocr_text_line(roi, lang=lang, deadline=deadline, bw=bw)
+    return _ocr_box_fallback(roi, lang=lang, deadline=deadline)
 
-    textos = []
-    for v in variantes:
-        for psm in (6, 11, 7):
-            cfg = f"{base_cfg} --psm {psm}"
-            try:
-                t = pytesseract.image_to_string(v, lang=lang, config=cfg, timeout=OCR_TIMEOUT_GLOBAL)
-                textos.append(t)
-            except RuntimeError:
-                logger.debug(f"Fallback global OCR psm {psm} timeout")
-                continue
 
+# --------------------- OCR por lotes (un solo Tesseract por lienzo) ---------------------
+def _batch_gap(imgs):
+    alturas = sorted(im.shape[0] for im in imgs)
+    return max(BATCH_MIN_GAP, alturas[len(alturas) // 2] // 2)
+
+
+def _batch_max_height(imgs):
+    """Con paralelismo, reparte las líneas en ~OCR_PARALLELISM lienzos."""
+    if OCR_PARALLELISM <= 1:
+        return OCR_BATCH_MAX_HEIGHT
+    gap = _batch_gap(imgs)
+    por_lienzo = -(-len(imgs) // OCR_PARALLELISM)
+    alto = gap + por_lienzo * (max(im.shape[0] for im in imgs) + gap)
+    return min(OCR_BATCH_MAX_HEIGHT, alto)
+
+
+def _build_batch_canvases(imgs, max_height=None):
+    """
+    Apila verticalmente las imágenes (2D, uint8, texto oscuro sobre blanco)
+    en uno o más lienzos blancos separados por un hueco.
+    Devuelve [(lienzo, [(idx, y0, y1), ...]), ...].
+    """
+    max_height = max_height or OCR_BATCH_MAX_HEIGHT
+    if not imgs:
+        return []
+    gap = _batch_gap(imgs)
+    margen = gap
+
+    grupos, actual, alto = [], [], margen
+    for idx, im in enumerate(imgs):
+        hh = im.shape[0] + gap
+        if actual and alto + hh > max_height:
+            grupos.append(actual)
+            actual, alto = [], margen
+        actual.append(idx)
+        alto += hh
+    if actual:
+        grupos.append(actual)
+
+    out = []
+    for grupo in grupos:
+        ancho = max(imgs[k].shape[1] for k in grupo) + 2 * margen
+        alto = margen + sum(imgs[k].shape[0] + gap for k in grupo)
+        lienzo = np.full((alto, ancho), 255, dtype=np.uint8)
+        spans, y = [], margen
+        for k in grupo:
+            im = imgs[k]
+            lienzo[y:y + im.shape[0], margen:margen + im.shape[1]] = im
+            spans.append((k, y, y + im.shape[0]))
+            y += im.shape[0] + gap
+        out.append((lienzo, spans))
+    return out
+
+
+def _words_to_spans(data, spans, pad):
+    """
+    Asigna cada palabra de image_to_data a su franja por el centro vertical.
+    Dentro de una franja (una caja puede tener varias líneas) las palabras se
+    ordenan por (bloque, párrafo, línea, izquierda) y cada línea se une por
+    separado, como en image_to_string.
+    """
+    por_span = {k: {} for k, _, _ in spans}
+    ceros = [0] * len(data.get("text", []))
+    bloques, parrafos, lineas = (data.get(c, ceros) for c in ("block_num", "par_num", "line_num"))
+    for i, txt in enumerate(data.get("text", [])):
+        txt = (txt or "").strip()
+        if not txt:
+            continue
+        cy = data["top"][i] + data["height"][i] / 2.0
+        for k, y0, y1 in spans:
+            if y0 - pad <= cy < y1 + pad:
+                linea = (bloques[i], parrafos[i], lineas[i])
+                por_span[k].setdefault(linea, []).append((data["left"][i], txt))
+                break
+    return {k: "\n".join(" ".join(t for _, t in sorted(ws)) for _, ws in sorted(por_linea.items()))
+            for k, por_linea in por_span.items()}
+
+
+def _ocr_lines_batch(imgs, lang="eng+spa", deadline=None):
+    """
+    OCR de muchas líneas con una sola invocación de Tesseract por lienzo.
+    Devuelve una lista de textos limpios alineada con imgs, o None en una
+    posición si ese lienzo falló (el llamante decide el fallback).
+    """
+    textos = [None] * len(imgs)
+    if not imgs:
+        return textos
+    pad = max(2, BATCH_MIN_GAP // 2)
+
+    def leer(lienzo_spans):
+        lienzo, spans = lienzo_spans
+        try:
+            data = _tess_data(lienzo, lang, _BATCH_CFG, OCR_TIMEOUT_GLOBAL, deadline)
+        except RuntimeError as e:
+            logger.debug(f"OCR por lotes falló ({len(spans)} líneas): {e}")
+            return {}
+        return _words_to_spans(data, spans, pad)
+
+    lienzos = _build_batch_canvases(imgs, max_height=_batch_max_height(imgs))
+    for por_span in _map_ordenado(leer, lienzos):
+        for k, t in por_span.items():
+            textos[k] = _clean_line_text(t)
+    return textos
+
+
+def _leer_filas_rapido(tareas, excluir=()):
+    """
+    Lector de dígitos en proceso para las tareas de tipo fila (salvo las de excluir).
+    Devuelve {índice de tarea: texto} solo con las filas leídas con confianza.
+    """
+    leidas = {}
+    for k, (_, _, tipo, roi) in enumerate(tareas):
+        if tipo != "fila" or k in excluir:
+            continue
+        texto, _ = leer_fila(_gray(roi))
+        if texto:
+            leidas[k] = texto
+    return leidas
+
+
+def _ocr_tareas(tareas, lang="eng+spa", deadline=None, preparadas=None):
+    """
+    OCR de todas las tareas (filas de cajas y cajas sin filas) de una imagen.
+    En modo lote (OCR_BATCH=1) se agrupan en un lienzo; las filas/cajas de un
+    lienzo fallido y las cajas sin texto repiten el camino individual.
+    Con OCR_PARALLELISM > 1 las llamadas se reparten en hilos; los textos
+    vuelven siempre en el orden de tareas (arriba -> abajo).
+    preparadas: lista alineada con tareas con la fila ya binarizada
+    (_prep_text_line) o None.
+    """
+    if not tareas:
+        return []
+    preparadas = preparadas or [None] * len(tareas)
+    una = lambda k: _ocr_tarea(tareas[k], lang=lang, deadline=deadline, bw=preparadas[k])  # noqa: E731
+    if not OCR_BATCH or len(tareas) == 1:
+        return _map_ordenado(una, range(len(tareas)))
+
+    imgs = []
+    for (_, _, tipo, roi), bw in zip(tareas, preparadas):
+        if tipo == "fila":
+            imgs.append(_prep_text_line(roi) if bw is None else bw)
+        else:
+            imgs.append(_gray(roi))
+    textos = _ocr_lines_batch(imgs, lang=lang, deadline=deadline)
+    if deadline is not None and deadline.expired():
+        return [t or "" for t in textos]
+    pendientes = [k for k, tarea in enumerate(tareas)
+                  if textos[k] is None or (not textos[k] and tarea[2] == "caja")]
+    for k, t in zip(pendientes, _map_ordenado(una, pendientes)):
+        textos[k] = t
+    return textos
+
+
+def _ns_filas(lang):
+    """Espacio de nombres de la caché de filas: idioma + versión del pipeline."""
+    return f"{PIPELINE_VERSION}|{lang}"
+
+
+_GLOBAL_CFG = (
+    "--oem 3 -c tessedit_char_whitelist=0123456789xX=:-/ "
+    "-c classify_bln_numeric_mode=1 "
+    "-c user_defined_dpi=180"
+)
+
+# Pasadas del fallback global (variante de binarización, psm) en el orden clásico
+_FALLBACK_PASSES = tuple((v, psm) for v in ("otsu", "otsu_inv") for psm in (6, 11, 7))
+# Historial del proceso: pasada -> [intentos, éxitos]
+_FALLBACK_STATS = {p: [0, 0] for p in _FALLBACK_PASSES}
+_FALLBACK_LOCK = threading.Lock()
+
+
+def _fallback_order():
+    """Pasadas ordenadas por tasa de éxito histórica (Laplace); empate = orden clásico."""
+    with _FALLBACK_LOCK:
+        stats = {p: tuple(v) for p, v in _FALLBACK_STATS.items()}
+    return sorted(_FALLBACK_PASSES,
+                  key=lambda p: (-(stats[p][1] + 1) / (stats[p][0] + 2), _FALLBACK_PASSES.index(p)))
+
+
+def _record_fallback(pase, ok):
+    with _FALLBACK_LOCK:
+        _FALLBACK_STATS[pase][0] += 1
+        if ok:
+            _FALLBACK_STATS[pase][1] += 1
+
+
+def fallback_stats():
+    """Historial de pasadas del fallback global en este proceso."""
+    with _FALLBACK_LOCK:
+        return {f"{v}/psm{psm}": {"intentos": n, "exitos": e} for (v, psm), (n, e) in _FALLBACK_STATS.items()}
+
+
+def _lines_from_data(data):
+    """Agrupa las palabras de image_to_data por línea: [(texto, conf_media), ...]."""
+    lineas = {}
+    for i, txt in enumerate(data.get("text", [])):
+        txt = (txt or "").strip()
+        if not txt:
+            continue
+        try:
+            conf = float(data["conf"][i])
+        except (TypeError, ValueError):
+            conf = -1.0
+        key = (data.get("block_num", [0] * (i + 1))[i], data.get("par_num", [0] * (i + 1))[i],
+               data.get("line_num", [0] * (i + 1))[i])
+        lineas.setdefault(key, []).append((data["left"][i], txt, conf))
+    out = []
+    for key in sorted(lineas):
+        palabras = sorted(lineas[key])
+        confs = [c for _, _, c in palabras if c >= 0]
+        out.append((" ".join(t for _, t, _ in palabras), sum(confs) / len(confs) if confs else 0.0))
+    return out
+
+
+def _fallback_variants(img, planos=None):
+    planos = planos or _Planos(img)
+    return {"otsu": planos.otsu, "otsu_inv": planos.otsu_inv}
+
+
+def _ocr_full_image_legacy(variantes, lang="eng+spa", deadline=None):
+    """Las 6 pasadas completas, concatenando todo el texto (comportamiento original)."""
+    textos = []
+    for v, psm in _FALLBACK_PASSES:
+        cfg = f"{_GLOBAL_CFG} --psm {psm}"
+        try:
+            textos.append(_tess_string(variantes[v], lang, cfg, OCR_TIMEOUT_GLOBAL, deadline))
+        except RuntimeError:
+            if deadline is not None and deadline.expired():
+                break
+            logger.debug(f"Fallback global OCR psm {psm} timeout")
     bruto = re.sub(r"[^\d xX]", " ", " ".join(textos))
-    for (cant, largo, ancho) in _extract_pairs_from_text(bruto):
-        piezas.append({
-            "cantidad": cant, "largo": largo, "ancho": ancho,
-            "cantos": {"L1": False, "L2": False, "A1": False, "A2": False},
-            "ocr_texto": f"{cant} {largo}x{ancho}"
-        })
-    return piezas
+    return [_pieza(c, l, a) for (c, l, a) in _extract_pairs_from_text(bruto)]
+
+
+def _ocr_full_image(img, lang="eng+spa", meta=None, deadline=None, planos=None):
+    """
+    OCR de la página completa cuando las cajas no dieron piezas.
 
+    Modo adaptativo (OCR_FALLBACK_ADAPTIVE=1): prueba las pasadas en orden de
+    éxito histórico con image_to_data y para en la primera que da ternas
+    'cantidad largo x ancho' con confianza media >= OCR_FALLBACK_MIN_CONF.
+    Si ninguna es fiable, se concatena el texto de todas (como antes).
+    Si se pasa meta (dict), se rellena meta["fallback_global"] con las pasadas
+    intentadas y omitidas. Con deadline, las pasadas que ya no caben se omiten.
+    """
+    variantes = _fallback_variants(img, planos)
+    if not OCR_FALLBACK_ADAPTIVE:
+        return _ocr_full_image_legacy(variantes, lang=lang, deadline=deadline)
+
+    orden = _fallback_order()
+    informe = {"intentadas": [], "omitidas": [], "parada_temprana": False}
+    textos, elegidas = [], None
+    for k, (v, psm) in enumerate(orden):
+        t0 = time.time()
+        pase = {"variante": v, "psm": psm}
+        if deadline is not None and deadline.expired():
+            informe["omitidas"] = [{"variante": vv, "psm": pp, "motivo": "presupuesto"} for vv, pp in orden[k:]]
+            break
+        try:
+            data = _tess_data(variantes[v], lang, f"{_GLOBAL_CFG} --psm {psm}", OCR_TIMEOUT_GLOBAL, deadline)
+        except RuntimeError as e:
+            if isinstance(e, BudgetExceeded) or (deadline is not None and deadline.expired()):
+                # sin presupuesto (o timeout recortado por él): no es un fallo de la
+                # pasada y no cuenta en su historial de éxito
+                informe["omitidas"] = [{"variante": vv, "psm": pp, "motivo": "presupuesto"}
+                                       for vv, pp in orden[k:]]
+                break
+            logger.debug(f"Fallback global OCR {v} psm {psm} timeout")
+            informe["intentadas"].append(dict(pase, error="timeout", ms=int((time.time() - t0) * 1000)))
+            _record_fallback((v, psm), False)
+            continue
+
+        lineas = _lines_from_data(data)
+        textos.extend(t for t, _ in lineas)
+        ternas, confs = [], []
+        for texto, conf in lineas:
+            pares = _extract_pairs_from_text(_clean_line_text(texto))
+            if pares:
+                ternas.extend(pares)
+                confs.append(conf)
+        conf_media = sum(confs) / len(confs) if confs else 0.0
+        ok = bool(ternas) and conf_media >= OCR_FALLBACK_MIN_CONF
+        _record_fallback((v, psm), ok)
+        informe["intentadas"].append(dict(pase, piezas=len(ternas), conf_media=round(conf_media, 1),
+                                          fiable=ok, ms=int((time.time() - t0) * 1000)))
+        if ok:
+            elegidas = ternas
+            informe["parada_temprana"] = k < len(orden) - 1
+            informe["omitidas"] = [{"variante": vv, "psm": pp} for vv, pp in orden[k + 1:]]
+            break
+
+    if meta is not None:
+        meta["fallback_global"] = informe
+    if elegidas is None:
+        bruto = re.sub(r"[^\d xX]", " ", " ".join(textos))
+        elegidas = _extract_pairs_from_text(bruto)
+    return [_pieza(c, l, a) for (c, l, a) in elegidas]
 
-def _detect_text_boxes(img):
-    gray = cv2.cvtColor(img, cv2.COLOR_BGR2GRAY)
-    blur = cv2.GaussianBlur(gray, (3, 3), 0)
-    _, th = cv2.threshold(blur, 0, 255, cv2.THRESH_BINARY + cv2.THRESH_OTSU)
-    inv = cv2.bitwise_not(th)
+
+def _detect_text_boxes(img, planos=None):
+    inv = (planos or _Planos(img)).otsu_inv
     kernel = cv2.getStructuringElement(cv2.MORPH_RECT, (15, 3))
     morphed = cv2.morphologyEx(inv, cv2.MORPH_CLOSE, kernel)
     contours, _ = cv2.findContours(morphed, cv2.RETR_EXTERNAL, cv2.CHAIN_APPROX_SIMPLE)
@@ -179,14 +765,82 @@ def _detect_text_boxes(img):
     return boxes
 
 
-def _save_debug_overlay(img, boxes, out_path):
-    if not boxes:
-        return None
+def _draw_debug_overlay(img, boxes, filas=None, textos=None):
+    """
+    Cajas (rojo) con sus bandas de fila (verde) y, si se da, el texto
+    reconocido por caja (cian). boxes: [(x, y, w, h, ...)]; filas: [(x, y, w, h)].
+    """
     vis = img.copy()
-    for (x, y, w, h, _) in boxes:
+    for (x, y, w, h) in filas or []:
+        cv2.rectangle(vis, (x, y), (x + w, y + h), (0, 180, 0), 1)
+    for k, (x, y, w, h) in enumerate(b[:4] for b in boxes):
         cv2.rectangle(vis, (x, y), (x + w, y + h), (0, 0, 255), 2)
         text = f"{x}x{y} {w}x{h}"
         cv2.putText(vis, text, (x + 4, y + 18), cv2.FONT_HERSHEY_SIMPLEX, 0.45, (0, 255, 255), 1, cv2.LINE_AA)
+        leido = (textos[k] if textos and k < len(textos) else "") or ""
+        if leido:
+            cv2.putText(vis, leido.replace("\n", " | ")[:80], (x + w + 6, y + 18), cv2.FONT_HERSHEY_SIMPLEX,
+                        0.5, (255, 255, 0), 1, cv2.LINE_AA)
+    return vis
+
+
+OVERLAY_FORMATS = {
+    "png": (".png", "image/png", [cv2.IMWRITE_PNG_COMPRESSION, 1]),
+    "jpg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 80]),
+    "jpeg": (".jpg", "image/jpeg", [cv2.IMWRITE_JPEG_QUALITY, 80]),
+    "webp": (".webp", "image/webp", [cv2.IMWRITE_WEBP_QUALITY, 80]),
+}
+
+
+def render_overlay(image, boxes, filas=None, textos=None, size=None, scale=1.0, fmt="png", orientacion=None):
+    """
+    Renderiza bajo demanda el overlay de depuración de un resultado ya calculado.
+    image: la imagen guardada por imagen_overlay (ya corregida: orientacion=None)
+    o la original (ruta/bytes/ndarray, se decodifica como en el análisis);
+    boxes/filas en coordenadas de la imagen analizada, de tamaño size=(ancho, alto).
+    orientacion: meta["orientacion"] del análisis (la misma corrección se aplica aquí).
+    Devuelve (bytes, mimetype) o (None, None) si la imagen no se puede leer.
+    """
+    ext, mimetype, params = OVERLAY_FORMATS[fmt]
+    img, _ = _load_image(image, max_side=MAX_SIDE)
+    if img is None:
+        return None, None
+    img = ocr_orientacion.corregir(img, orientacion)
+    if size and (img.shape[1], img.shape[0]) != tuple(size):
+        img = cv2.resize(img, tuple(int(v) for v in size))
+    vis = _draw_debug_overlay(img, boxes, filas, textos)
+    if scale and scale != 1.0:
+        vis = cv2.resize(vis, None, fx=scale, fy=scale,
+                         interpolation=cv2.INTER_AREA if scale < 1 else cv2.INTER_LINEAR)
+    ok, buf = cv2.imencode(ext, vis, params)
+    return (buf.tobytes(), mimetype) if ok else (None, None)
+
+
+def imagen_overlay(image, orientacion=None, calidad=85):
+    """
+    Imagen analizada (lado mayor <= MAX_SIDE, orientación corregida) en JPEG,
+    para guardarla con el resultado en lugar del original y dibujar sobre ella
+    el overlay con render_overlay(..., orientacion=None).
+    image: la imagen que devuelve analyze_image_result(con_imagen=True) (solo
+    se codifica) o la subida (se decodifica, reduce y corrige: caché OCR).
+    Devuelve bytes o None si no se puede leer.
+    """
+    img, _ = _load_image(image, max_side=MAX_SIDE)
+    if img is None:
+        return None
+    lado = max(img.shape[:2])
+    if lado > MAX_SIDE:
+        f = MAX_SIDE / lado
+        img = cv2.resize(img, None, fx=f, fy=f, interpolation=cv2.INTER_AREA)
+    img = ocr_orientacion.corregir(img, orientacion)
+    ok, buf = cv2.imencode(".jpg", img, [cv2.IMWRITE_JPEG_QUALITY, calidad])
+    return buf.tobytes() if ok else None
+
+
+def _save_debug_overlay(img, boxes, out_path, filas=None, textos=None):
+    if not boxes:
+        return None
+    vis = _draw_debug_overlay(img, boxes, filas, textos)
 
     try:
         tmp_out = out_path
@@ -215,116 +869,340 @@ def _write_last_result_json(result_obj, path=LAST_JSON_PATH):
         logger.debug(f"No se pudo escribir last_result.json: {e}")
 
 
-def analyze_image(image_path, lang="eng+spa", dump_csv=False):
-    logger.info(f"Analyze image: {image_path}")
+# --------------------- Ingesta de imagen (en memoria) ---------------------
+_REDUCED_FLAGS = ((8, cv2.IMREAD_REDUCED_COLOR_8), (4, cv2.IMREAD_REDUCED_COLOR_4),
+                  (2, cv2.IMREAD_REDUCED_COLOR_2))
+
+
+def _image_size(data):
+    """(ancho, alto) leyendo solo la cabecera (PIL abre en modo perezoso)."""
+    try:
+        from PIL import Image
+        with Image.open(io.BytesIO(data)) as im:
+            return im.size
+    except Exception:
+        return None
+
+
+def _decode_image(data, max_side=None):
+    """
+    Decodifica bytes con cv2.imdecode. Si la imagen es mucho mayor que max_side,
+    decodifica ya reducida (1/2, 1/4, 1/8: escalado DCT en JPEG) sin bajar de max_side.
+    Devuelve (img, (ancho_original, alto_original)) o (None, None).
+    """
+    buf = np.frombuffer(data, dtype=np.uint8)
+    size = _image_size(data)
+    flag = cv2.IMREAD_COLOR
+    if size and max_side and OCR_REDUCED_DECODE:
+        lado = max(size)
+        for factor, f in _REDUCED_FLAGS:
+            if lado / factor >= max_side:
+                flag = f
+                break
+    img = cv2.imdecode(buf, flag)
+    if img is None and flag != cv2.IMREAD_COLOR:
+        img = cv2.imdecode(buf, cv2.IMREAD_COLOR)
+    if img is None:
+        return None, None
+    if size is None:
+        size = (img.shape[1], img.shape[0])
+    return img, size
+
+
+def _load_image(image, max_side=None):
+    """
+    Acepta ruta (str/PathLike), bytes/bytearray/memoryview o ndarray (BGR o gris).
+    Devuelve (img_bgr, (ancho_original, alto_original)) o (None, None).
+    """
+    if isinstance(image, np.ndarray):
+        img = image
+        if img.ndim == 2:
+            img = cv2.cvtColor(img, cv2.COLOR_GRAY2BGR)
+        elif img.shape[2] == 4:
+            img = cv2.cvtColor(img, cv2.COLOR_BGRA2BGR)
+        return img, (img.shape[1], img.shape[0])
+    if isinstance(image, (bytes, bytearray, memoryview)):
+        return _decode_image(bytes(image), max_side=max_side)
+    try:
+        with open(image, "rb") as f:
+            data = f.read()
+    except (OSError, TypeError):
+        return None, None
+    return _decode_image(data, max_side=max_side)
+
+
+def _pyramid_crop(full, escala, rect, bandas):
+    """
+    Lleva un recorte (x0, y0, x1, y1) y sus bandas de fila de la imagen de
+    detección a la de resolución completa. Las bandas ganan un píxel de
+    margen (en la escala pequeña) por arriba y por abajo.
+    Devuelve (roi_completa, [(y0, y1), ...]).
+    """
+    x0, y0, x1, y1 = rect
+    fh, fw = full.shape[:2]
+    fx0, fy0 = int(x0 * escala), int(y0 * escala)
+    fx1, fy1 = min(fw, int(np.ceil(x1 * escala))), min(fh, int(np.ceil(y1 * escala)))
+    roi = full[fy0:fy1, fx0:fx1]
+    margen = int(np.ceil(escala))
+    alto = roi.shape[0]
+    bandas_full = [(max(0, int(b0 * escala) - margen), min(alto, int(np.ceil(b1 * escala)) + margen))
+                   for b0, b1 in bandas]
+    return roi, bandas_full
+
+
+def _image_label(image):
+    return os.fspath(image) if isinstance(image, (str, os.PathLike)) else None
+
+
+def _empty_result(image_path=None):
+    return {"piezas": [], "image_width": 0, "image_height": 0, "boxes": [], "filas": [], "textos_cajas": [],
+            "meta": {"image_path": image_path}, "parcial": False}
+
+
+def analyze_image_result(image_path, lang="eng+spa", deadline=None, debug_overlay=None, con_imagen=False):
+    """
+    Igual que analyze_image pero devuelve un dict:
+    {"piezas", "image_width", "image_height", "boxes": [[x, y, w, h], ...],
+     "filas": [[x, y, w, h], ...], "textos_cajas": [texto por caja], "meta", "parcial"}
+    (dimensiones, cajas y filas en coordenadas de la imagen analizada/reducida;
+    con eso render_overlay dibuja el overlay bajo demanda).
+    image_path puede ser una ruta, los bytes del fichero o un ndarray BGR.
+    deadline (Deadline) limita el tiempo total de Tesseract; por defecto
+    OCR_REQUEST_BUDGET. Si se agota, "parcial" es True.
+    debug_overlay: ruta donde guardar el overlay de cajas (opcional).
+    con_imagen: añade "imagen", el ndarray BGR analizado (para imagen_overlay
+    sin volver a decodificar).
+    """
+    image_path_label = _image_label(image_path)
+    logger.info(f"Analyze image: {image_path_label or type(image_path).__name__}")
     start = time.time()
+    if deadline is None:
+        deadline = Deadline()
 
-    img = cv2.imread(image_path)
+    decode_side = (OCR_PYRAMID_SIDE or None) if OCR_PYRAMID else MAX_SIDE
+    with deadline.etapa("decode"):
+        img, orig_size = _load_image(image_path, max_side=decode_side)
     if img is None:
         logger.error("No se pudo leer la imagen.")
-        return [], 0, 0
+        return _empty_result(image_path_label)
 
-    h, w = img.shape[:2]
-    if max(h, w) > MAX_SIDE:
-        esc = MAX_SIDE / max(h, w)
-        img = cv2.resize(img, (int(w * esc), int(h * esc)))
+    w, h = orig_size
+    full = None
+    if OCR_PYRAMID:
+        full = img
+        fh, fw = full.shape[:2]
+        if OCR_PYRAMID_SIDE and max(fh, fw) > OCR_PYRAMID_SIDE:
+            with deadline.etapa("resize"):
+                esc = OCR_PYRAMID_SIDE / max(fh, fw)
+                full = cv2.resize(full, (int(fw * esc), int(fh * esc)), interpolation=cv2.INTER_AREA)
+    ih, iw = img.shape[:2]
+    if max(ih, iw) > MAX_SIDE:
+        with deadline.etapa("resize"):
+            esc = MAX_SIDE / max(ih, iw)
+            img = cv2.resize(img, (int(iw * esc), int(ih * esc)),
+                             interpolation=cv2.INTER_AREA if full is not None else cv2.INTER_LINEAR)
         logger.debug(f"Imagen reducida a {img.shape[1]}x{img.shape[0]}")
+    # escala detección -> OCR; sin ganancia de resolución no merece la pena
+    escala = full.shape[1] / img.shape[1] if full is not None else 1.0
+    if escala < 1.05:
+        full, escala = None, 1.0
 
-    boxes = _detect_text_boxes(img)
+    planos = _Planos(img)
+    with deadline.etapa("preprocess"):
+        planos.otsu_inv
+    orientacion = None
+    if OCR_DESKEW:
+        with deadline.etapa("orientacion"):
+            orientacion = ocr_orientacion.estimar(planos.gray, planos.otsu_inv)
+            if orientacion is not None:
+                logger.info(f"Orientación corregida: {orientacion}")
+                img = ocr_orientacion.corregir(img, orientacion)
+                if full is not None:
+                    full = ocr_orientacion.corregir(full, orientacion)
+                    escala = full.shape[1] / img.shape[1]
+                planos = _Planos(img)
+                planos.otsu_inv
+    full_planos = _Planos(full) if full is not None else None
+    with deadline.etapa("detect_boxes"):
+        boxes = _detect_text_boxes(img, planos)
     piezas = []
+    digitos = cache_filas = None
+    filas_abs = []
+    textos_cajas = [""] * len(boxes)
     if boxes:
         logger.info(f"Detectadas {len(boxes)} cajas")
-        for i, (x, y, ww, hh, _) in enumerate(boxes, start=1):
+        tareas = []
+        rects = []
+        for (x, y, ww, hh, _) in boxes:
             pad_x = int(ww * 0.03) + 2
             pad_y = int(hh * 0.15) + 2
-            x0 = max(0, x - pad_x)
-            y0 = max(0, y - pad_y)
-            x1 = min(img.shape[1], x + ww + pad_x)
-            y1 = min(img.shape[0], y + hh + pad_y)
-            roi = img[y0:y1, x0:x1]
-            filas = _find_text_rows(roi)
-            if filas:
-                for j, r in enumerate(filas, 1):
-                    t = _ocr_text_line(r, lang=lang)
-                    if not t:
-                        continue
-                    logger.debug(f"[OCR][box {i} fila {j}] '{t}'")
-                    for (cant, largo, ancho) in _extract_pairs_from_text(t):
-                        piezas.append({"cantidad": cant, "largo": largo, "ancho": ancho,
-                                       "cantos": {"L1": False, "L2": False, "A1": False, "A2": False},
-                                       "ocr_texto": f"{cant} {largo}x{ancho}"})
+            rects.append((max(0, x - pad_x), max(0, y - pad_y),
+                          min(img.shape[1], x + ww + pad_x), min(img.shape[0], y + hh + pad_y)))
+        with deadline.etapa("preprocess"):
+            gris = (full_planos or planos).gray
+            adaptativo = planos.adaptativo_inv if planos.adaptativo_compartido(rects) else None
+        for i, (x0, y0, x1, y1) in enumerate(rects, start=1):
+            with deadline.etapa("find_rows"):
+                bandas = _find_row_bands(planos.gray[y0:y1, x0:x1],
+                                         inv=adaptativo[y0:y1, x0:x1] if adaptativo is not None else None)
+            filas_abs.extend([x0, y0 + b0, x1 - x0, b1 - b0] for b0, b1 in bandas)
+            if full is not None:
+                # mismos recortes, leídos de la imagen a resolución completa
+                roi, bandas = _pyramid_crop(gris, escala, (x0, y0, x1, y1), bandas)
             else:
-                for psm in (7, 6):
-                    cfg = f"--oem 3 --psm {psm} -c tessedit_char_whitelist=0123456789xX -c classify_bln_numeric_mode=1"
-                    try:
-                        t = pytesseract.image_to_string(roi, lang=lang, config=cfg, timeout=OCR_TIMEOUT_LINE)
-                    except RuntimeError:
-                        t = ""
-                    t = re.sub(r"[^\dxX ]", " ", t)
-                    t = re.sub(r"\s+", " ", t).strip()
-                    if t:
-                        logger.debug(f"[OCR][box {i} psm{psm}] '{t}'")
-                        for (cant, largo, ancho) in _extract_pairs_from_text(t):
-                            piezas.append({"cantidad": cant, "largo": largo, "ancho": ancho,
-                                           "cantos": {"L1": False, "L2": False, "A1": False, "A2": False},
-                                           "ocr_texto": f"{cant} {largo}x{ancho}"})
-                        break
-
-    if not piezas:
+                roi = gris[y0:y1, x0:x1]
+            if bandas:
+                tareas.extend((i, j, "fila", roi[b0:b1, :]) for j, (b0, b1) in enumerate(bandas, 1))
+            else:
+                tareas.append((i, 0, "caja", roi))
+
+        rapidas, preparadas, consultas = {}, {}, {}
+        row_cache = get_row_cache()
+        if row_cache is not None:
+            with deadline.etapa("cache_filas"):
+                ns = _ns_filas(lang)
+                for k, (_, _, tipo, roi) in enumerate(tareas):
+                    if tipo != "fila":
+                        continue
+                    preparadas[k] = _prep_text_line(roi)
+                    c = row_cache.consultar(preparadas[k], ns)
+                    if c is not None and c.acierto:
+                        rapidas[k] = c.texto
+                    elif c is not None:
+                        consultas[k] = c
+            cache_filas = {"filas": len(preparadas), "aciertos": len(rapidas)}
+        if OCR_DIGITS:
+            with deadline.etapa("digitos"):
+                leidas = _leer_filas_rapido(tareas, excluir=rapidas)
+            digitos = {"filas": sum(1 for t in tareas if t[2] == "fila") - len(rapidas), "aceptadas": len(leidas)}
+            rapidas.update(leidas)
+        pendientes = [k for k in range(len(tareas)) if k not in rapidas]
+        with deadline.etapa("ocr_boxes"):
+            leidos = _ocr_tareas([tareas[k] for k in pendientes], lang=lang, deadline=deadline,
+                                 preparadas=[preparadas.get(k) for k in pendientes])
+        textos = [rapidas.get(k) for k in range(len(tareas))]
+        for k, t in zip(pendientes, leidos):
+            textos[k] = t
+            if k in consultas:
+                row_cache.guardar(consultas[k], t)
+        for (i, j, tipo, _), t in zip(tareas, textos):
+            if not t:
+                continue
+            etiqueta = f"fila {j}" if tipo == "fila" else "caja"
+            logger.debug(f"[OCR][box {i} {etiqueta}] '{t}'")
+            textos_cajas[i - 1] = f"{textos_cajas[i - 1]}\n{t}" if textos_cajas[i - 1] else t
+            for (cant, largo, ancho) in _extract_pairs_from_text(t):
+                piezas.append(_pieza(cant, largo, ancho))
+
+    meta = {"image_path": image_path_label}
+    if not piezas and deadline.expired():
+        logger.warning("Presupuesto OCR agotado; se omite el OCR global")
+    elif not piezas:
         logger.info("No se detectaron piezas por cajas; probando OCR global")
-        piezas = _ocr_full_image(img, lang=lang)
+        meta["fallback_global_usado"] = True
+        with deadline.etapa("fallback_global"):
+            piezas = _ocr_full_image(img, lang=lang, meta=meta, deadline=deadline, planos=planos)
+    meta["presupuesto"] = {"segundos": deadline.seconds, "agotado": deadline.agotado}
+    if digitos is not None:
+        meta["digitos"] = digitos
+    if cache_filas is not None:
+        meta["cache_filas"] = cache_filas
+    if OCR_DESKEW:
+        meta["orientacion"] = orientacion
+    if OCR_PYRAMID:
+        meta["piramide"] = {"escala": round(escala, 3)}
 
-    # Guardar overlay seguro (solo si hay cajas)
+    # Guardar overlay seguro (solo si hay cajas y se pidió; si no, render_overlay bajo demanda)
+    overlay_out = debug_overlay or (DEBUG_OVERLAY_DEFAULT if OCR_DEBUG_FILES else None)
     try:
-        overlay_out = DEBUG_OVERLAY_DEFAULT
-        input_abs = os.path.abspath(image_path)
-        if os.path.abspath(overlay_out) == input_abs:
+        if overlay_out and image_path_label and os.path.abspath(overlay_out) == os.path.abspath(image_path_label):
             overlay_out = os.path.join("/tmp", f"debug_overlay_{int(time.time())}.png")
-        saved = _save_debug_overlay(img, boxes, overlay_out)
-        if saved:
-            logger.debug(f"Overlay guardado en {saved}")
+        if boxes and overlay_out:
+            with deadline.etapa("overlay"):
+                saved = _save_debug_overlay(img, boxes, overlay_out, filas_abs, textos_cajas)
+            if saved:
+                logger.debug(f"Overlay guardado en {saved}")
     except Exception as e:
         logger.debug(f"No se pudo generar overlay: {e}")
 
-    # Guardar last_result.json
+    # Guardar last_result.json (solo depuración local)
+    if OCR_DEBUG_FILES:
+        try:
+            result_obj = {
+                "image_height": int(h),
+                "image_width": int(w),
+                "meta": {"image_path": image_path_label},
+                "piezas": piezas
+            }
+            with deadline.etapa("write_json"):
+                _write_last_result_json(result_obj, path=LAST_JSON_PATH)
+        except Exception as e:
+            logger.debug(f"Error guardando last_result.json: {e}")
+
+    if deadline.agotado:
+        logger.warning(f"Resultado parcial: presupuesto de {deadline.seconds:g} s agotado")
+    total_ms = (time.time() - start) * 1000.0
+    meta.setdefault("fallback_global_usado", False)
+    meta["tiempos_ms"] = {k: round(v, 2) for k, v in deadline.tiempos_ms.items()}
+    meta["tiempos_ms"]["total"] = round(total_ms, 2)
+    meta["tesseract_llamadas"] = deadline.tesseract_llamadas
+    logger.info(f"Análisis finalizado en {int(total_ms)} ms. Piezas: {len(piezas)}")
+    resultado = {
+        "piezas": piezas,
+        "image_width": img.shape[1],
+        "image_height": img.shape[0],
+        "boxes": [[int(x), int(y), int(ww), int(hh)] for (x, y, ww, hh, _) in boxes],
+        "filas": [[int(v) for v in f] for f in filas_abs],
+        "textos_cajas": textos_cajas,
+        "meta": meta,
+        "parcial": deadline.agotado,
+    }
+    if con_imagen:
+        resultado["imagen"] = img
+    return resultado
+
+
+def analyze_image(image_path, lang="eng+spa", dump_csv=False):
+    res = analyze_image_result(image_path, lang=lang)
+    return res["piezas"], res["image_width"], res["image_height"]
+
+
+def pipeline_params(lang="eng+spa"):
+    """Parámetros que cambian el resultado del OCR (para claves de caché)."""
+    return {"version": PIPELINE_VERSION, "lang": lang, "max_side": MAX_SIDE, "batch": OCR_BATCH,
+            "reduced_decode": OCR_REDUCED_DECODE, "fallback_adaptive": OCR_FALLBACK_ADAPTIVE,
+            "fallback_min_conf": OCR_FALLBACK_MIN_CONF, "pyramid": OCR_PYRAMID,
+            "pyramid_side": OCR_PYRAMID_SIDE if OCR_PYRAMID else None,
+            "digits": [OCR_DIGITS_MIN_SIM, OCR_DIGITS_MIN_MARGIN] if OCR_DIGITS else False,
+            "row_cache": OCR_ROW_CACHE_MAX_DIST if OCR_ROW_CACHE and not OCR_ROW_CACHE_AUDIT else False,
+            "deskew": [ocr_orientacion.OCR_DESKEW_MIN_ANGLE, ocr_orientacion.OCR_DESKEW_MAX_ANGLE,
+                       ocr_orientacion.OCR_DESKEW_PERSPECTIVE] if OCR_DESKEW else False}
+
+
+def run_ocr_result(image_path, debug_overlay=None, lang="eng+spa", deadline=None, con_imagen=False):
+    """
+    Como run_ocr_and_get_pieces pero devuelve el dict completo de
+    analyze_image_result (piezas, dimensiones, cajas, meta y parcial).
+    """
     try:
-        result_obj = {
-            "image_height": int(h),
-            "image_width": int(w),
-            "meta": {"image_path": image_path},
-            "piezas": piezas
-        }
-        _write_last_result_json(result_obj, path=LAST_JSON_PATH)
+        if debug_overlay and os.path.dirname(debug_overlay):
+            os.makedirs(os.path.dirname(debug_overlay), exist_ok=True)
+        return analyze_image_result(image_path, lang=lang, deadline=deadline, debug_overlay=debug_overlay,
+                                    con_imagen=con_imagen)
     except Exception as e:
-        logger.debug(f"Error guardando last_result.json: {e}")
-
-    logger.info(f"Análisis finalizado en {int((time.time()-start)*1000)} ms. Piezas: {len(piezas)}")
-    return piezas, img.shape[1], img.shape[0]
+        logger.exception(f"run_ocr_and_get_pieces error: {e}")
+        return _empty_result(_image_label(image_path))
 
 
 def run_ocr_and_get_pieces(image_path, debug_overlay=None, lang="eng+spa"):
     """
     Public API expected by app.py.
-    If debug_overlay is provided (path), copy the internal /tmp/debug_overlay.png to that path.
+    image_path may be a path, the raw file bytes or a BGR ndarray.
+    If debug_overlay is provided (path), the box overlay is written to that path.
     Returns (piezas, width, height).
     """
-    try:
-        piezas, w, h = analyze_image(image_path, lang=lang)
-        # Si el usuario pidió un path para el overlay, copiarlo si existe
-        internal_overlay = DEBUG_OVERLAY_DEFAULT
-        if debug_overlay and os.path.exists(internal_overlay):
-            try:
-                # si rutas coinciden, saltar copia
-                if os.path.abspath(debug_overlay) != os.path.abspath(internal_overlay):
-                    # asegurar directorio destino
-                    os.makedirs(os.path.dirname(debug_overlay), exist_ok=True)
-                    shutil.copy(internal_overlay, debug_overlay)
-            except Exception as e:
-                logger.debug(f"No se pudo copiar overlay a {debug_overlay}: {e}")
-        return piezas, w, h
-    except Exception as e:
-        logger.exception(f"run_ocr_and_get_pieces error: {e}")
-        return [], 0, 0
+    res = run_ocr_result(image_path, debug_overlay=debug_overlay, lang=lang)
+    return res["piezas"], res["image_width"], res["image_height"]
 
 
 if __name__ == "__main__":
@@ -334,5 +1212,5 @@ if __name__ == "__main__":
         sys.exit(1)
     imgp = sys.argv[1]
     os.environ["OCR_DEBUG"] = "1"
-    pcs, W, H = run_ocr_and_get_pieces(imgp)
+    pcs, W, H = run_ocr_and_get_pieces(imgp, debug_overlay=DEBUG_OVERLAY_DEFAULT)
     print("RESULT:", pcs)
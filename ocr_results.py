@@ -0,0 +1,219 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_results.py
+Almacén de resultados OCR por id para Carpinter-IA.
+
+Sustituye al global ULTIMO_RESULTADO y a los ficheros fijos de /tmp
+(output_from_json.pdf, debug_overlay.png, last_result.json): cada petición
+guarda su resultado con un id propio, de modo que varios workers/hilos de
+gunicorn no se pisan.
+
+SQLite local (WAL) compartido por todos los workers del contenedor:
+- results: JSON del resultado (piezas, dimensiones, cajas, meta)
+- blobs:   artefactos binarios por resultado (pdf, overlay...)
+
+Expulsión: por TTL (OCR_RESULTS_TTL) y por tamaño total (OCR_RESULTS_MAX_MB);
+al superarlo se borran los resultados usados hace más tiempo.
+
+Variables de entorno:
+- OCR_RESULTS_DB      ruta SQLite (por defecto /tmp/carpinter_results.sqlite3)
+- OCR_RESULTS_TTL     segundos que se conserva un resultado (por defecto 3600)
+- OCR_RESULTS_MAX_MB  tope de tamaño de resultados + blobs (por defecto 200)
+"""
+
+import os
+import json
+import time
+import uuid
+import sqlite3
+import logging
+import tempfile
+import threading
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_RESULTS_DB = os.environ.get("OCR_RESULTS_DB", os.path.join(tempfile.gettempdir(), "carpinter_results.sqlite3"))
+OCR_RESULTS_TTL = float(os.environ.get("OCR_RESULTS_TTL", 3600))
+OCR_RESULTS_MAX_MB = float(os.environ.get("OCR_RESULTS_MAX_MB", 200))
+
+_PURGE_EVERY = 30  # s entre purgas completas (TTL + tamaño)
+
+
+class ResultStore:
+    def __init__(self, path=OCR_RESULTS_DB, ttl=OCR_RESULTS_TTL, max_mb=OCR_RESULTS_MAX_MB):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self._local = threading.local()
+        self._last_purge = 0.0
+        c = self._conn()
+        c.execute("""CREATE TABLE IF NOT EXISTS results (
+            id TEXT PRIMARY KEY, created REAL, accessed REAL, size INTEGER, data TEXT)""")
+        c.execute("""CREATE TABLE IF NOT EXISTS blobs (
+            result_id TEXT, name TEXT, mimetype TEXT, data BLOB, PRIMARY KEY (result_id, name))""")
+        c.execute("CREATE INDEX IF NOT EXISTS results_accessed ON results (accessed)")
+        c.execute("CREATE INDEX IF NOT EXISTS results_created ON results (created)")
+
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    # --------------------- escritura ---------------------
+    def put(self, result, blobs=None):
+        """
+        Guarda el resultado (dict JSON) y sus blobs {nombre: (bytes, mimetype)}.
+        Devuelve el id nuevo.
+        """
+        result_id = uuid.uuid4().hex
+        data = json.dumps(result, ensure_ascii=False)
+        ahora = time.time()
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            c.execute("INSERT INTO results (id, created, accessed, size, data) VALUES (?, ?, ?, ?, ?)",
+                      (result_id, ahora, ahora, len(data), data))
+            for nombre, (contenido, mimetype) in (blobs or {}).items():
+                self._put_blob(c, result_id, nombre, contenido, mimetype)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        self._maybe_purge()
+        return result_id
+
+    def _put_blob(self, c, result_id, nombre, contenido, mimetype):
+        c.execute("INSERT OR REPLACE INTO blobs (result_id, name, mimetype, data) VALUES (?, ?, ?, ?)",
+                  (result_id, nombre, mimetype, sqlite3.Binary(contenido)))
+        c.execute("UPDATE results SET size = size + ? WHERE id = ?", (len(contenido), result_id))
+
+    def put_blob(self, result_id, nombre, contenido, mimetype):
+        """Añade (o reemplaza) un blob a un resultado existente. False si no existe."""
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            if c.execute("SELECT 1 FROM results WHERE id = ?", (result_id,)).fetchone() is None:
+                c.execute("ROLLBACK")
+                return False
+            viejo = c.execute("SELECT length(data) FROM blobs WHERE result_id = ? AND name = ?",
+                              (result_id, nombre)).fetchone()
+            if viejo:
+                c.execute("UPDATE results SET size = size - ? WHERE id = ?", (viejo[0] or 0, result_id))
+            self._put_blob(c, result_id, nombre, contenido, mimetype)
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        self._maybe_purge()
+        return True
+
+    # --------------------- lectura ---------------------
+    def get(self, result_id):
+        c = self._conn()
+        row = c.execute("SELECT data, created FROM results WHERE id = ?", (result_id,)).fetchone()
+        if not row or self._caducado(row[1]):
+            return None
+        c.execute("UPDATE results SET accessed = ? WHERE id = ?", (time.time(), result_id))
+        return json.loads(row[0])
+
+    def get_blob(self, result_id, nombre):
+        """(bytes, mimetype) o None."""
+        row = self._conn().execute(
+            "SELECT b.data, b.mimetype, r.created FROM blobs b JOIN results r ON r.id = b.result_id "
+            "WHERE b.result_id = ? AND b.name = ?", (result_id, nombre)).fetchone()
+        if not row or self._caducado(row[2]):
+            return None
+        return bytes(row[0]), row[1]
+
+    def blob_names(self, result_id):
+        """Nombres de los blobs de un resultado (sin leer su contenido)."""
+        return {r[0] for r in self._conn().execute(
+            "SELECT name FROM blobs WHERE result_id = ?", (result_id,))}
+
+    def latest(self, con_blob=None):
+        """
+        (id, resultado) del resultado más reciente (de cualquier worker), o (None, None).
+        con_blob: si se indica, el más reciente que tenga ese blob.
+        """
+        limite = time.time() - self.ttl if self.ttl else 0
+        if con_blob:
+            row = self._conn().execute(
+                "SELECT r.id, r.data FROM results r JOIN blobs b ON b.result_id = r.id "
+                "WHERE b.name = ? AND r.created >= ? ORDER BY r.created DESC LIMIT 1",
+                (con_blob, limite)).fetchone()
+        else:
+            row = self._conn().execute(
+                "SELECT id, data FROM results WHERE created >= ? ORDER BY created DESC LIMIT 1",
+                (limite,)).fetchone()
+        if not row:
+            return None, None
+        return row[0], json.loads(row[1])
+
+    def _caducado(self, created):
+        return bool(self.ttl) and created < time.time() - self.ttl
+
+    # --------------------- expulsión ---------------------
+    def _maybe_purge(self):
+        if time.monotonic() - self._last_purge < _PURGE_EVERY:
+            return
+        self._last_purge = time.monotonic()
+        try:
+            self.purge()
+        except sqlite3.Error as e:
+            logger.debug(f"No se pudo purgar resultados: {e}")
+
+    def _delete(self, c, ids):
+        for i in range(0, len(ids), 500):
+            trozo = ids[i:i + 500]
+            marcas = ",".join("?" * len(trozo))
+            c.execute(f"DELETE FROM blobs WHERE result_id IN ({marcas})", trozo)
+            c.execute(f"DELETE FROM results WHERE id IN ({marcas})", trozo)
+
+    def purge(self):
+        """Borra caducados y, si se supera el tope, los menos usados hasta el 90 %. Devuelve nº borrados."""
+        c = self._conn()
+        c.execute("BEGIN IMMEDIATE")
+        try:
+            borrados = []
+            if self.ttl:
+                borrados = [r[0] for r in c.execute(
+                    "SELECT id FROM results WHERE created < ?", (time.time() - self.ttl,))]
+                self._delete(c, borrados)
+            total = c.execute("SELECT COALESCE(SUM(size), 0) FROM results").fetchone()[0]
+            if self.max_bytes and total > self.max_bytes:
+                objetivo = int(self.max_bytes * 0.9)
+                sobrantes = []
+                for rid, size in c.execute("SELECT id, size FROM results ORDER BY accessed"):
+                    if total <= objetivo:
+                        break
+                    sobrantes.append(rid)
+                    total -= size
+                self._delete(c, sobrantes)
+                borrados += sobrantes
+            c.execute("COMMIT")
+        except Exception:
+            c.execute("ROLLBACK")
+            raise
+        return len(borrados)
+
+    def stats(self):
+        n, total = self._conn().execute("SELECT COUNT(*), COALESCE(SUM(size), 0) FROM results").fetchone()
+        return {"results": n, "bytes": total, "max_bytes": self.max_bytes, "ttl": self.ttl}
+
+
+_STORE = None
+_STORE_LOCK = threading.Lock()
+
+
+def get_store():
+    """Almacén del proceso (conexiones SQLite por hilo; se reabren tras fork)."""
+    global _STORE
+    if _STORE is None:
+        with _STORE_LOCK:
+            if _STORE is None:
+                _STORE = ResultStore()
+    return _STORE
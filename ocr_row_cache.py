@@ -0,0 +1,308 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_row_cache.py
+Caché de filas OCR por huella perceptual para Carpinter-IA.
+
+Las mismas filas impresas (medidas estándar, cabeceras, plantillas del mismo
+taller) se repiten entre subidas. En lugar de mandar cada fila a Tesseract,
+se calcula una huella de la fila binarizada por _prep_text_line y, si ya se
+leyó una fila (casi) idéntica, se reutiliza su texto.
+
+Huella: recorte a la tinta, reducción a 128x24 (INTER_AREA) y umbral -> 3072
+bits. Las filas se agrupan en cubetas por proporción de la tinta (log ancho/alto)
+y la búsqueda aproximada compara por distancia de Hamming solo con la cubeta
+propia y las vecinas.
+
+Niveles:
+- memoria: LRU acotado (OCR_ROW_CACHE_ITEMS)
+- SQLite opcional (OCR_ROW_CACHE_DB): persiste entre reinicios y se comparte
+  entre workers; al arrancar se precargan en memoria las filas más recientes.
+
+Modo auditoría (OCR_ROW_CACHE_AUDIT=1): nunca se salta Tesseract; cada fila
+con un candidato a distancia <= OCR_ROW_CACHE_AUDIT_RADIUS se compara con el
+texto de Tesseract y se acumula por distancia (iguales / distintos). stats()
+devuelve ese histograma, los falsos aciertos con el umbral actual y el umbral
+más alto por debajo del primer falso acierto observado.
+
+Variables de entorno:
+- OCR_ROW_CACHE               "1" activa la caché (por defecto "0")
+- OCR_ROW_CACHE_ITEMS         filas en memoria (por defecto 4096)
+- OCR_ROW_CACHE_MAX_DIST      bits distintos aceptados como acierto (por defecto 12; 0 = exacta)
+- OCR_ROW_CACHE_DB            ruta SQLite del nivel persistente (vacío = solo memoria)
+- OCR_ROW_CACHE_DB_ITEMS      tope de filas en SQLite (por defecto 100000)
+- OCR_ROW_CACHE_AUDIT         "1" modo auditoría
+- OCR_ROW_CACHE_AUDIT_RADIUS  distancia máxima registrada en auditoría (por defecto 96)
+"""
+
+import os
+import time
+import sqlite3
+import logging
+import threading
+from collections import OrderedDict
+
+import cv2
+import numpy as np
+
+import ocr_metrics
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_ROW_CACHE = os.environ.get("OCR_ROW_CACHE", "0") == "1"
+OCR_ROW_CACHE_ITEMS = int(os.environ.get("OCR_ROW_CACHE_ITEMS", 4096))
+OCR_ROW_CACHE_MAX_DIST = int(os.environ.get("OCR_ROW_CACHE_MAX_DIST", 12))
+OCR_ROW_CACHE_DB = os.environ.get("OCR_ROW_CACHE_DB", "")
+OCR_ROW_CACHE_DB_ITEMS = int(os.environ.get("OCR_ROW_CACHE_DB_ITEMS", 100000))
+OCR_ROW_CACHE_AUDIT = os.environ.get("OCR_ROW_CACHE_AUDIT", "0") == "1"
+OCR_ROW_CACHE_AUDIT_RADIUS = int(os.environ.get("OCR_ROW_CACHE_AUDIT_RADIUS", 96))
+
+HUELLA_W, HUELLA_H = 128, 24
+_HUELLA_BYTES = HUELLA_W * HUELLA_H // 8
+_CUBETAS_POR_UNIDAD = 6  # resolución de la cubeta en log(ancho/alto)
+_POPCOUNT = np.array([bin(i).count("1") for i in range(256)], np.uint8)
+_PURGE_EVERY = 500  # escrituras en SQLite entre purgas
+
+ROW_CACHE_TOTAL = ocr_metrics.REGISTRY.register(ocr_metrics.Counter(
+    "carpinter_ocr_row_cache_total", "Consultas a la caché de filas OCR", ("resultado",)))
+
+
+def huella(bw):
+    """
+    bw: fila binarizada (texto negro sobre blanco, como _prep_text_line).
+    Devuelve (huella en bytes, cubeta) o None si no hay tinta suficiente.
+    """
+    tinta = bw < 128
+    ys = np.flatnonzero(tinta.any(axis=1))
+    xs = np.flatnonzero(tinta.any(axis=0))
+    if len(ys) < 4 or len(xs) < 4:
+        return None
+    recorte = tinta[ys[0]:ys[-1] + 1, xs[0]:xs[-1] + 1].view(np.uint8) * np.uint8(255)
+    h, w = recorte.shape
+    peq = cv2.resize(recorte, (HUELLA_W, HUELLA_H), interpolation=cv2.INTER_AREA)
+    return np.packbits(peq >= 128).tobytes(), int(round(np.log(w / h) * _CUBETAS_POR_UNIDAD))
+
+
+class Consulta:
+    """Resultado de consultar(): candidato encontrado y si cuenta como acierto."""
+    __slots__ = ("ns", "clave", "cubeta", "texto", "dist", "origen", "acierto")
+
+    def __init__(self, ns, clave, cubeta):
+        self.ns, self.clave, self.cubeta = ns, clave, cubeta
+        self.texto, self.dist, self.origen, self.acierto = None, None, None, False
+
+
+class RowCache:
+    def __init__(self, items=OCR_ROW_CACHE_ITEMS, max_dist=OCR_ROW_CACHE_MAX_DIST, db_path=OCR_ROW_CACHE_DB,
+                 db_items=OCR_ROW_CACHE_DB_ITEMS, audit=OCR_ROW_CACHE_AUDIT, audit_radius=OCR_ROW_CACHE_AUDIT_RADIUS):
+        self.items = max(1, int(items))
+        self.max_dist = max(0, int(max_dist))
+        self.audit = audit
+        self.audit_radius = max(self.max_dist, int(audit_radius))
+        self.db_path = db_path or None
+        self.db_items = db_items
+        self._lru = OrderedDict()  # (ns, clave) -> (texto, cubeta)
+        self._cubetas = {}         # (ns, cubeta) -> {clave: None}
+        self._matrices = {}        # (ns, cubeta) -> (claves, matriz uint8 [n, bytes])
+        self._lock = threading.Lock()
+        self._local = threading.local()
+        self._escrituras = 0
+        self.stats_counts = {"consultas": 0, "sin_tinta": 0, "hits_mem": 0, "hits_db": 0, "hits_cercanos": 0,
+                             "misses": 0, "puts": 0, "evictions_mem": 0,
+                             "auditadas": 0, "falsos_aciertos": 0}
+        self.por_distancia = {}    # auditoría: distancia -> [iguales, distintos]
+        if self.db_path:
+            try:
+                self._init_db()
+            except sqlite3.Error as e:
+                logger.warning(f"Caché de filas sin SQLite ({e})")
+                self.db_path = None
+
+    # --------------------- SQLite ---------------------
+    def _conn(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None or getattr(self._local, "pid", None) != os.getpid():
+            conn = sqlite3.connect(self.db_path, timeout=30, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            self._local.conn, self._local.pid = conn, os.getpid()
+        return conn
+
+    def _init_db(self):
+        c = self._conn()
+        c.execute("""CREATE TABLE IF NOT EXISTS filas (
+            ns TEXT, clave BLOB, cubeta INTEGER, texto TEXT, usado REAL, PRIMARY KEY (ns, clave))""")
+        c.execute("CREATE INDEX IF NOT EXISTS filas_usado ON filas (usado)")
+        recientes = c.execute("SELECT ns, clave, cubeta, texto FROM filas ORDER BY usado DESC LIMIT ?",
+                              (self.items,)).fetchall()
+        with self._lock:
+            for ns, clave, cubeta, texto in reversed(recientes):
+                self._mem_put(ns, bytes(clave), cubeta, texto)
+
+    def _db_get(self, ns, clave):
+        if not self.db_path:
+            return None
+        try:
+            c = self._conn()
+            row = c.execute("SELECT texto FROM filas WHERE ns = ? AND clave = ?", (ns, clave)).fetchone()
+            if row:
+                c.execute("UPDATE filas SET usado = ? WHERE ns = ? AND clave = ?", (time.time(), ns, clave))
+            return row[0] if row else None
+        except sqlite3.Error as e:
+            logger.debug(f"Caché de filas: lectura SQLite falló: {e}")
+            return None
+
+    def _db_put(self, ns, clave, cubeta, texto):
+        if not self.db_path:
+            return
+        try:
+            c = self._conn()
+            c.execute("INSERT OR REPLACE INTO filas (ns, clave, cubeta, texto, usado) VALUES (?, ?, ?, ?, ?)",
+                      (ns, clave, cubeta, texto, time.time()))
+            self._escrituras += 1
+            if self._escrituras % _PURGE_EVERY == 0:
+                c.execute("DELETE FROM filas WHERE rowid IN (SELECT rowid FROM filas ORDER BY usado DESC "
+                          "LIMIT -1 OFFSET ?)", (self.db_items,))
+        except sqlite3.Error as e:
+            logger.debug(f"Caché de filas: escritura SQLite falló: {e}")
+
+    # --------------------- memoria (con self._lock) ---------------------
+    def _mem_put(self, ns, clave, cubeta, texto):
+        k = (ns, clave)
+        if k in self._lru:
+            self._lru.move_to_end(k)
+        else:
+            self._cubetas.setdefault((ns, cubeta), {})[clave] = None
+            self._matrices.pop((ns, cubeta), None)
+        self._lru[k] = (texto, cubeta)
+        while len(self._lru) > self.items:
+            (ns_v, clave_v), (_, cubeta_v) = self._lru.popitem(last=False)
+            self._cubetas[(ns_v, cubeta_v)].pop(clave_v, None)
+            self._matrices.pop((ns_v, cubeta_v), None)
+            self.stats_counts["evictions_mem"] += 1
+
+    def _matriz(self, ns, cubeta):
+        m = self._matrices.get((ns, cubeta))
+        if m is None:
+            claves = list(self._cubetas.get((ns, cubeta)) or ())
+            if not claves:
+                return None
+            m = self._matrices[(ns, cubeta)] = (
+                claves, np.frombuffer(b"".join(claves), np.uint8).reshape(len(claves), _HUELLA_BYTES))
+        return m
+
+    def _cercana(self, ns, clave, cubeta, radio):
+        """(texto, distancia) de la fila más parecida de las cubetas vecinas, o (None, None)."""
+        q = np.frombuffer(clave, np.uint8)
+        mejor = (None, None)
+        for b in (cubeta, cubeta - 1, cubeta + 1):
+            m = self._matriz(ns, b)
+            if m is None:
+                continue
+            claves, matriz = m
+            dist = _POPCOUNT[matriz ^ q].sum(axis=1, dtype=np.int32)
+            i = int(dist.argmin())
+            if dist[i] <= radio and (mejor[1] is None or dist[i] < mejor[1]):
+                k = (ns, claves[i])
+                self._lru.move_to_end(k)
+                mejor = (self._lru[k][0], int(dist[i]))
+        return mejor
+
+    # --------------------- API ---------------------
+    def consultar(self, bw, ns=""):
+        """
+        Busca la fila binarizada bw. Devuelve una Consulta (acierto=True si su
+        texto se puede usar sin Tesseract) o None si la fila no tiene tinta.
+        ns separa resultados de distintos idiomas/versiones del pipeline.
+        """
+        h = huella(bw)
+        if h is None:
+            self.stats_counts["sin_tinta"] += 1
+            return None
+        c = Consulta(ns, *h)
+        self.stats_counts["consultas"] += 1
+        with self._lock:
+            exacta = self._lru.get((ns, c.clave))
+            if exacta is not None:
+                self._lru.move_to_end((ns, c.clave))
+                c.texto, c.dist, c.origen = exacta[0], 0, "mem"
+        if c.texto is None:
+            texto = self._db_get(ns, c.clave)
+            if texto is not None:
+                with self._lock:
+                    self._mem_put(ns, c.clave, c.cubeta, texto)
+                c.texto, c.dist, c.origen = texto, 0, "db"
+        radio = self.audit_radius if self.audit else self.max_dist
+        if c.texto is None and radio > 0:
+            with self._lock:
+                c.texto, c.dist = self._cercana(ns, c.clave, c.cubeta, radio)
+            c.origen = "cercano" if c.texto is not None else None
+        if c.texto is not None and c.dist <= self.max_dist and not self.audit:
+            c.acierto = True
+            clave_stat = {"mem": "hits_mem", "db": "hits_db", "cercano": "hits_cercanos"}[c.origen]
+            self.stats_counts[clave_stat] += 1
+            ROW_CACHE_TOTAL.inc(resultado="hit")
+        else:
+            self.stats_counts["misses"] += 1
+            ROW_CACHE_TOTAL.inc(resultado="miss")
+        return c
+
+    def guardar(self, consulta, texto):
+        """Guarda el texto leído por Tesseract para una consulta fallida (y audita el candidato)."""
+        if consulta is None or consulta.acierto or not texto:
+            return
+        if self.audit and consulta.texto is not None:
+            distinto = consulta.texto != texto
+            with self._lock:
+                self.por_distancia.setdefault(consulta.dist, [0, 0])[distinto] += 1
+                if consulta.dist <= self.max_dist:
+                    self.stats_counts["auditadas"] += 1
+                    self.stats_counts["falsos_aciertos"] += distinto
+            if distinto and consulta.dist <= self.max_dist:
+                ROW_CACHE_TOTAL.inc(resultado="false_match")
+                logger.debug(f"Caché de filas: falso acierto a {consulta.dist} bits "
+                             f"('{consulta.texto}' != '{texto}')")
+        if consulta.dist == 0 and consulta.texto == texto:
+            return
+        self.stats_counts["puts"] += 1
+        with self._lock:
+            self._mem_put(consulta.ns, consulta.clave, consulta.cubeta, texto)
+        self._db_put(consulta.ns, consulta.clave, consulta.cubeta, texto)
+
+    def _umbral_sugerido(self):
+        """
+        Auditoría: distancia justo por debajo del primer falso acierto observado
+        (-1 si los hay incluso a distancia 0), o el radio si no hubo ninguno.
+        """
+        falsos = [d for d, (_, distintos) in self.por_distancia.items() if distintos]
+        return min(falsos) - 1 if falsos else self.audit_radius
+
+    def stats(self):
+        out = dict(self.stats_counts)
+        hits = out["hits_mem"] + out["hits_db"] + out["hits_cercanos"]
+        out["hit_rate"] = round(hits / out["consultas"], 4) if out["consultas"] else 0.0
+        with self._lock:
+            out["items_mem"] = len(self._lru)
+            por_distancia = {d: list(v) for d, v in sorted(self.por_distancia.items())}
+            umbral = self._umbral_sugerido()
+        out.update(max_dist=self.max_dist, audit=self.audit, db=bool(self.db_path))
+        if self.audit:
+            out["audit_radius"] = self.audit_radius
+            out["por_distancia"] = {str(d): {"iguales": v[0], "distintos": v[1]} for d, v in por_distancia.items()}
+            out["umbral_sugerido"] = umbral
+        return out
+
+
+_ROW_CACHE = None
+_ROW_CACHE_LOCK = threading.Lock()
+
+
+def get_row_cache():
+    """Caché de filas del proceso, o None si OCR_ROW_CACHE=0."""
+    global _ROW_CACHE
+    if not OCR_ROW_CACHE:
+        return None
+    if _ROW_CACHE is None:
+        with _ROW_CACHE_LOCK:
+            if _ROW_CACHE is None:
+                _ROW_CACHE = RowCache()
+    return _ROW_CACHE
@@ -0,0 +1,142 @@
+# -*- coding: utf-8 -*-
+"""
+ocr_warmup.py
+Arranque en frío rápido de Carpinter-IA.
+
+app.py ya no importa cv2/numpy/pytesseract/ReportLab al cargarse: /health y
+el arranque del proceso son inmediatos. El coste se paga aquí, una vez por
+proceso:
+
+- precargar_modulos(): solo importa los módulos pesados. Es seguro antes de
+  fork (no crea hilos, procesos ni conexiones), así que gunicorn con
+  preload_app lo llama en el master y los workers heredan las páginas.
+- iniciar(): en cada worker (post_fork) lanza un hilo que, por pasos:
+    * construye las plantillas de dígitos (si OCR_DIGITS=1);
+    * comprueba que Tesseract (pool o binario) lee de verdad una fila de
+      prueba (arranca el pool);
+    * hace un OCR diminuto con el pipeline completo (hilos de OpenCV);
+    * genera un PDF/XLSX diminuto.
+- estado(): lo que devuelve GET /ready (listo, error, tiempos por paso).
+
+Variables de entorno:
+- OCR_WARMUP  "1" (por defecto) calienta al arrancar el worker; "0" lo desactiva
+              y /ready responde listo sin calentar.
+"""
+
+import os
+import time
+import logging
+import threading
+
+logger = logging.getLogger("carpinter_ocr")
+
+OCR_WARMUP = os.environ.get("OCR_WARMUP", "1") == "1"
+
+_LOCK = threading.Lock()
+_LISTO = threading.Event()
+_ESTADO = {"pid": None, "estado": "pendiente", "error": None, "pasos_ms": {}}
+
+
+def precargar_modulos():
+    """Importa los módulos pesados (sin efectos laterales). Devuelve ms."""
+    t0 = time.perf_counter()
+    import cv2  # noqa: F401
+    import numpy  # noqa: F401
+    import ocr_rayas_tesseract  # noqa: F401  (pytesseract, ocr_pool)
+    import generar_pdf  # noqa: F401  (ReportLab, openpyxl)
+    return round((time.perf_counter() - t0) * 1000.0, 1)
+
+
+def _imagen_minima():
+    """Fila "2 600x400" dentro de una caja, codificada en PNG."""
+    import cv2
+    import numpy as np
+    img = np.full((120, 420, 3), 255, np.uint8)
+    cv2.rectangle(img, (10, 10), (410, 110), (0, 0, 0), 2)
+    cv2.putText(img, "2  600x400", (40, 75), cv2.FONT_HERSHEY_SIMPLEX, 1.2, (20, 20, 20), 2, cv2.LINE_AA)
+    ok, buf = cv2.imencode(".png", img)
+    return buf.tobytes()
+
+
+def _paso(nombre, fn):
+    t0 = time.perf_counter()
+    try:
+        return fn()
+    finally:
+        _ESTADO["pasos_ms"][nombre] = round((time.perf_counter() - t0) * 1000.0, 1)
+
+
+def _comprobar_tesseract():
+    """
+    El pipeline traga los errores de Tesseract (fila vacía); aquí deben fallar.
+    No basta con que el binario o el pool arranquen: se lee la fila mínima y
+    se exige que salgan sus dígitos.
+    """
+    import cv2
+    import numpy as np
+    from ocr_pool import get_pool
+    img = cv2.imdecode(np.frombuffer(_imagen_minima(), np.uint8), cv2.IMREAD_GRAYSCALE)
+    pool = get_pool()
+    if pool is None:  # sin pool: pytesseract lanza el binario
+        import pytesseract
+        _ESTADO["tesseract"] = str(pytesseract.get_tesseract_version())
+        texto = pytesseract.image_to_string(img, lang="eng", config="--psm 7", timeout=30)
+    else:
+        _ESTADO["tesseract"] = "pool"
+        texto = pool.image_to_string(img, lang="eng", config="--psm 7", timeout=30)
+    if "600" not in (texto or ""):
+        raise RuntimeError(f"Tesseract ({_ESTADO['tesseract']}) no lee la fila de prueba: {texto!r}")
+
+
+def calentar():
+    """Ejecuta el calentamiento completo en el hilo actual."""
+    _ESTADO.update(estado="calentando", error=None)
+    t0 = time.perf_counter()
+    try:
+        _paso("imports", precargar_modulos)
+        from ocr_rayas_tesseract import run_ocr_result, Deadline, OCR_DIGITS
+        from generar_pdf import generar_pdf_bytes, generar_xlsx_bytes
+        if OCR_DIGITS:
+            import ocr_digitos
+            _paso("plantillas_digitos", ocr_digitos.plantillas)
+        _paso("tesseract", _comprobar_tesseract)
+        res = _paso("ocr", lambda: run_ocr_result(_imagen_minima(), deadline=Deadline(0)))
+        _ESTADO["tesseract_llamadas"] = (res.get("meta") or {}).get("tesseract_llamadas", 0)
+        _paso("pdf", lambda: generar_pdf_bytes(res["piezas"] or [{"cantidad": 1, "largo": 1, "ancho": 1}]))
+        _paso("xlsx", lambda: generar_xlsx_bytes(res["piezas"]))
+        _ESTADO["estado"] = "listo"
+    except Exception as e:
+        _ESTADO.update(estado="error", error=str(e))
+        logger.warning(f"Calentamiento fallido: {e}")
+    finally:
+        _ESTADO["pasos_ms"]["total"] = round((time.perf_counter() - t0) * 1000.0, 1)
+        _LISTO.set()
+    logger.info(f"Calentamiento {_ESTADO['estado']} en {_ESTADO['pasos_ms']['total']} ms (pid {os.getpid()})")
+
+
+def iniciar():
+    """Lanza el calentamiento en segundo plano (una vez por proceso; tras fork vuelve a lanzarse)."""
+    with _LOCK:
+        if _ESTADO["pid"] == os.getpid():
+            return
+        _ESTADO.update(pid=os.getpid(), estado="pendiente", error=None, pasos_ms={})
+        _LISTO.clear()
+        if not OCR_WARMUP:
+            _ESTADO["estado"] = "listo"
+            _LISTO.set()
+            return
+        threading.Thread(target=calentar, name="ocr-warmup", daemon=True).start()
+
+
+def listo():
+    return _LISTO.is_set() and _ESTADO["estado"] == "listo"
+
+
+def esperar(timeout=None):
+    """Bloquea hasta que termine el calentamiento (o timeout). Devuelve listo()."""
+    _LISTO.wait(timeout)
+    return listo()
+
+
+def estado():
+    return dict(_ESTADO, pasos_ms=dict(_ESTADO["pasos_ms"]), listo=listo())